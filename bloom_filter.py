@@ -0,0 +1,83 @@
+# bloom_filter.py
+
+'''Bloom filters of Zobrist hashes, used to quickly reject positions that are 
+not in a repertoire book without touching the book itself.'''
+
+import os, struct, numpy
+
+class BloomFilter(object):
+    '''A Bloom filter of 64 bit Zobrist hashes.
+
+    Since Zobrist hashes are already uniformly distributed, the bit indices
+    are taken straight from the two halves of the hash (double hashing).
+    The number of bits is always a power of two.'''
+    MAGIC = b'CNABLOOM'
+    # Magic, number of bits, number of hashes, and a stamp of four integers
+    # identifying the version of the book the filter was saved for
+    HEADER_STRUCT = struct.Struct('>8sQI4q')
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.mask = num_bits - 1
+        self.num_hashes = num_hashes
+        self.bits = bytearray(num_bits // 8) if bits == None else bytearray(bits)
+
+    @classmethod
+    def for_keys(cls, keys, bits_per_key, num_hashes):
+        '''Creates a filter sized for, and containing, the given numpy array of keys.'''
+        num_bits = 64
+        while num_bits < bits_per_key * len(keys):
+            num_bits *= 2
+        result = cls(num_bits, num_hashes)
+        result.add_many(keys)
+        return result
+
+    def indices(self, key):
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        return map(lambda i : (h1 + i * h2) & self.mask, range(self.num_hashes))
+
+    def add(self, key):
+        for i in self.indices(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def might_contain(self, key):
+        '''Returns False if the key was definitely never added.'''
+        bits = self.bits
+        for i in self.indices(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def add_many(self, keys):
+        '''Vectorized version of add for a numpy array of keys.'''
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        h1 = keys & numpy.uint64(0xFFFFFFFF)
+        h2 = (keys >> numpy.uint64(32)) | numpy.uint64(1)
+        flags = numpy.unpackbits(numpy.frombuffer(self.bits, dtype=numpy.uint8), bitorder='little').astype(bool)
+        for i in range(self.num_hashes):
+            flags[(h1 + numpy.uint64(i) * h2) & numpy.uint64(self.mask)] = True
+        self.bits = bytearray(numpy.packbits(flags, bitorder='little').tobytes())
+
+    def save(self, filename, stamp):
+        '''Saves the filter, along with a stamp of four integers identifying the book it belongs to.'''
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fil:
+            fil.write(self.HEADER_STRUCT.pack(self.MAGIC, self.num_bits, self.num_hashes, *stamp))
+            fil.write(self.bits)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, stamp):
+        '''Loads a filter saved with the given stamp, or returns None if there
+        is no such filter (in which case it should be rebuilt).'''
+        try:
+            with open(filename, 'rb') as fil:
+                header = fil.read(cls.HEADER_STRUCT.size)
+                magic, num_bits, num_hashes, *saved_stamp = cls.HEADER_STRUCT.unpack(header)
+                bits = fil.read()
+        except (OSError, struct.error):
+            return None
+        if magic != cls.MAGIC or tuple(saved_stamp) != tuple(stamp) or len(bits) != num_bits // 8:
+            return None
+        return cls(num_bits, num_hashes, bits)
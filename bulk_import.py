@@ -0,0 +1,129 @@
+# bulk_import.py
+
+'''Imports large PGN files into the saved games of a repertoire (see
+Repertoire.add_games), parsing them in parallel.'''
+
+import os, io, re, time, multiprocessing, numpy, chess.pgn
+from chess_tools import zobrist_hash, changedSquares, pieceHash, stateHash
+from position_index import PositionIndexBuilder
+
+# A blank line followed by a tag, which can only be the start of a game
+GAME_START = re.compile(rb'\n\r?\n\[')
+
+def split_ranges(filename, chunk_size):
+    '''Splits a PGN file into byte ranges of about chunk_size bytes, each
+    starting at the start of a game (except for the first, which starts at 0).'''
+    size = os.path.getsize(filename)
+    starts = [0]
+    with open(filename, 'rb') as fil:
+        offset = chunk_size
+        while offset < size:
+            fil.seek(offset)
+            data = b''
+            match = None
+            # Read until a game starts (or the file ends)
+            while match == None:
+                block = fil.read(1 << 16)
+                if len(block) == 0:
+                    break
+                data += block
+                match = GAME_START.search(data)
+            if match == None:
+                break
+            start = offset + match.end() - 1
+            starts.append(start)
+            offset = start + chunk_size
+    return list(zip(starts, starts[1:] + [size]))
+
+class MainlineHashes(chess.pgn.BaseVisitor):
+    '''Collects the Zobrist hashes of the positions of the mainline of a game
+    while it is parsed, updating them incrementally on the parser's own board
+    (see pushWithHash), without building the game tree.
+
+    As when reading a game normally, an illegal move ends its mainline.'''
+    def begin_game(self):
+        self.hashes = []
+        self.key = None
+        self.squares = None
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.squares = changedSquares(board, move)
+        self.key ^= pieceHash(board, self.squares) ^ stateHash(board)
+
+    def visit_board(self, board):
+        if self.key == None:
+            # The starting position
+            self.key = zobrist_hash(board)
+        elif self.squares != None:
+            self.key ^= pieceHash(board, self.squares) ^ stateHash(board)
+            self.squares = None
+        else:
+            # After a move that could not be parsed
+            return
+        self.hashes.append(self.key)
+
+    def handle_error(self, error):
+        pass
+
+    def result(self):
+        return self.hashes
+
+def parse_range(arguments):
+    '''Parses the games in a byte range of a PGN file, and returns their texts,
+    along with the hashes of the positions of their mainlines and the number
+    (within the range) of the game of each hash. Runs in the worker processes.'''
+    filename, start, end = arguments
+    with open(filename, 'rb') as fil:
+        fil.seek(start)
+        text = fil.read(end - start).decode('utf-8', errors='replace')
+    handle = io.StringIO(text)
+    texts, hashes, games = [], [], []
+    while True:
+        offset = handle.tell()
+        try:
+            game_hashes = chess.pgn.read_game(handle, Visitor=MainlineHashes)
+        except Exception:
+            # The rest of the range can't be parsed reliably
+            break
+        if game_hashes == None:
+            break
+        texts.append(text[offset:handle.tell()].strip() + '\n\n')
+        hashes.extend(game_hashes)
+        games.extend([len(texts) - 1] * len(game_hashes))
+    return texts, numpy.array(hashes, dtype=numpy.uint64), numpy.array(games, dtype=numpy.uint32)
+
+def bulk_import_games(repertoire, filename, chunk_size, run_size, processes=None, progress=None):
+    '''Saves the games of a PGN file with repertoire, and indexes their positions.
+
+    The file is split into ranges of about chunk_size bytes, which are parsed
+    by a pool of processes (as many as CPUs unless given). The games of each
+    range are appended to the game archive as soon as the range is parsed, in
+    the order of the file, and the (hash, game number) pairs are sorted into
+    runs of run_size pairs, which are merged into the position index at the
+    end. progress, if given, is called after each range with the number of
+    games imported, the number of bytes parsed, the size of the file, and the
+    seconds elapsed. Returns the number of games imported.'''
+    started = time.time()
+    size = os.path.getsize(filename)
+    ranges = split_ranges(filename, chunk_size)
+    builder = PositionIndexBuilder(repertoire.positions, run_size)
+    imported, parsed = 0, 0
+    # The workers only need the file and the ranges, so they are forked from a
+    # fresh server process rather than from this one, whose other threads (the
+    # compactor, the prefetcher, GLib's) may hold locks that the children
+    # would inherit held. The server imports the main script once (without
+    # running it), and the workers are forked from it.
+    with multiprocessing.get_context('forkserver').Pool(processes) as pool:
+        arguments = [(filename, start, end) for start, end in ranges]
+        for (start, end), (texts, hashes, games) in zip(ranges, pool.imap(parse_range, arguments)):
+            first = repertoire.games.append_texts(texts)
+            builder.add_many(hashes, games + numpy.uint32(first))
+            imported += len(texts)
+            parsed += end - start
+            if progress != None:
+                progress(imported, parsed, size, time.time() - started)
+    builder.finish()
+    return imported
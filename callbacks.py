@@ -11,7 +11,8 @@ from gi.repository import Gdk as gdk
 from gi.repository import Pango as pango
 from gi.repository import GLib
 import global_variables as G
-import signal, math, subprocess, sys, os, os.path, shutil, chess, chess.pgn, shlex, random
+import signal, math, subprocess, sys, os, os.path, shutil, chess, chess.pgn, shlex, random, time
+import review_log
 from functools import reduce
 from helper import *
 from opening_pgn import *
@@ -162,6 +163,39 @@ def show_opening_comment_callback(*args):
         display_status("No opening comment exists for this position.")
     return False
 
+@gui_callback
+@documented
+def search_comments_callback(*args):
+    '''Searches the opening comments for the given words (or beginnings of words), and goes to the first position found.
+
+    The positions found are printed, along with their comments.
+    Without arguments, goes to the next position found by the last search.
+    Positions are reached through the repertoire, so those not in it are not shown.'''
+    if not G.rep:
+        display_status("No repertoire file loaded.")
+        return False
+    if len(args) > 0:
+        boards = []
+        for key in G.rep.search_comments(" ".join(args)):
+            board = G.rep.find_line(key)
+            if board != None:
+                boards.append(board)
+        boards.sort(key=lambda board : len(board.move_stack))
+        for board in boards:
+            print("%s: %s" % (board_moves(board), G.rep.get_comment(board)))
+        G.comment_search_results = boards
+        G.comment_search_index = 0
+    elif len(G.comment_search_results) > 0:
+        G.comment_search_index = (G.comment_search_index + 1) % len(G.comment_search_results)
+    if len(G.comment_search_results) == 0:
+        display_status("No comments found.")
+        return False
+    board = G.comment_search_results[G.comment_search_index]
+    load_new_game_from_game(chess.pgn.Game.from_board(board), G.player)
+    G.handlers["go_to_end_callback"]()
+    display_status("(%d/%d) %s" % (G.comment_search_index + 1, len(G.comment_search_results), G.rep.get_comment(board)))
+    return False
+
 @gui_callback
 @documented
 def add_last_callback(*args):
@@ -198,25 +232,30 @@ def walk_random_opening_path_callback(*args):
     using repertoire. Avoids repeating positions when choosing a path.'''
     if G.rep:
         visited_hashes = set()
+        board = G.g.board()
+        key = chess.polyglot.zobrist_hash(board)
         while True:
-            visited_hashes.add(chess.polyglot.zobrist_hash(G.g.board()))
-            try:
-                moves = list(G.rep.findMoves(G.player, G.g.board()))
-                while moves:
-                    index = random.randint(0, len(moves) - 1)
-                    choice = moves[index]
-                    temp_board = G.g.board()
-                    temp_board.push(choice)
-                    if chess.polyglot.zobrist_hash(temp_board) in visited_hashes:
-                        del moves[index]
-                        continue
-                    else:
-                        make_move(choice)
-                        break
-                else:
-                    break
-            except:
-                # In case findMoves raises IndexError instead of returning []
+            visited_hashes.add(key)
+            # Children are found through their stored hashes (see Repertoire.successors)
+            successors = G.rep.successors(G.player, key)
+            while successors:
+                index = random.randint(0, len(successors) - 1)
+                entry, child_hash = successors[index]
+                try:
+                    choice = normalizeMove(board, entry.move)
+                except ValueError:
+                    del successors[index]
+                    continue
+                if child_hash == None:
+                    child_hash = G.rep.store_child_hash(G.player, board, entry)
+                if child_hash in visited_hashes:
+                    del successors[index]
+                    continue
+                make_move(choice)
+                board.push(choice)
+                key = child_hash
+                break
+            else:
                 break
     G.board_display.queue_draw()
     return False
@@ -358,7 +397,7 @@ def opening_games_callback(*args):
 
     This feature is experimental and probably won't work too well.'''
     games = G.rep.list_games(G.g.board())
-    display_string = " ".join(games)
+    display_string = " ".join(map(str, games))
     display_status(display_string)
     return False
 
@@ -402,6 +441,32 @@ def opening_save_game_callback(*args):
         display_status("No repertoire file loaded.")
     return False
 
+@gui_callback
+@documented
+def import_games_callback(*args):
+    '''Adds all the games of the given PGN file to the repertoire's games.
+
+    The file is parsed in the background by several processes, with the progress shown in the status bar.
+    Like saving a game, this does not affect the positions in the repertoire itself.'''
+    if not G.rep:
+        display_status("No repertoire file loaded.")
+        return False
+    filename = os.path.expanduser(" ".join(args))
+    if not os.path.isfile(filename):
+        display_status("No PGN file %s." % filename)
+        return False
+    def progress(games, parsed, size, seconds):
+        display_status("Importing %s: %d games, %d%% (%.1f MB/s, %d games/s)" % (filename, games, 100 * parsed // max(size, 1), parsed / max(seconds, 1e-3) / (1 << 20), games / max(seconds, 1e-3)))
+    def import_games():
+        try:
+            start = time.time()
+            count = G.rep.bulk_import_games(filename, progress=progress)
+            display_status("Imported %d games from %s in %.1f seconds." % (count, filename, time.time() - start))
+        except Exception as e:
+            display_status("Error importing games from %s: %s" % (filename, e))
+    threading.Thread(target=import_games, daemon=True).start()
+    return False
+
 @gui_callback
 @documented
 def display_repertoire_moves_callback(*args):
@@ -1112,6 +1177,23 @@ def load_repertoire_callback(*args):
     update_pgn_message()
     return False
 
+@gui_callback
+@documented
+def export_books_callback(*args):
+    '''Exports the repertoire's books as plain polyglot books into the given directory.'''
+    if G.rep:
+        try:
+            directory = args[0]
+        except:
+            display_status("No directory given.")
+            return False
+        try:
+            G.rep.export_books(directory)
+            display_status("Exported books to '%s'." % directory)
+        except Exception as e:
+            display_status("Error exporting books: %s" % e)
+    return False
+
 @gui_callback
 @documented
 def opening_size_callback(*args):
@@ -1119,9 +1201,7 @@ def opening_size_callback(*args):
     
     (See opening_test_callback).'''
     if G.rep:
-        opening_game = create_opening_game(None, G.rep, G.player, G.g)
-        count = countNodes(opening_game, color=G.player)
-        count -= G.g.readonly_board.fullmove_number - 1
+        count = G.rep.opening_size(G.player, G.g.board())
         display_status("Opening size: %d" % count)
     else:
         display_status("No repertoire file loaded.")
@@ -1557,6 +1637,7 @@ def puzzle_file_name_callback(*args):
 def save_puzzle_callback(*args):
     G.rep.add_initial_position(G.g.board(), save=True)
     color = G.g.board().turn
+    items = []
     for node in real_dfs(G.g):
         if len(args) > 0 and args[0] == 'all':
             indices = range(0, len(node.variations))
@@ -1566,9 +1647,10 @@ def save_puzzle_callback(*args):
             child = node.variation(i)
             b = node.board()
             if b.turn == color:
-                G.rep.appendTactic(b, child.move)
+                items.append((b, child.move))
             else:
-                G.rep.appendTactic(b, child.move, 1, 0) # Don't learn both sides
+                items.append((b, child.move, 1, 0)) # Don't learn both sides
+    G.rep.append_many(None, items)
     G.rep.flush()
 
     return False
@@ -1635,8 +1717,8 @@ def set_to_learn_callback(*args):
     if G.rep:
         # Note the following does nothing if position isn't in repertoire already,
         # or if it is already learnable
-        G.rep.make_position_learnable(G.g.board(), G.player)
-        G.rep.flush()
+        with G.rep.transaction():
+            G.rep.make_position_learnable(G.g.board(), G.player)
         mark_nodes(G.g)
         update_pgn_message()
     return False
@@ -1646,9 +1728,9 @@ def set_to_learn_callback(*args):
 def unlearn_callback(*args):
     '''Removes a position+move from spaced repetition, but keeps it in repertoire.'''
     if G.rep:
-        for var in G.g.variations:
-            G.rep.remove_learning_data(G.player, G.g.board(), var.move)
-        G.rep.flush()
+        with G.rep.transaction():
+            for var in G.g.variations:
+                G.rep.remove_learning_data(G.player, G.g.board(), var.move)
         mark_nodes(G.g)
         update_pgn_message()
     return False
@@ -1658,8 +1740,8 @@ def unlearn_callback(*args):
 def set_game_to_learn_callback(*args):
     '''Sets up spaced repetition for all special and book nodes in current game.'''
     if G.rep:
-        learn_special_nodes(G.g.root())
-        G.rep.flush()
+        with G.rep.transaction():
+            learn_special_nodes(G.g.root())
         mark_nodes(G.g.root())
         update_pgn_message()
     return False
@@ -1670,10 +1752,42 @@ def set_game_to_learn_callback(*args):
 def reset_learn_callback(*args):
     '''Resets spaced repetition learning data as new item.'''
     if G.rep:
-        G.rep.make_position_learnable(G.g.board(), G.player, override=True)
-        G.rep.flush()
+        with G.rep.transaction():
+            G.rep.make_position_learnable(G.g.board(), G.player, override=True)
     return False
 
+@gui_callback
+@documented
+def shift_learn_callback(*args):
+    '''Postpones all spaced repetition problems of the current perspective by the given number of days (e.g. after a vacation).
+
+    A negative number of days brings them forward instead.
+    With 'here' as second argument, only the positions reachable from the current one are changed.'''
+    days = days_argument(args)
+    if days == None:
+        return False
+    return bulk_learning_update(shift_due_dates(int(days * 1440)), args[1:], "Shifted due dates by %g days" % days)
+
+@gui_callback
+@documented
+def spread_learn_callback(*args):
+    '''Spreads the spaced repetition problems of the current perspective that are due now evenly over the given number of days.
+
+    The most overdue problems come first.
+    With 'here' as second argument, only the positions reachable from the current one are changed.'''
+    days = days_argument(args)
+    if days == None:
+        return False
+    return bulk_learning_update(spread_backlog(int(days * 1440)), args[1:], "Spread due problems over %g days" % days)
+
+@gui_callback
+@documented
+def reset_easiness_callback(*args):
+    '''Resets the easiness of the spaced repetition problems of the current perspective to that of new problems.
+
+    With 'here' as argument, only the positions reachable from the current one are changed.'''
+    return bulk_learning_update(reset_easiness(), args, "Reset easiness")
+
 @gui_callback
 @documented
 def reset_learn_timer_callback(*args):
@@ -1711,6 +1825,32 @@ def print_schedule_callback(*args):
         pass
     get_learning_schedule(G.g.board(), G.player, max_lines=lines)
 
+@gui_callback
+@documented
+def print_review_stats_callback(*args):
+    '''Prints statistics of the spaced repetition answers of the current perspective over the given number of days (30 by default).
+
+    Shows the retention, the number of answers and time spent per day, and the entries failed most often.'''
+    if not G.rep:
+        display_status("No repertoire file loaded.")
+        return False
+    days = 30
+    try:
+        days = int(args[0])
+    except:
+        pass
+    with G.rep.reviews.records() as records:
+        # A copy, so the log can be unmapped
+        records = review_log.select(records, review_log.book_number(G.player), time.time() - days * 86400)
+    print("Retention over the last %d days: %.1f%% of %d answers" % (days, 100 * review_log.retention(records), len(records)))
+    for day, count, seconds in zip(*review_log.daily_workload(records)):
+        print("%s: %d answers, %d minutes" % (day, count, seconds / 60))
+    keys, raw_moves, reviews, rates = review_log.failure_rates(records, min_reviews=3)
+    for key, raw_move, count, rate in list(zip(keys, raw_moves, reviews, rates))[:10]:
+        print("Key %d, move %s: %.0f%% failed of %d" % (key, decode_move(int(raw_move)).uci(), 100 * rate, count))
+    records = None
+    return False
+
 @gui_callback
 def textview_mouse_pressed_callback(widget, event):
     text_window = gtk.TextWindowType.WIDGET
@@ -1764,6 +1904,8 @@ def enter_opening_test_mode_callback(*args):
     Not sure if this still works.'''
     if G.ot_board == None:
         G.ot_board = chess.Board(G.g.readonly_board.fen()) # To strip board history
+        if G.ot_gen != None:
+            G.ot_gen.close()
         G.ot_gen = None
     setup_ot_mode()
     return False
@@ -1776,6 +1918,8 @@ def reset_test_mode_callback(*args):
     This does not necessarily produce the exact same test again.
     (For example, when using learn mode.)'''
     G.ot_board = G.g.board()
+    if G.ot_gen != None:
+        G.ot_gen.close()
     G.ot_gen = None
     setup_ot_mode()
     return False
@@ -1992,6 +2136,7 @@ def destroy_main_window_callback(widget=None):
     for e in G.engines:
         if e.transport != None:
             e.transport.send_signal(signal.SIGCONT)
+    close_repertoire()
     return False
 
 def signal_handler(signum=None):
@@ -1999,4 +2144,5 @@ def signal_handler(signum=None):
     # signum is ignored because this handler is only registered elsewhere
     # for SIGINT and SIGTERM. If that changes, this function needs to be changed
     # appropriately.
+    close_repertoire()
     exit(0)
@@ -3,6 +3,7 @@
 import chess, chess.pgn, chess.polyglot
 
 zobrist_hash = chess.polyglot.zobrist_hash
+zobrist_hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
 
 # The following two functions are meant to be inverses of each other
 
@@ -71,6 +72,77 @@ def bytesToKeyAndBits(byteArray):
 def makeEntry(board, move, weight=1, learn=0):
     return chess.polyglot.Entry(zobrist_hash(board), moveToBits(move), weight, learn, move)
 
+def pieceHash(board, squares):
+    '''Returns the part of the Zobrist hash of board due to the pieces on the given squares.'''
+    result = 0
+    for square in squares:
+        piece = board.piece_at(square)
+        if piece != None:
+            result ^= chess.polyglot.POLYGLOT_RANDOM_ARRAY[64 * ((piece.piece_type - 1) * 2 + int(piece.color)) + square]
+    return result
+
+# Castling parts of Zobrist hashes, by what they depend on (see stateHash)
+castling_hashes = {}
+
+def stateHash(board):
+    '''Returns the part of the Zobrist hash of board due to castling rights, en passant and turn.'''
+    # Only kings on their own back rank can castle
+    kings = board.kings & ~board.promoted
+    castling = (board.clean_castling_rights(), kings & board.occupied_co[chess.WHITE] & chess.BB_RANK_1,
+                kings & board.occupied_co[chess.BLACK] & chess.BB_RANK_8)
+    castling_hash = castling_hashes.get(castling)
+    if castling_hash == None:
+        castling_hash = castling_hashes[castling] = zobrist_hasher.hash_castling(board)
+    return castling_hash ^ zobrist_hasher.hash_ep_square(board) ^ zobrist_hasher.hash_turn(board)
+
+def changedSquares(board, move):
+    '''Returns the squares whose pieces change when move is played on board.'''
+    squares = [move.from_square, move.to_square]
+    if board.is_castling(move):
+        # Covers the king and rook squares of both sides, in Chess960 as well
+        rank = chess.square_rank(move.from_square)
+        squares = [chess.square(f, rank) for f in range(8)]
+    elif board.is_en_passant(move):
+        squares.append(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+    return squares
+
+def pushWithHash(board, key, move):
+    '''Plays move on board, and returns the Zobrist hash of the new position given
+    key, the hash of the old one. Only the squares the move changes are rehashed.'''
+    squares = changedSquares(board, move)
+    key ^= pieceHash(board, squares) ^ stateHash(board)
+    board.push(move)
+    return key ^ pieceHash(board, squares) ^ stateHash(board)
+
+def normalizeMove(board, move):
+    '''Returns the legal move of board that a book move stands for, raising
+    ValueError if there is none (for example, after a hash collision).
+
+    Castling can be in either form: moveToBits stores the king's destination
+    (e1g1), as python-chess writes it, while books made by other programs
+    follow the polyglot convention of king takes rook (e1h1). parse_uci takes
+    both, and returns the move in the form used by board.'''
+    return board.parse_uci(move.uci())
+
+def childHash(board, move):
+    '''Returns the Zobrist hash of the position after move is played on board.'''
+    child = board.copy(stack=False)
+    child.push(move)
+    return zobrist_hash(child)
+
+def mainlineHashes(game):
+    '''Returns the Zobrist hashes of the positions of the mainline of game, starting position included.'''
+    board = game.board()
+    key = zobrist_hash(board)
+    hashes = [key]
+    for move in game.mainline_moves():
+        key = pushWithHash(board, key, move)
+        hashes.append(key)
+    return hashes
+
+def entryToBytes(entry):
+    return chess.polyglot.ENTRY_STRUCT.pack(entry.key, entry.raw_move, entry.weight, entry.learn)
+
 def lmFilter(board, move):
     if move in board.legal_moves:
         return move
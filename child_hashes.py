@@ -0,0 +1,112 @@
+# child_hashes.py
+
+'''The Zobrist hashes of the positions that repertoire entries lead to, so that
+the repertoire can be traversed without playing through moves.'''
+
+import os, struct, numpy
+
+class ChildHashes(object):
+    '''The hash of the position reached by each (key, raw move) pair of a book,
+    kept in an append-only file next to it.
+
+    Records are (key, raw move, child hash), and later records win. Adding a
+    record never rewrites the file, so several processes can append to it
+    (under the lock of the book), and others catch up by reading the records
+    past the end of what they loaded (see load). rewrite drops the records of
+    entries that are no longer in the book.
+
+    Books from before child hashes were stored have none at first, so once
+    they are all filled in (see Repertoire.complete_child_hashes), a record
+    with COMPLETE_MARK as the child of the (0, 0) pair, which no entry has,
+    says so (see mark_complete), and self.complete is True.'''
+    RECORD_DTYPE = numpy.dtype([('key', '>u8'), ('raw_move', '>u2'), ('child', '>u8')])
+    RECORD_STRUCT = struct.Struct('>QHQ')
+    COMPLETE_MARK = int.from_bytes(b'COMPLETE', byteorder='big')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.hashes = {}
+        self.complete = False
+        self.reopen()
+
+    def reopen(self):
+        if self.fd != None:
+            os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.inode = os.fstat(self.fd).st_ino
+        self.loaded_size = 0
+        self.hashes = {}
+        self.complete = False
+        self.load()
+
+    def load(self):
+        '''Reads the records appended since the last load, or the whole file
+        again if it was rewritten in the meantime.'''
+        try:
+            if os.stat(self.filename).st_ino != self.inode:
+                return self.reopen()
+        except FileNotFoundError:
+            pass
+        size = os.fstat(self.fd).st_size
+        # A partially written record, if any, is left for the next load
+        size -= (size - self.loaded_size) % self.RECORD_STRUCT.size
+        if size <= self.loaded_size:
+            return
+        records = numpy.frombuffer(os.pread(self.fd, size - self.loaded_size, self.loaded_size), dtype=self.RECORD_DTYPE)
+        self.hashes.update(zip(zip(records['key'].tolist(), records['raw_move'].tolist()), records['child'].tolist()))
+        if self.hashes.pop((0, 0), None) == self.COMPLETE_MARK:
+            self.complete = True
+        self.loaded_size = size
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def num_records(self):
+        '''The number of records in the file, including replaced ones.'''
+        return self.loaded_size // self.RECORD_STRUCT.size
+
+    def get(self, key, raw_move):
+        '''Returns the hash of the child, or None if it is not known.'''
+        return self.hashes.get((key, raw_move))
+
+    def add_many(self, records):
+        '''Adds (key, raw move, child hash) records, skipping the ones already known.'''
+        self.load()
+        new_records = []
+        for key, raw_move, child in records:
+            if self.hashes.get((key, raw_move)) != child:
+                self.hashes[(key, raw_move)] = child
+                new_records.append(self.RECORD_STRUCT.pack(key, raw_move, child))
+        if len(new_records) > 0:
+            data = b''.join(new_records)
+            os.write(self.fd, data)
+            self.loaded_size += len(data)
+
+    def add(self, key, raw_move, child):
+        self.add_many([(key, raw_move, child)])
+
+    def mark_complete(self):
+        '''Records that every child hash that can be known is stored.'''
+        self.load()
+        if not self.complete:
+            data = self.RECORD_STRUCT.pack(0, 0, self.COMPLETE_MARK)
+            os.write(self.fd, data)
+            self.loaded_size += len(data)
+            self.complete = True
+
+    def rewrite(self, pairs):
+        '''Rewrites the file with the records of the given (key, raw move) pairs only.'''
+        self.load()
+        records = [(key, raw_move, self.hashes[(key, raw_move)]) for key, raw_move in pairs if (key, raw_move) in self.hashes]
+        if self.complete:
+            records.append((0, 0, self.COMPLETE_MARK))
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as fil:
+            fil.write(numpy.array(records, dtype=self.RECORD_DTYPE).tobytes())
+            os.fsync(fil.fileno())
+        os.replace(temp_filename, self.filename)
+        self.reopen()
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,71 @@
+# comment_search.py
+
+'''Full-text search of the comments of a repertoire (see mmrw.CommentStore).'''
+
+import re
+from bisect import bisect_left
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokens(text):
+    '''The lowercase words of a text.'''
+    return set(map(str.lower, TOKEN_PATTERN.findall(text)))
+
+class CommentSearchIndex(object):
+    '''An inverted index from the words of comments to the hashes of their positions.
+
+    Words are looked up by prefix, with a bisect in a sorted list of all words
+    (rebuilt after words are added), so that partial words match as well.
+
+    version is for the owner, to tell whether the index is up to date with the
+    comments (see CommentStore.version).'''
+    def __init__(self, comments=[]):
+        '''comments is an iterable of (position hash, comment) pairs.'''
+        self.version = None
+        self.postings = {}
+        self.position_tokens = {}
+        self.sorted_tokens = None
+        for key, comment in comments:
+            self.set(key, comment)
+
+    def set(self, key, comment):
+        '''Indexes the comment of a position, replacing the previous one.'''
+        new_tokens = tokens(comment) if comment != None else set()
+        old_tokens = self.position_tokens.get(key, set())
+        for token in old_tokens - new_tokens:
+            postings = self.postings[token]
+            postings.discard(key)
+            if len(postings) == 0:
+                del self.postings[token]
+                self.sorted_tokens = None
+        for token in new_tokens - old_tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                self.sorted_tokens = None
+            self.postings[token].add(key)
+        if len(new_tokens) > 0:
+            self.position_tokens[key] = new_tokens
+        else:
+            self.position_tokens.pop(key, None)
+
+    def matching(self, prefix):
+        '''Returns the hashes of the positions with a word starting with prefix.'''
+        if self.sorted_tokens == None:
+            self.sorted_tokens = sorted(self.postings)
+        result = set()
+        index = bisect_left(self.sorted_tokens, prefix)
+        while index < len(self.sorted_tokens) and self.sorted_tokens[index].startswith(prefix):
+            result |= self.postings[self.sorted_tokens[index]]
+            index += 1
+        return result
+
+    def search(self, query):
+        '''Returns the hashes of the positions whose comments have words starting
+        with each word of query.'''
+        result = None
+        for token in sorted(tokens(query), key=len, reverse=True):
+            matches = self.matching(token)
+            result = matches if result == None else result & matches
+            if len(result) == 0:
+                break
+        return result if result != None else set()
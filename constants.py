@@ -7,7 +7,27 @@ NULL_SQUARE = -1
 DEFAULT_SQUARE_SIZE = 50
 SR_FULL_LINE_PROBABILITY = 0.3
 WEAK_STOCKFISH_DEFAULT_LEVEL = 4
-COMMENT_ENTRY_SIZE = 256
+DELTA_MAX_ENTRIES = 4096 # Delta segment size that triggers a compaction
+DELTA_COMPACTION_INTERVAL = 300 # In seconds
+BOOK_SEARCH_MODE = 'fence' # None, 'fence', or 'interpolation' (see mmrw.KeySearch)
+FENCE_STRIDE = 256 # Entries between keys kept in a fence index
+INTERPOLATION_STEPS = 4 # Interpolation guesses before falling back to binary search
+BLOOM_BITS_PER_KEY = 10 # Bloom filter size, about 1% false positives with 7 hashes
+BLOOM_HASHES = 7
+BOOK_MIN_CAPACITY = 256 # In entries
+BOOK_GROWTH_FACTOR = 2 # Capacity multiplier when a book file runs out of room
+JOURNAL_CHECKPOINT_SIZE = 1 << 16 # In bytes, journal size after which the books are synced
+REPERTOIRE_POLL_INTERVAL = 500 # In milliseconds, between checks for repertoire changes by other processes
+GRAPH_OVERLAY_LIMIT = 4096 # Structural edits kept aside before a repertoire graph is rebuilt
+DUE_ENTRIES_CHUNK = 64 # Entries first read at once from a due index (then twice as many each time)
+VISITOR_BATCH_SIZE = 256 # Book moves a repertoire visitor looks at per hold of the books, at most
+PREFETCH_SIZE = 8 # Training positions found ahead of time in opening/tactics test mode
+REVIEW_LOG_BUFFER = 16 # Answers kept in memory before being written to the review log
+COMMENT_INDEX_MERGE_MIN = 256 # Comments set before the comment index is sorted again, at least
+COMMENT_INDEX_MERGE_FRACTION = 8 # And at least this fraction of the sorted part of the index
+COMMENT_HEAP_MIN_SIZE = 1 << 16 # In bytes, below which the comment heap is not compacted
+POSITION_INDEX_RUN_SIZE = 1 << 20 # (Position, game) pairs sorted in memory at once when adding games
+BULK_IMPORT_CHUNK_SIZE = 1 << 22 # In bytes, of the parts of a PGN file parsed by each process when importing games
 DEFAULT_CONFIG_FILENAME = "shortcuts.json"
 TABLEBASE_RESULTS = {-2 : "0-1", -1 : "Cursed black win", 0 : "1/2-1/2", 1 : "Cursed white win", 2 : "1-0"}
 
@@ -0,0 +1,113 @@
+# due_index.py
+
+'''Indexes of the entries set to learn in repertoire books, ordered by due time,
+so that the next reviews can be found without visiting the repertoire.'''
+
+import os, struct, numpy, chess, chess.polyglot
+from bisect import bisect_left, bisect_right, insort
+
+def decode_move(raw_move):
+    '''Decodes a polyglot move the same way as python-chess's readers (not normalized).'''
+    to_square = raw_move & 0x3f
+    from_square = (raw_move >> 6) & 0x3f
+    promotion_part = (raw_move >> 12) & 0x7
+    return chess.Move(from_square, to_square, promotion_part + 1 if promotion_part else None)
+
+class DueIndex(object):
+    '''The entries of a book with a nonzero learn value, as a sorted list of
+    (learn, key, raw_move, weight) tuples. Since learn values are due times
+    (in minutes after the epoch), the first items are the next ones due.
+
+    Lookups are binary searches. Updating an entry moves its item in the
+    list, which is a memmove of a list of pointers, so the index can be kept
+    up to date on every review instead of being rebuilt.'''
+    MAGIC = b'CNADUEIX'
+    # Magic, number of items, and a stamp of four integers
+    # identifying the version of the book the index was saved for
+    HEADER_STRUCT = struct.Struct('>8sQ4q')
+    ITEM_DTYPE = numpy.dtype([('learn', '>u4'), ('key', '>u8'), ('raw_move', '>u2'), ('weight', '>u2')])
+
+    def __init__(self, items=[]):
+        self.items = sorted(items)
+
+    @classmethod
+    def for_arrays(cls, arrays):
+        '''Creates an index of the entries in the given numpy arrays of entries (see ENTRY_DTYPE).'''
+        parts = [array[array['learn'] > 0] for array in arrays]
+        selected = numpy.concatenate(parts) if len(parts) > 0 else numpy.zeros(0, dtype=cls.ITEM_DTYPE)
+        order = numpy.lexsort((selected['weight'], selected['raw_move'], selected['key'], selected['learn']))
+        selected = selected[order]
+        index = cls()
+        index.items = list(zip(selected['learn'].tolist(), selected['key'].tolist(),
+                               selected['raw_move'].tolist(), selected['weight'].tolist()))
+        return index
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, entry):
+        if entry.learn > 0:
+            insort(self.items, (entry.learn, entry.key, entry.raw_move, entry.weight))
+
+    def remove(self, entry):
+        '''Removes an entry, if it is in the index.'''
+        item = (entry.learn, entry.key, entry.raw_move, entry.weight)
+        index = bisect_left(self.items, item)
+        if index < len(self.items) and self.items[index] == item:
+            del self.items[index]
+
+    def update(self, entry, weight, learn):
+        '''Records that the weight and learn values of entry changed.'''
+        self.remove(entry)
+        self.add(chess.polyglot.Entry(entry.key, entry.raw_move, weight, learn, entry.move))
+
+    def entries(self, start, end):
+        return [chess.polyglot.Entry(key, raw_move, weight, learn, decode_move(raw_move))
+                for learn, key, raw_move, weight in self.items[start:end]]
+
+    def earliest(self, count):
+        '''Returns the count entries due first, in due order.'''
+        return self.entries(0, count)
+
+    def due(self, before, count=None, after=None):
+        '''Returns the entries due at or before the given time (at any time if
+        before is None), in due order, only the first count of them if count is
+        given, and only those coming after the entry after if it is given.'''
+        start = 0
+        if after != None:
+            start = bisect_right(self.items, (after.learn, after.key, after.raw_move, after.weight))
+        end = len(self.items) if before == None else bisect_right(self.items, (before, 1 << 64))
+        if count != None:
+            end = min(end, start + count)
+        return self.entries(start, end)
+
+    def count_due(self, before):
+        return bisect_right(self.items, (before, 1 << 64))
+
+    def save(self, filename, stamp):
+        '''Saves the index, along with a stamp of four integers identifying the book it belongs to.'''
+        temp_filename = filename + '.tmp'
+        array = numpy.array(self.items, dtype=self.ITEM_DTYPE)
+        with open(temp_filename, 'wb') as fil:
+            fil.write(self.HEADER_STRUCT.pack(self.MAGIC, len(self.items), *stamp))
+            fil.write(array.tobytes())
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, stamp):
+        '''Loads an index saved with the given stamp, or returns None if there
+        is no such index (in which case it should be rebuilt).'''
+        try:
+            with open(filename, 'rb') as fil:
+                header = fil.read(cls.HEADER_STRUCT.size)
+                magic, count, *saved_stamp = cls.HEADER_STRUCT.unpack(header)
+                data = fil.read()
+        except (OSError, struct.error):
+            return None
+        if magic != cls.MAGIC or tuple(saved_stamp) != tuple(stamp) or len(data) != count * cls.ITEM_DTYPE.itemsize:
+            return None
+        array = numpy.frombuffer(data, dtype=cls.ITEM_DTYPE)
+        index = cls()
+        index.items = list(zip(array['learn'].tolist(), array['key'].tolist(),
+                               array['raw_move'].tolist(), array['weight'].tolist()))
+        return index
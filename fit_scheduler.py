@@ -0,0 +1,51 @@
+# fit_scheduler.py
+
+'''Fits the spaced repetition scheduler to the answers in the review log of a
+repertoire (see scheduler_fitting.py), and prints the result.
+
+Usage: python3 fit_scheduler.py REPERTOIRE_DIRECTORY [--retention R] [--apply]
+
+With --apply, the fitted scheduler is saved in the repertoire directory, where
+the program loads it from, and the due dates of all problems are moved to 
+those the new scheduler would have set at their last review.'''
+
+import sys, os, time, chess
+import global_variables as G
+from mmrw import Repertoire
+from review_log import ReviewLog
+from spaced_repetition import get_scheduler, load_scheduler, save_scheduler, rescheduled
+from scheduler_fitting import fit
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        exit(1)
+    directory = sys.argv[1]
+    retention = 0.9
+    if '--retention' in sys.argv:
+        retention = float(sys.argv[sys.argv.index('--retention') + 1])
+
+    log = ReviewLog(os.sep.join([directory, 'reviews']))
+    old_scheduler = load_scheduler(os.sep.join([directory, 'scheduler'])) or get_scheduler()
+    start_time = time.time()
+    with log.records() as records:
+        scheduler, report = fit(records, old_scheduler.__class__, retention=retention)
+        records = None
+    log.close()
+    print("Fitted in %f seconds." % (time.time() - start_time))
+    for name, value in report.items():
+        print("%s: %s" % (name, value))
+    if scheduler == None:
+        print("Not enough answers to fit.", file=sys.stderr)
+        exit(1)
+    for name, value in scheduler.params.items():
+        print("%s = %s" % (name, value))
+
+    if '--apply' in sys.argv:
+        G.rep = Repertoire(directory)
+        count = 0
+        for player in [chess.WHITE, chess.BLACK, None]:
+            count += G.rep.transform_learning(player, rescheduled(old_scheduler, scheduler))
+        save_scheduler(scheduler, os.sep.join([directory, 'scheduler']))
+        G.rep.close()
+        print("Rescheduled %d problems." % count)
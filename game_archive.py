@@ -0,0 +1,128 @@
+# game_archive.py
+
+'''The games saved with a repertoire, in a single PGN file.'''
+
+import os, io, struct, chess.pgn
+from process_lock import ProcessLock
+
+class GameArchive(object):
+    '''An append-only PGN file of games, along with an index of fixed width
+    (offset, length) records, so that the text of game number n is found by
+    reading the n-th record of the index and then that range of the archive.
+
+    Games are numbered in the order they were appended, from 0. Appends take
+    self.lock, and write the games before their index records, so an
+    interrupted append leaves at worst some unindexed text at the end of the
+    archive, which the next append writes past. Since the index is read with
+    pread, other processes' appends are seen right away.'''
+    RECORD_STRUCT = struct.Struct('>QI')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(filename + '.index', os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.lock = ProcessLock(self.index_fd)
+
+    def __len__(self):
+        return os.fstat(self.index_fd).st_size // self.RECORD_STRUCT.size
+
+    def append_texts(self, texts):
+        '''Appends the PGN texts of games, and returns the number of the first one.'''
+        with self.lock:
+            first = len(self)
+            offset = os.fstat(self.fd).st_size
+            # Drop a partially written record, if any
+            os.ftruncate(self.index_fd, first * self.RECORD_STRUCT.size)
+            data, records = [], []
+            for text in texts:
+                text = text.encode('utf-8')
+                records.append(self.RECORD_STRUCT.pack(offset, len(text)))
+                data.append(text)
+                offset += len(text)
+            os.write(self.fd, b''.join(data))
+            os.write(self.index_fd, b''.join(records))
+            return first
+
+    def append(self, games):
+        '''Appends games (chess.pgn.Game objects), and returns the number of the first one.'''
+        # Games are followed by a blank line, so that the archive is a valid PGN file
+        return self.append_texts([str(game) + '\n\n' for game in games])
+
+    def text(self, number):
+        '''Returns the PGN text of a game, or None if there is no such game.'''
+        if number < 0:
+            return None
+        record = os.pread(self.index_fd, self.RECORD_STRUCT.size, number * self.RECORD_STRUCT.size)
+        if len(record) < self.RECORD_STRUCT.size:
+            return None
+        offset, length = self.RECORD_STRUCT.unpack(record)
+        return os.pread(self.fd, length, offset).decode('utf-8', errors='replace')
+
+    def texts(self, numbers):
+        '''Yields the PGN texts of the given games, skipping unknown numbers.'''
+        for number in numbers:
+            text = self.text(number)
+            if text != None:
+                yield text
+
+    def game(self, number):
+        '''Returns a game as a chess.pgn.Game, or None if there is no such game.'''
+        text = self.text(number)
+        if text == None:
+            return None
+        return chess.pgn.read_game(io.StringIO(text))
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.index_fd)
+
+def convert_games_directory(directory, filename):
+    '''Converts a directory of one PGN file per game (named by its number), as
+    used before GameArchive, into an archive at filename, unless the archive
+    exists already. Games keep their numbers, with empty games standing in for
+    missing numbers.
+
+    The archive is built under a temporary name and renamed into place once
+    complete, with a lock file held throughout, so that neither an
+    interrupted conversion nor two processes converting at once leave a
+    partial archive behind.'''
+    lock_fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with ProcessLock(lock_fd):
+            if os.path.exists(filename):
+                return
+            temp_filename = filename + '.tmp'
+            # Left by an interrupted conversion
+            for name in [temp_filename, temp_filename + '.index']:
+                if os.path.exists(name):
+                    os.remove(name)
+            archive = GameArchive(temp_filename)
+            try:
+                archive.append_texts(read_games_directory(directory))
+                os.fsync(archive.fd)
+                os.fsync(archive.index_fd)
+            finally:
+                archive.close()
+            # The archive last, since it is the one whose existence marks the conversion done
+            os.replace(temp_filename + '.index', filename + '.index')
+            os.replace(temp_filename, filename)
+    finally:
+        os.close(lock_fd)
+
+def read_games_directory(directory):
+    '''Returns the PGN texts of the games of a directory of one PGN file per
+    game, by number (see convert_games_directory).'''
+    numbers = {}
+    for name in os.listdir(directory):
+        try:
+            numbers[int(name)] = name
+        except ValueError:
+            continue
+    texts = []
+    for number in range(max(numbers) + 1 if len(numbers) > 0 else 0):
+        if number in numbers:
+            with open(os.sep.join([directory, numbers[number]]), 'r') as fil:
+                texts.append(fil.read().rstrip('\n') + '\n\n')
+        else:
+            texts.append('')
+    return texts
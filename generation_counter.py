@@ -0,0 +1,76 @@
+# generation_counter.py
+
+'''Generation numbers shared between processes, so that each process can tell
+when another one changed a file they both have open.'''
+
+import os, mmap, struct, fcntl
+
+class GenerationCounter(object):
+    '''Generation numbers for a group of files, kept in a small memory mapped
+    file shared by every process using them.
+
+    Writers bump the number of a file after changing it. Other processes call
+    changed regularly, which only reads shared memory (no system calls), to
+    find out which files were changed by someone else since they last looked.
+
+    Every process using the files also holds a shared flock on the counter
+    file (see register), so a process can tell whether it is the only one.'''
+    SLOT_STRUCT = struct.Struct('>Q')
+
+    def __init__(self, filename, count):
+        self.filename = filename
+        self.count = count
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        size = count * self.SLOT_STRUCT.size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.mmap = mmap.mmap(self.fd, size)
+        # The numbers as of the last call to changed, including our own bumps
+        self.seen = self.read()
+
+    def register(self, if_alone=None):
+        '''Marks this process as using the files, until close. If no other 
+        process is using them, if_alone is called first.'''
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            alone = True
+        except BlockingIOError:
+            alone = False
+        if alone and if_alone != None:
+            if_alone()
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    def value(self, n):
+        return self.SLOT_STRUCT.unpack_from(self.mmap, n * self.SLOT_STRUCT.size)[0]
+
+    def read(self):
+        return list(map(self.value, range(self.count)))
+
+    def bump(self, n):
+        '''Records that file number n was changed by this process.
+        Returns the number it had before.'''
+        offset = n * self.SLOT_STRUCT.size
+        # Only writers take the lock, so that two bumps are never merged into one
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.SLOT_STRUCT.size, offset)
+        try:
+            value = self.SLOT_STRUCT.unpack_from(self.mmap, offset)[0]
+            self.SLOT_STRUCT.pack_into(self.mmap, offset, value + 1)
+            # If someone else changed the file since we last looked, we still need to see that
+            if self.seen[n] == value:
+                self.seen[n] = value + 1
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.SLOT_STRUCT.size, offset)
+        return value
+
+    def changed(self):
+        '''Returns the numbers of the files changed by other processes since the last call.'''
+        result = []
+        for n, value in enumerate(self.read()):
+            if value != self.seen[n]:
+                self.seen[n] = value
+                result.append(n)
+        return result
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
@@ -99,6 +99,10 @@ command_history = []
 command_index = 0
 
         
+# Results of the last search_comments command, as boards, and the one shown
+comment_search_results = []
+comment_search_index = 0
+
 # Generator for opening trainer positions
 ot_gen = None
 ot_board = None
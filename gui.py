@@ -18,6 +18,7 @@ from shortcut_loader import load_shortcuts_from_config_file
 from command_line_arguments import cla_parser
 from menu_items import MenuNode
 from json_loader import CallbackConfigManager
+from rep_visitor import batch_rep_visitor
 
 def main():
     # Change directory to application directory
@@ -67,6 +68,15 @@ def main():
         exit(1)
     if useOpeningMode and useTacticsMode:
         print("Incorrect usage. Cannot practice both opening and tactics.", file=sys.stderr)
+    if useBatchMode and not useOpeningMode:
+        print("Incorrect usage. Cannot practice a batch without ot mode.", file=sys.stderr)
+        exit(1)
+    if useBatchMode:
+        batch_args = parser.args_for_keyword("--ot_batch", enforce_num_args=True)
+        if batch_args == None or not batch_args[0].isdigit() or int(batch_args[0]) == 0:
+            print("Incorrect usage. The batch size of --ot_batch should be a positive integer.", file=sys.stderr)
+            exit(1)
+        batch_size = int(batch_args[0])
     if useOpeningMode or useTacticsMode:
         fenString = " ".join(parser.args_for_keyword("--ot")) if useOpeningMode else " ".join(parser.args_for_keyword("--tt"))
         try:
@@ -74,7 +84,12 @@ def main():
         except ValueError:
             G.ot_board = chess.Board() if useOpeningMode else None
         preparations(builder)
-        setup_ot_mode(only_sr=useLearningMode, visitor=rep_visitor if useOpeningMode else tactics_visitor)
+        visitor = rep_visitor if useOpeningMode else tactics_visitor
+        if useBatchMode:
+            # A batch is always of entries due for spaced repetition
+            visitor = lambda board, player, only_sr : batch_rep_visitor(board, player, batch_size)
+            useLearningMode = True
+        setup_ot_mode(only_sr=useLearningMode, visitor=visitor)
     else:
         preparations(builder)
 
@@ -185,13 +200,16 @@ def preparations(builder):
     except:
         pass
     mark_nodes(G.g.root())
+    GLib.timeout_add(G.REPERTOIRE_POLL_INTERVAL, watch_repertoire)
     
-# For graceful exits
-GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, signal_handler, signal.SIGINT)
-GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, signal_handler, signal.SIGTERM)
-
-# Start
-try:
-    main()
-except KeyboardInterrupt:
-    signal_handler()
+# Not when imported by the processes importing games (see bulk_import.py)
+if __name__ == '__main__':
+    # For graceful exits
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, signal_handler, signal.SIGINT)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, signal_handler, signal.SIGTERM)
+
+    # Start
+    try:
+        main()
+    except KeyboardInterrupt:
+        signal_handler()
@@ -18,7 +18,7 @@ from drawing import *
 from dfs import *
 from lichess_helpers import *
 from help_helpers import *
-from rep_visitor import rep_visitor, tactics_visitor
+from rep_visitor import rep_visitor, tactics_visitor, Prefetcher
 from pgn_visitor import game_gui_string
 
 def make_move(m):
@@ -73,29 +73,17 @@ def mark_if_book(game):
         else:
             position = game.parent.readonly_board
             parent_book = int(game.parent.book)
+            probe = G.rep.probe(G.player, position, game.move)
             
             # Normal book
-            if G.player == chess.WHITE and G.rep.hasPositionWhite(position) and game.move in G.rep.findMovesWhite(position): game.book = 1
-            elif G.player == chess.BLACK and G.rep.hasPositionBlack(position) and game.move in G.rep.findMovesBlack(position): game.book = 1
+            if probe.move_in_book: game.book = 1
             # The other player deviates first
-            elif G.player == chess.WHITE and parent_book == 1 and position.turn == chess.BLACK and game.move not in G.rep.findMovesWhite(position): game.book = 2
-            elif G.player == chess.BLACK and parent_book == 1 and position.turn == chess.WHITE and game.move not in G.rep.findMovesBlack(position): game.book = 2
+            elif parent_book == 1 and position.turn != G.player: game.book = 2
             elif parent_book == 2: game.book = 2
             
             # Check if set to learn
-            zh = chess.polyglot.zobrist_hash(position)
-            mmrw = G.rep.get_mmrw(G.player, position.turn)
-            index = mmrw.bisect_key_left(zh)
-            while index < len(mmrw):
-                entry = mmrw[index]
-                if entry.key != zh:
-                    break
-                if entry.move != game.move:
-                    index += 1
-                    continue
-                if entry.learn != 0:
-                    game.book += 0.5
-                break
+            if probe.learn != 0:
+                game.book += 0.5
 
 def is_arrow_nag(nag):
     return nag & (1 << (32 + 6 + 6))
@@ -122,6 +110,14 @@ def parse_arrow_nag(nag):
 
 def mark_nodes(game):
     '''Marks special and book nodes, as well as the arrows given by arrow nags.'''
+    if G.rep:
+        # Holding the books for the whole tree saves locking them at every node
+        with G.rep.lookups(G.player):
+            mark_subtree(game)
+    else:
+        mark_subtree(game)
+
+def mark_subtree(game):
     # TODO: Create subclass to have these attributes
     # Make sure node has an arrows attribute
     if not hasattr(game, 'my_arrows'):
@@ -146,38 +142,38 @@ def mark_nodes(game):
     children = game.variations
     num_children = len(game.variations)
     for i in range(1, num_children):
-        mark_nodes(game.variation(i))
+        mark_subtree(game.variation(i))
     if num_children > 0:
-        mark_nodes(game.variation(0))
+        mark_subtree(game.variation(0))
 
 def save_special_node_to_repertoire(game):
     '''Adds new node into repertoire for G.player side.'''
-    # Select correct helper functions for each side
-    findMoves = G.rep.findMovesWhite
+    # Select correct helper function for each side
     append = G.rep.appendWhite
     if G.player == chess.BLACK:
-        findMoves = G.rep.findMovesBlack
         append = G.rep.appendBlack
     # Save position
     if game.parent != None:
         board = game.parent.board()
         move = game.move
-        moveInBook = False
-        for m in findMoves(board): # Checking if move in book
-            if m == move:
-                moveInBook = True
-                break
-        if not moveInBook: # If it isn't in the book, add it
+        if not G.rep.probe(G.player, board, move).move_in_book: # If it isn't in the book, add it
             append(board, move)
 
-def save_special_nodes_to_repertoire(game):
-    '''Adds new nodes beneath an input node into repertoire for
-    the G.player side.'''
-    save_special_node_to_repertoire(game)
+def special_positions_and_moves(game):
+    '''Generates the position/move pairs of an input node and the special
+    nodes beneath it.'''
+    if game.parent != None:
+        yield game.parent.board(), game.move
     # Recursion
     for node in game.variations:
         if node.special:
-            save_special_nodes_to_repertoire(node)
+            yield from special_positions_and_moves(node)
+
+def save_special_nodes_to_repertoire(game):
+    '''Adds new nodes beneath an input node into repertoire for
+    the G.player side.'''
+    # All the nodes are merged into the repertoire at once
+    G.rep.append_many(G.player, special_positions_and_moves(game))
 
 def learn_special_node(game):
     if game.special:
@@ -189,6 +185,15 @@ def learn_special_nodes(game):
         if node.special:
             learn_special_nodes(node)
 
+def watch_repertoire():
+    '''Refreshes the repertoire and book marks when another process (like a 
+    trainer started by opening_test_callback) changed the repertoire.
+    Meant to be called regularly by a GLib timeout.'''
+    if G.rep and G.rep.refresh():
+        mark_nodes(G.g.root())
+        update_pgn_message()
+    return True
+
 def display_status(s):
     def f():
         G.status_bar.remove_all(G.status_bar_cid)
@@ -550,13 +555,16 @@ def make_report():
     if G.rep:
         create_opening_game("currentTest.pgn", G.rep, G.player, G.g)
         splitter = subprocess.Popen(["python3", "splitGame.py", "currentTest.pgn", "-o"])
-        file_names = ["currentTest.pgn", "currentTest.pgn.split"] + list(map(lambda x : G.rep.directory + os.sep + 'games' + os.sep + x, G.rep.list_games(G.g.board())))
+        file_names = ["currentTest.pgn", "currentTest.pgn.split"]
         reportFile = open("currentReport.pgn", 'w')
         splitter.wait()
         for name in file_names:
             fil = open(name, 'r')
             shutil.copyfileobj(fil, reportFile)
             print(file=reportFile)
+        # Saved games are copied straight from the repertoire's game archive
+        for text in G.rep.read_games(G.g.board()):
+            reportFile.write(text)
         reportFile.close()
         display_status("Report saved to currentReport.pgn.")
     else:
@@ -603,13 +611,23 @@ def ot_move_completed_callback(answer):
         return f
     return lambda _ : None
 
+def close_repertoire():
+    '''Closes the repertoire on exit, so that buffered reviews are written and
+    the indexes of the books are saved for the next start.'''
+    if G.ot_gen != None:
+        # Stops looking for positions in the background
+        G.ot_gen.close()
+    if G.rep:
+        G.rep.close()
+        G.rep = None
+
 def setup_ot_mode(only_sr=False, visitor=rep_visitor):
     '''Sets up opening trainer mode, and starts it or continues it with the next problem).'''
     tt_mode = (visitor == tactics_visitor)
 
-    # Load generator if first time
+    # Load generator if first time, which looks for positions in the background
     if G.ot_gen == None:
-        G.ot_gen = visitor(board=G.ot_board, player=G.player, only_sr=only_sr)
+        G.ot_gen = Prefetcher(visitor(board=G.ot_board, player=G.player, only_sr=only_sr), None if tt_mode else G.player)
 
     # Get next position
     try:
@@ -663,11 +681,11 @@ def sr_move_completed_callback(answer, setup_function=setup_ot_mode, tt_mode=Fal
                 # Correct answer
                 if G.sound: sound_effects.perfect_fifth()
                 # Update learning data
-                if tt_mode:
-                    G.rep.update_learning_data(None, G.g.parent.readonly_board, answer, G.ot_info.incorrect_answers, time.time() - G.ot_info.starting_time)
-                else:
-                    G.rep.update_learning_data(G.player, G.g.parent.readonly_board, answer, G.ot_info.incorrect_answers, time.time() - G.ot_info.starting_time)
-                G.rep.flush()
+                with G.rep.transaction():
+                    if tt_mode:
+                        G.rep.update_learning_data(None, G.g.parent.readonly_board, answer, G.ot_info.incorrect_answers, time.time() - G.ot_info.starting_time)
+                    else:
+                        G.rep.update_learning_data(G.player, G.g.parent.readonly_board, answer, G.ot_info.incorrect_answers, time.time() - G.ot_info.starting_time)
                 # Update last modified date for directory monitors
                 if tt_mode:
                     G.rep.update_modified_date(None, G.g.parent.readonly_board.turn)
@@ -678,7 +696,7 @@ def sr_move_completed_callback(answer, setup_function=setup_ot_mode, tt_mode=Fal
 
                 # Prepare next
                 setup_function()
-            elif guess in G.rep.findMoves(G.player, G.g.parent.readonly_board):
+            elif guess in G.rep.probe(G.player, G.g.parent.readonly_board).moves:
                 # Valid alternate, give another try with clock reset
                 G.handlers["go_back_callback"]()
                 display_status("%s is a valid alternate." % G.g.readonly_board.san(guess))
@@ -691,6 +709,26 @@ def sr_move_completed_callback(answer, setup_function=setup_ot_mode, tt_mode=Fal
         return f
     return lambda _ : None
 
+def bulk_learning_update(transform, args, description):
+    # Helper for the bulk spaced repetition callbacks, which apply to positions 
+    # reachable from the current one if 'here' is among the arguments
+    if G.rep:
+        board = G.g.board() if 'here' in args else None
+        count = G.rep.transform_learning(G.player, transform, board)
+        G.rep.update_modified_date(G.player, G.player)
+        display_status("%s for %d entries." % (description, count))
+    else:
+        display_status("No repertoire file loaded.")
+    return False
+
+def days_argument(args):
+    # Parses the number of days given to the bulk spaced repetition callbacks
+    try:
+        return float(args[0])
+    except (IndexError, ValueError):
+        display_status("Number of days needed.")
+        return None
+
 def create_board_answer_stack(board, final_answer):
     # Create stack of positions of interest
     # Helper for sr_full_line_setup
@@ -0,0 +1,159 @@
+# journal.py
+
+'''A redo journal making groups of writes to repertoire files atomic and
+durable with a single fsync.'''
+
+import os, struct, zlib
+from chess_tools import entryToBytes
+from process_lock import ProcessLock
+
+class Journal(object):
+    '''A redo journal of writes to a fixed list of files (the targets).
+
+    A transaction is written to the journal as one record per write, (target
+    number, offset, length) followed by the data, and then a commit record
+    holding the number of writes and a checksum of the transaction. Only once
+    the journal is synced are the writes applied to the targets themselves, so
+    after a crash recover can redo every committed transaction and ignore a
+    partially written one.
+
+    checkpoint syncs the targets and empties the journal, so committing a
+    transaction only costs one small append and fsync.
+
+    Several processes can share a journal: committing and applying a
+    transaction holds the journal's lock shared, and checkpoints hold it
+    exclusively, so a checkpoint never drops a transaction that is not
+    yet applied.
+
+    Targets need the following methods:
+    entry_offset(index): the byte offset of the entry at the given index in the file
+    store_at(offset, entry): writes an entry without going through the journal
+    flush(): syncs the file to disk
+
+    While a transaction is open, targets put edited entries in self.pending,
+    keyed by (target, offset), instead of writing them, and read entries
+    from there first.'''
+    RECORD_STRUCT = struct.Struct('>BQI')
+    COMMIT_TARGET = 255
+
+    def __init__(self, filename, targets):
+        self.filename = filename
+        self.targets = targets
+        self.target_numbers = dict((id(target), n) for n, target in enumerate(targets))
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.lock = ProcessLock(self.fd)
+        self.size = os.fstat(self.fd).st_size
+        self.pending = None
+        self.depth = 0
+
+    @classmethod
+    def recover(cls, filename, target_filenames):
+        '''Redoes the committed transactions of a journal on the files they were
+        meant for (given in target order), then empties the journal.
+        Returns the number of transactions redone.
+
+        Only call this when no other process is using the journal.'''
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, 'rb') as fil:
+            data = fil.read()
+        transactions = []
+        writes = []
+        start = position = 0
+        while position + cls.RECORD_STRUCT.size <= len(data):
+            target, offset, length = cls.RECORD_STRUCT.unpack_from(data, position)
+            position += cls.RECORD_STRUCT.size
+            if target == cls.COMMIT_TARGET:
+                # For commit records, offset is the number of writes and length the checksum
+                if offset != len(writes) or length != zlib.crc32(data[start:position - cls.RECORD_STRUCT.size]):
+                    break
+                transactions.append(writes)
+                writes = []
+                start = position
+                continue
+            if target >= len(target_filenames) or position + length > len(data):
+                break
+            writes.append((target, offset, data[position:position + length]))
+            position += length
+
+        fds = {}
+        try:
+            for writes in transactions:
+                for target, offset, chunk in writes:
+                    if target not in fds:
+                        fds[target] = os.open(target_filenames[target], os.O_RDWR)
+                    os.pwrite(fds[target], chunk, offset)
+            for fd in fds.values():
+                os.fsync(fd)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        with open(filename, 'wb') as fil:
+            os.fsync(fil.fileno())
+        return len(transactions)
+
+    def begin(self):
+        with self.lock.thread_lock:
+            if self.depth == 0:
+                self.pending = {}
+            self.depth += 1
+
+    def end(self):
+        '''Ends a transaction, committing it if it is the outermost one.'''
+        with self.lock.thread_lock:
+            self.depth -= 1
+            if self.depth == 0:
+                self.commit_pending()
+                self.pending = None
+
+    def abort(self):
+        '''Ends a transaction, discarding its uncommitted writes if it is the outermost one.'''
+        with self.lock.thread_lock:
+            self.depth -= 1
+            if self.depth == 0:
+                self.pending = None
+
+    def commit(self, writes, apply):
+        '''Appends writes, a list of (target, offset, data) triples, to the journal
+        as one transaction, syncs it, and then calls apply to make the writes.'''
+        with self.lock.shared():
+            records = []
+            for target, offset, data in writes:
+                records.append(self.RECORD_STRUCT.pack(self.target_numbers[id(target)], offset, len(data)))
+                records.append(data)
+            records = b''.join(records)
+            records += self.RECORD_STRUCT.pack(self.COMMIT_TARGET, len(writes), zlib.crc32(records))
+            os.write(self.fd, records)
+            os.fsync(self.fd)
+            self.size += len(records)
+            apply()
+
+    def commit_pending(self):
+        '''Commits and applies the edits of the open transaction so far.'''
+        with self.lock.shared():
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+            def apply():
+                for (target, offset), entry in pending.items():
+                    target.store_at(offset, entry)
+            self.commit(list(map(lambda item : (item[0][0], item[0][1], entryToBytes(item[1])), pending.items())), apply)
+
+    def checkpoint(self):
+        '''Commits the open transaction so far, syncs the targets, and empties the journal.'''
+        with self.lock:
+            self.commit_pending()
+            # Other processes may have committed transactions as well
+            if os.fstat(self.fd).st_size == 0:
+                self.size = 0
+                return
+            for target in self.targets:
+                target.flush()
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            self.size = 0
+
+    def close(self):
+        self.checkpoint()
+        os.close(self.fd)
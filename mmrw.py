@@ -1,73 +1,730 @@
 # mmrw.py
 
-import mmap, os, os.path, time, sys, subprocess
-import chess, chess.polyglot, chess.pgn
+import mmap, os, os.path, time, sys, threading, struct, contextlib, fcntl
+import chess, chess.polyglot, chess.pgn, numpy
 import global_variables as G
 from spaced_repetition import *
 from chess_tools import *
+from bloom_filter import BloomFilter
+from due_index import DueIndex, decode_move
+from child_hashes import ChildHashes
+from repertoire_graph import RepertoireGraph
+from journal import Journal
+from generation_counter import GenerationCounter
+from process_lock import ProcessLock
+from review_log import ReviewLog, book_number
+from comment_search import CommentSearchIndex
+from bulk_import import bulk_import_games
+from game_archive import GameArchive, convert_games_directory
+from position_index import PositionIndex, PositionIndexBuilder, convert_positions_directory
 from bisect import bisect_left
 
-class MemoryMappedReaderWriter(chess.polyglot.MemoryMappedReader):
-    '''Extends python-chess's polyglot memory mapped reader to also modify them and write new entries.'''
-    def __init__(self, filename, length=0, offset=0):
+# Layout of a polyglot entry, for numpy views of books
+ENTRY_DTYPE = numpy.dtype([('key', '>u8'), ('raw_move', '>u2'), ('weight', '>u2'), ('learn', '>u4')])
+# The key and raw move of an entry as a single comparable value
+PAIR_DTYPE = numpy.dtype({'names': ['pair'], 'formats': ['V10'], 'offsets': [0], 'itemsize': 16})
+
+def entry_pairs(array):
+    '''Returns the (key, raw move) pairs of a structured array of entries
+    as an array of 10 byte values, which sort in the same order as the pairs.'''
+    return array.view(PAIR_DTYPE)['pair']
+
+def pairs_to_array(pairs):
+    '''Converts an iterable of (key, raw move) tuples to the format of entry_pairs.'''
+    return numpy.array([key.to_bytes(8, byteorder="big") + raw_move.to_bytes(2, byteorder="big") for key, raw_move in pairs], dtype='V10')
+
+class KeySearch(object):
+    '''Mixin for files of fixed width records sorted by a 64 bit key, which finds
+    the leftmost record with a given key while touching fewer pages than a plain
+    binary search on large, cold files.
+
+    The search_mode attribute selects how: None is a plain binary search, 'fence'
+    first looks the key up in an in-memory copy of every G.FENCE_STRIDE-th key,
+    and 'interpolation' guesses where the key is from its value, as Zobrist hashes
+    are close to uniformly distributed. Subclasses provide key_at and num_keys,
+    and must call keys_changed whenever records are inserted or deleted.'''
+    search_mode = None
+    fences = None
+
+    def keys_changed(self):
+        self.fences = None
+
+    def search_key_left(self, key):
+        lo, hi = 0, self.num_keys()
+        if self.search_mode == 'fence':
+            lo, hi = self.fence_bounds(key, hi)
+        elif self.search_mode == 'interpolation':
+            lo, hi = self.interpolation_bounds(key, lo, hi)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def fence_bounds(self, key, length):
+        fences = self.fences
+        if fences is None:
+            fences = numpy.array([self.key_at(i) for i in range(0, length, G.FENCE_STRIDE)], dtype=numpy.uint64)
+            self.fences = fences
+        # The first fence with a key that is at least the given key
+        f = int(numpy.searchsorted(fences, numpy.uint64(key)))
+        return max(0, (f - 1) * G.FENCE_STRIDE), min(length, f * G.FENCE_STRIDE)
+
+    def interpolation_bounds(self, key, lo, hi):
+        # Keys before lo are less than key, keys from hi onwards are at least key
+        low_key, high_key = -1, 2 ** 64
+        for _ in range(G.INTERPOLATION_STEPS):
+            if hi - lo <= 8:
+                break
+            guess = lo + (key - low_key) * (hi - lo) // (high_key - low_key)
+            guess = min(max(guess, lo), hi - 1)
+            guess_key = self.key_at(guess)
+            if guess_key < key:
+                lo, low_key = guess + 1, guess_key
+            else:
+                hi, high_key = guess, guess_key
+        return lo, hi
+
+class DeltaSegment(chess.polyglot.MemoryMappedReader):
+    '''A small append-only file of polyglot entries that have not yet been
+    merged into the book it sits next to.
+
+    New entries are only ever appended to the file, so writing one never moves
+    other entries. A sorted copy of the entries is kept in memory as self.mmap,
+    so that the reading methods of the superclass (indexing, bisect_key_left,
+    find_all) work on it unchanged. Indices always refer to this sorted order.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.journal = None
+        self.on_change = None
+        self.load()
+
+    def reload(self):
+        '''Reopens and reloads the file, after another process changed it.'''
+        os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.load()
+
+    def changed(self, keys=False, added=None, removed=None):
+        if self.on_change != None:
+            self.on_change(keys, added, removed)
+
+    def load(self):
+        size = os.fstat(self.fd).st_size
+        if size % 16 != 0:
+            # Drop a partially written entry left behind by an interrupted append
+            size -= size % 16
+            os.ftruncate(self.fd, size)
+        data = os.pread(self.fd, size, 0)
+        # Records are sorted by key and raw move, and remember their position in the file
+        records = sorted((data[i:i + 16], i // 16) for i in range(0, size, 16))
+        self.mmap = bytearray(b''.join(map(lambda x : x[0], records)))
+        self.positions = list(map(lambda x : x[1], records))
+
+    def __len__(self):
+        return len(self.mmap) // 16
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self.journal != None and self.journal.pending and 0 <= index < len(self):
+            entry = self.journal.pending.get((self, self.entry_offset(index)))
+            if entry != None:
+                return entry
+        return super().__getitem__(index)
+
+    def __setitem__(self, key, value):
+        if self.journal != None and self.journal.pending != None:
+            self.journal.pending[(self, self.entry_offset(key))] = value
+        else:
+            self.store_at(self.entry_offset(key), value)
+
+    def entry_offset(self, index):
+        '''Position of the entry at the given (sorted) index in the file.'''
+        return 16 * self.positions[index]
+
+    def store_at(self, offset, entry):
+        byteArray = entryToBytes(entry)
+        index = self.positions.index(offset // 16)
+        self.mmap[16 * index : 16 * index + 16] = byteArray
+        os.pwrite(self.fd, byteArray, offset)
+        self.changed()
+
+    def __contains__(self, entry):
+        index = self.bisect_key_left(entry.key)
+        while index < len(self):
+            suggestion = self[index]
+            if suggestion.key != entry.key:
+                break
+            if suggestion.move == entry.move:
+                return True
+            index += 1
+        return False
+
+    def edit_entry(self, index, position, move, new_weight, new_learn):
+        self[index] = makeEntry(position, move, new_weight, new_learn)
+
+    def add_entry(self, entry):
+        byteArray = entryToBytes(entry)
+        position = len(self)
+        os.pwrite(self.fd, byteArray, 16 * position)
+        index = self.bisect_key_left(entry.key)
+        self.mmap[16 * index : 16 * index] = byteArray
+        self.positions.insert(index, position)
+        self.changed(keys=True, added=[entry])
+
+    def delete_indices(self, indices):
+        '''Deletes the entries at the given indices by rewriting the (small) file.'''
+        indices = set(filter(lambda i : 0 <= i < len(self), indices))
+        if len(indices) == 0:
+            return 0
+        if self.journal != None:
+            # Entries are about to move in the file
+            self.journal.checkpoint()
+        removed = [self[i] for i in sorted(indices)]
+        kept = b''.join(self.mmap[16 * i : 16 * i + 16] for i in range(len(self)) if i not in indices)
+        # Write to a temporary file first, so that a crash leaves one version or the other
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as fil:
+            fil.write(kept)
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.replace(temp_filename, self.filename)
+        os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_RDWR)
+        self.mmap = bytearray(kept)
+        self.positions = list(range(len(self)))
+        self.changed(keys=True, removed=removed)
+        return len(indices)
+
+    def delete_where(self, predicate):
+        return self.delete_indices([i for i, e in enumerate(self) if predicate(e)])
+
+    def view(self):
+        '''Returns a read-only numpy copy of the (sorted) entries.'''
+        return numpy.frombuffer(bytes(self.mmap), dtype=ENTRY_DTYPE)
+
+    def clear(self):
+        if self.journal != None:
+            self.journal.checkpoint()
+        removed = list(self)
+        os.ftruncate(self.fd, 0)
+        self.mmap = bytearray()
+        self.positions = []
+        self.changed(keys=True, removed=removed)
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+class MemoryMappedReaderWriter(KeySearch, chess.polyglot.MemoryMappedReader):
+    '''Extends python-chess's polyglot memory mapped reader to also modify them and write new entries.
+
+    If use_delta is True, new entries added with add_position_and_move are
+    written to a DeltaSegment next to the book (in filename + '.delta') instead
+    of being inserted into the book directly, and compact merges them into the
+    book later. Lookups (find_all, locate_all, and membership) see both, while 
+    indexing, len and iteration only see the book itself.
+
+    See KeySearch for the possible values of search_mode.
+
+    If use_bloom is True, a Bloom filter of the keys in the book and its delta 
+    segment is kept, so that lookups of keys not in the book return right away.
+    It is saved next to the book (in filename + '.bloom') when it is built, and
+    when the book is closed or compacted, and is rebuilt on opening if the book
+    changed since.
+
+    If use_due_index is True, a DueIndex of the entries set to learn is kept
+    the same way (in filename + '.due'), for due_index. Learn values should
+    then be changed with edit_learning, which keeps it up to date.
+
+    If use_child_hashes is True, the hashes of the positions that entries lead
+    to are kept in a ChildHashes file (filename + '.children'), so that the
+    book can be traversed without playing moves (see child_hash).
+
+    Several processes can use the same book: self.lock is a ProcessLock, taken
+    shared for lookups and exclusively for changes, and each process catches
+    up with the changes of the others when it takes the lock (see sync).'''
+    # Whether the book can have no entries at all, rather than a null placeholder entry
+    allows_empty = False
+
+    def __init__(self, filename, length=0, offset=0, use_delta=False, search_mode=None, use_bloom=False, use_due_index=False, use_child_hashes=False):
         # Like superclass init, just allowing writing
         self.fd = os.open(filename, os.O_RDWR)
         self.filename = filename
+        self.lock = ProcessLock(self.fd, self.sync)
+        self.delta = DeltaSegment(filename + '.delta') if use_delta else None
+        if self.delta != None:
+            self.delta.on_change = self.changed
+        self.search_mode = search_mode
+        self.bloom = None
+        self.use_due_index = use_due_index
+        # Built when first needed, kept up to date by the changes made through
+        # this object, and dropped when other processes change entries set to learn
+        self.due = None
+        # True while the delta segment is merged into the book (see changed)
+        self.compacting = False
+        self.children = ChildHashes(filename + '.children') if use_child_hashes else None
+        self.journal = None
+        # A GenerationCounter and the first of the three slots of the book in it (see set_generations)
+        self.generations = None
+        self.synced = None
+        # Counts the changes that structures built from the book cannot follow
+        # on their own (see Repertoire.graph)
+        self.version = 0
 
         try:
             self.mmap = mmap.mmap(self.fd, length, offset=offset)
         except:
             self.mmap = None
 
-    def add_entry(self, entry):
-        # Get bytes to write
-        byteArray = entry.key.to_bytes(8, byteorder="big")
-        byteArray += entry.raw_move.to_bytes(2, byteorder="big")
-        byteArray += entry.weight.to_bytes(2, byteorder="big")
-        byteArray += entry.learn.to_bytes(4, byteorder="big")
-
-        # Increase size of mmap by 16 bytes
-        insertionIndex = 16 * self.bisect_key_left(entry.key)
-        oldEndIndex = self.mmap.size()
-        self.mmap.resize(oldEndIndex + 16)
-
-        # Write to mmap (use flush method on self.mmap to make sure this
-        # has gone through to hard drive)
-        # To keep the book ordered, we apply an insertion sort
-        nextEntry = None
-        for i in range(insertionIndex, oldEndIndex + 16, 16):
-            if i == insertionIndex:
-                nextEntry = self.mmap[i:i + 16]
-                self.mmap[i:i + 16] = byteArray
+        if use_bloom and self.mmap != None:
+            self.load_bloom()
+        if use_due_index and self.mmap != None:
+            self.due = DueIndex.load(filename + '.due', self.file_stamp())
+
+    def file_stamp(self):
+        '''Sizes and modification times of the book and its delta segment.'''
+        stat = os.stat(self.filename)
+        delta_stat = os.stat(self.delta.filename) if self.delta != None else None
+        return (stat.st_size, stat.st_mtime_ns, delta_stat.st_size if delta_stat else 0, delta_stat.st_mtime_ns if delta_stat else 0)
+
+    def load_bloom(self):
+        self.bloom = BloomFilter.load(self.filename + '.bloom', self.file_stamp())
+        if self.bloom == None:
+            self.rebuild_bloom()
+            # Saved again when the book is closed, if changed by then
+            self.save_bloom()
+
+    def rebuild_bloom(self):
+        with self.lock.shared():
+            keys = numpy.concatenate([array['key'].astype(numpy.uint64) for _, array in self.views()])
+            self.bloom = BloomFilter.for_keys(keys, G.BLOOM_BITS_PER_KEY, G.BLOOM_HASHES)
+
+    def save_bloom(self):
+        if self.bloom != None:
+            self.bloom.save(self.filename + '.bloom', self.file_stamp())
+
+    def due_index(self):
+        '''Returns the DueIndex of the book and its delta segment, building it if needed.'''
+        with self.lock.shared():
+            if self.due == None:
+                self.due = DueIndex.for_arrays(list(map(lambda view : view[1], self.views())))
+                # Saved again when the book is closed, if changed by then
+                self.save_due_index()
+            return self.due
+
+    def save_due_index(self):
+        if self.due != None:
+            self.due.save(self.filename + '.due', self.file_stamp())
+
+    def edit_learning(self, segment, index, entry, weight, learn):
+        '''Sets the weight and learn values of entry, found at index in segment 
+        (the book or its delta segment), keeping the due index up to date.'''
+        with self.lock:
+            segment[index] = chess.polyglot.Entry(entry.key, entry.raw_move, weight, learn, entry.move)
+            if self.due != None:
+                self.due.update(entry, weight, learn)
+
+    def transform_learning(self, transform, keys=None):
+        '''Applies transform (see spaced_repetition.py) to the learning data of the 
+        entries set to learn, only those with keys in the given numpy array if one is 
+        given, with one pass over the book and one over its delta segment. Returns 
+        the number of entries changed.
+
+        The book is written directly (not through the journal), so the journal
+        is checkpointed first, since replaying it would undo the changes.'''
+        count = 0
+        with self.lock:
+            if self.journal != None:
+                self.journal.checkpoint()
+            for segment, array in self.views():
+                selected = array['learn'] > 0
+                if keys is not None:
+                    selected &= numpy.isin(array['key'].astype(numpy.uint64), keys)
+                indices = numpy.nonzero(selected)[0]
+                old_weights, old_learns = array['weight'][indices], array['learn'][indices]
+                weights, learns = export_value_arrays(*transform(*read_value_arrays(old_weights, old_learns)))
+                edited = (weights != old_weights) | (learns != old_learns)
+                indices, weights, learns = indices[edited], weights[edited], learns[edited]
+                count += len(indices)
+                if segment is self:
+                    # Writes straight through to the book
+                    array['weight'][indices] = weights
+                    array['learn'][indices] = learns
+                else:
+                    for i, weight, learn in zip(indices.tolist(), weights.tolist(), learns.tolist()):
+                        entry = segment[i]
+                        segment[i] = chess.polyglot.Entry(entry.key, entry.raw_move, weight, learn, entry.move)
+            array = None
+            if count > 0:
+                self.flush()
+                self.learning_changed()
+        return count
+
+    def learning_changed(self):
+        '''Call after changing learn values other than with edit_learning.'''
+        self.due = None
+        self.version += 1
+        self.changed()
+
+    def child_hash(self, entry):
+        '''Returns the hash of the position entry leads to, or None if it is not known.'''
+        return self.children.get(entry.key, entry.raw_move) if self.children != None else None
+
+    def add_child_hashes(self, records):
+        '''Stores (key, raw move, child hash) records for child_hash.'''
+        if self.children != None:
+            with self.lock:
+                self.children.add_many(records)
+
+    def might_contain_key(self, key):
+        '''Returns False if no entry in the book has the given key, and True if one might.'''
+        return self.bloom == None or self.bloom.might_contain(key)
+
+    def set_generations(self, generations, slot):
+        '''Uses slots slot, slot + 1 and slot + 2 of a GenerationCounter to tell other
+        processes about changes to the entries, to their values, and to the entries
+        set to learn (see changed) respectively.'''
+        self.generations = (generations, slot)
+        self.synced = [generations.value(slot), generations.value(slot + 1), generations.value(slot + 2)]
+
+    def changed(self, keys=False, added=None, removed=None):
+        '''Lets other processes know about a change to the book or its delta segment.
+        keys is True if entries were added, moved or removed, rather than just edited.
+
+        For such changes, added and removed, if given, are the entries added
+        and removed, so that the due index is updated rather than dropped, and
+        other processes keep theirs if none of them is set to learn.'''
+        learning = True
+        if keys:
+            self.version += 1
+            if added == None and removed == None:
+                self.due = None
             else:
-                nextTempEntry = self.mmap[i:i + 16]
-                self.mmap[i:i + 16] = nextEntry
-                nextEntry = nextTempEntry
+                added, removed = added or [], removed or []
+                learning = any(map(lambda e : e.learn > 0, added + removed)) and not self.compacting
+                if self.due != None:
+                    for entry in added:
+                        self.due.add(entry)
+                    for entry in removed:
+                        self.due.remove(entry)
+        if self.generations == None:
+            return
+        generations, slot = self.generations
+        for n in [0 if keys else 1] + ([2] if learning else []):
+            if generations.bump(slot + n) == self.synced[n]:
+                self.synced[n] += 1
+
+    def sync(self):
+        '''Catches up with changes made to the book by other processes, remapping the
+        book if its file changed size and reloading or rebuilding in-memory copies and 
+        indexes. Called whenever this process takes the lock of the book.'''
+        if self.mmap == None:
+            return
+        keys_changed = values_changed = learning_changed = True
+        if self.generations != None:
+            generations, slot = self.generations
+            current = [generations.value(slot), generations.value(slot + 1), generations.value(slot + 2)]
+            keys_changed, values_changed = current[0] != self.synced[0], current[1] != self.synced[1]
+            learning_changed = current[2] != self.synced[2]
+            self.synced = current
+        if keys_changed and os.fstat(self.fd).st_size != len(self.mmap):
+            old_mmap = self.mmap
+            self.mmap = mmap.mmap(self.fd, 0)
+            old_mmap.close()
+        if self.generations == None:
+            # Without generation numbers, only the file size tells of changes
+            return
+        if keys_changed or values_changed:
+            self.version += 1
+        if learning_changed:
+            self.due = None
+        if keys_changed:
+            if self.delta != None:
+                self.delta.reload()
+            if self.children != None:
+                self.children.load()
+            self.keys_changed()
+            if self.bloom != None:
+                self.rebuild_bloom()
+        elif values_changed and self.delta != None:
+            self.delta.reload()
+
+    def refresh(self):
+        '''Catches up with changes made to the book by other processes (see sync).'''
+        with self.lock.shared():
+            # Taking the lock is enough
+            pass
+
+    def segments(self):
+        '''Returns the book followed by its delta segment, if it has one.'''
+        if self.delta == None:
+            return [self]
+        return [self, self.delta]
+
+    def locate_all(self, key):
+        '''Returns a (segment, index, entry) triple for every entry with the given key, 
+        where segment is either the book or its delta segment. Entries can then be 
+        edited or deleted with the segment's own methods.'''
+        if type(key) != int:
+            key = zobrist_hash(key)
+        result = []
+        with self.lock.shared():
+            if not self.might_contain_key(key):
+                return result
+            for segment in self.segments():
+                index = segment.bisect_key_left(key)
+                while index < len(segment):
+                    entry = segment[index]
+                    if entry.key != key:
+                        break
+                    result.append((segment, index, entry))
+                    index += 1
+        return result
+
+    def locate_everything(self):
+        '''Generates a (segment, index, entry) triple for every entry in the book
+        and its delta segment (see locate_all).'''
+        for segment in self.segments():
+            for index, entry in enumerate(segment):
+                yield segment, index, entry
+
+    def view(self):
+        '''Returns a zero-copy numpy structured array (see ENTRY_DTYPE) over the 
+        entries of the book, not including its delta segment. Writing to the array 
+        writes to the book.
+
+        The book cannot be resized while the array, or any view of it, is alive,
+        so hold self.lock (shared, for reading only) while using it and drop it
+        before releasing the lock.'''
+        return numpy.frombuffer(self.mmap, dtype=ENTRY_DTYPE, count=len(self), offset=self._offset(0))
+
+    def views(self):
+        '''Returns a (segment, array) pair for the book and its delta segment (see view).'''
+        return list(map(lambda segment : (segment, segment.view()), self.segments()))
+
+    def find_all(self, board, *args, **kwargs):
+        with self.lock.shared():
+            if not self.might_contain_key(board if type(board) == int else zobrist_hash(board)):
+                return iter([])
+            entries = list(super().find_all(board, *args, **kwargs))
+            if self.delta != None and len(self.delta) > 0:
+                entries += list(self.delta.find_all(board, *args, **kwargs))
+        return iter(entries)
+
+    def compact(self):
+        '''Merges the delta segment into the book and empties it.
+        Returns the number of entries merged.'''
+        if self.delta == None:
+            return 0
+        with self.lock:
+            if len(self.delta) == 0:
+                return 0
+            new_entries = {}
+            for entry in self.delta:
+                if not self.base_contains(entry):
+                    new_entries.setdefault((entry.key, entry.raw_move), entry)
+            new_entries = sorted(new_entries.values(), key=lambda e : (e.key, e.raw_move))
+            # Entries only move from the delta segment to the book, which other
+            # processes' due indexes need not hear about
+            self.compacting = True
+            try:
+                if len(new_entries) > 0:
+                    self._merge_entries(new_entries)
+                # The delta is only emptied once the merge is on disk, so that
+                # an interrupted compaction is simply redone later
+                self.mmap.flush()
+                self.delta.clear()
+            finally:
+                self.compacting = False
+            if self.bloom != None:
+                self.rebuild_bloom()
+                self.save_bloom()
+            if self.use_due_index:
+                self.due_index()
+                self.save_due_index()
+            if self.children != None and self.children.num_records() > 2 * len(self) + G.BOOK_MIN_CAPACITY:
+                # Drop the records of deleted entries
+                array = self.view()
+                pairs = list(zip(array['key'].tolist(), array['raw_move'].tolist()))
+                array = None
+                self.children.rewrite(pairs)
+            return len(new_entries)
+
+    def flush(self):
+        self.mmap.flush()
+        if self.delta != None:
+            self.delta.flush()
+
+    def close(self):
+        self.mmap.flush()
+        self.save_bloom()
+        self.save_due_index()
+        self.mmap.close()
+        if self.delta != None:
+            self.delta.close()
+        if self.children != None:
+            self.children.close()
+
+    def add_entry(self, entry):
+        with self.lock:
+            self._merge_entries([entry])
+
+    def key_at(self, index):
+        return int.from_bytes(self.mmap[self._offset(index):self._offset(index) + 8], byteorder="big")
+
+    def num_keys(self):
+        return len(self)
+
+    def bisect_key_left(self, key):
+        return self.search_key_left(key)
+
+    def add_entries(self, entries):
+        '''Adds many entries at once, skipping position/move pairs already in the book.
+        Returns the number of entries added.
+
+        The new entries are sorted and merged into the book in a single pass,
+        with a single resize, so each existing entry is moved at most once.'''
+        with self.lock:
+            new_entries = {}
+            for entry in entries:
+                if entry not in self:
+                    new_entries.setdefault((entry.key, entry.raw_move), entry)
+            new_entries = sorted(new_entries.values(), key=lambda e : (e.key, e.raw_move))
+            if len(new_entries) > 0:
+                self._merge_entries(new_entries)
+            return len(new_entries)
+
+    def _merge_entries(self, new_entries):
+        '''Merges a sorted list of entries (not already in the book) into the book.'''
+        if self.journal != None:
+            # Pending edits need to be in the book before entries move
+            self.journal.commit_pending()
+        indices = [self.bisect_key_left(e.key) for e in new_entries]
+        old_length = len(self)
+
+        # Everything from the first insertion index onwards is rebuilt
+        # in memory, and then written over the end of the book at once
+        start = previous = indices[0]
+        pieces = []
+        for index, entry in zip(indices, new_entries):
+            pieces.append(self.mmap[self._offset(previous):self._offset(index)])
+            pieces.append(entryToBytes(entry))
+            previous = index
+            if self.bloom != None:
+                self.bloom.add(entry.key)
+        pieces.append(self.mmap[self._offset(previous):self._offset(old_length)])
+        self._rewrite_tail(start, old_length + len(new_entries), b''.join(pieces), added=new_entries)
+
+    def _rewrite_tail(self, start, num_entries, data, added=None, removed=None):
+        '''Replaces the entries from index start onwards with data, 
+        leaving num_entries entries in the book. added and removed are the
+        entries this adds and removes (see changed).'''
+        self._set_length(num_entries)
+        self.mmap[self._offset(start):self._offset(start) + len(data)] = data
+        self.keys_changed()
+        self.changed(keys=True, added=added, removed=removed)
+
+    def _offset(self, index):
+        '''Byte offset of the entry at the given index.'''
+        return 16 * index
+
+    def _set_length(self, num_entries):
+        '''Resizes the book so that it holds num_entries entries.'''
+        self.mmap.resize(16 * num_entries)
+
+    def delete_indices(self, indices):
+        '''Deletes the entries at the given indices. Returns the number of entries deleted.
+
+        The kept entries after the first deleted one are gathered
+        in one pass and written back at once.'''
+        with self.lock:
+            if self.journal != None:
+                # Pending edits need to be in the book before entries move
+                self.journal.commit_pending()
+            length = len(self)
+            indices = sorted(set(filter(lambda i : 0 <= i < length, indices)))
+            if len(indices) == 0:
+                return 0
+            # The kept runs between deleted entries are joined into the new end of the book
+            pieces = []
+            for n, index in enumerate(indices):
+                run_end = indices[n + 1] if n + 1 < len(indices) else length
+                pieces.append(self.mmap[self._offset(index + 1):self._offset(run_end)])
+            data = b''.join(pieces)
+            removed = [self[i] for i in indices]
+            num_entries = length - len(indices)
+            if num_entries == 0 and not self.allows_empty:
+                # An mmap cannot be resized to zero, so an emptied book keeps
+                # the null placeholder entry that empty books start with
+                data = 16 * b'\0'
+                num_entries = 1
+            self._rewrite_tail(indices[0], num_entries, data, removed=removed)
+            return len(indices)
+
+    def delete_where(self, predicate):
+        '''Deletes every entry (including those in the delta segment)
+        for which predicate(entry) is true. Returns the number of entries deleted.'''
+        with self.lock:
+            count = self.delete_indices([i for i, e in enumerate(self) if predicate(e)])
+            if self.delta != None:
+                count += self.delta.delete_where(predicate)
+            return count
 
     def remove_entry(self, entry):
-        for i, e in enumerate(self):
-            if e == entry:
-                del self[i]
-                break
+        with self.lock:
+            for segment, index, e in self.locate_all(entry.key):
+                if e == entry:
+                    segment.delete_indices([index])
+                    break
 
     def edit_entry(self, index, position, move, new_weight, new_learn):
         # Make entry and corresponding byte array
         entry = makeEntry(position, move, new_weight, new_learn)
         self[index] = entry
 
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self.journal != None and self.journal.pending and 0 <= index < len(self):
+            entry = self.journal.pending.get((self, self.entry_offset(index)))
+            if entry != None:
+                return entry
+        return self._read_entry(index)
+
+    def _read_entry(self, index):
+        return super().__getitem__(index)
+
     def __setitem__(self, key, value):
-        byteArray = value.key.to_bytes(8, byteorder="big")
-        byteArray += value.raw_move.to_bytes(2, byteorder="big")
-        byteArray += value.weight.to_bytes(2, byteorder="big")
-        byteArray += value.learn.to_bytes(4, byteorder="big")
-        self.mmap[16 * key : 16 * key + 16] = byteArray
+        if self.journal != None and self.journal.pending != None:
+            self.journal.pending[(self, self.entry_offset(key))] = value
+        else:
+            self.store_at(self.entry_offset(key), value)
+
+    def entry_offset(self, index):
+        return self._offset(index)
+
+    def store_at(self, offset, entry):
+        self.mmap[offset:offset + 16] = entryToBytes(entry)
+        self.changed()
 
     def __delitem__(self, key):
-        for i in range(key, len(self) - 1):
-            self[i] = self[i + 1]
-        self.mmap.resize(len(self.mmap) - 16)
+        self.delete_indices([key])
 
     def __contains__(self, entry):
+        with self.lock.shared():
+            if not self.might_contain_key(entry.key):
+                return False
+            return self.base_contains(entry) or (self.delta != None and entry in self.delta)
+
+    def base_contains(self, entry):
+        '''Checks if the book itself (not its delta segment) contains the entry.'''
         index = self.bisect_key_left(entry.key)
         if index >= len(self):
             return False
@@ -83,66 +740,419 @@ class MemoryMappedReaderWriter(chess.polyglot.MemoryMappedReader):
 
     def add_position_and_move(self, p, m, weight=1, learn=0):
         entry = makeEntry(p, m, weight, learn)
-        # We do nothing if entry with same position/move combo is already in mmap
-        if entry not in self:
-            self.add_entry(entry)
-
-class CommentsMMRW(mmap.mmap):
-    def __init__(self, fd, length):
-        self.key_size = 8
-        self.comment_size = 248
-        self.entry_size = self.key_size + self.comment_size
-
-    def hash_at_position_index(self, i):
-        byte_list = self[i * self.entry_size:i * self.entry_size + self.key_size]
-        return int.from_bytes(byte_list, byteorder="big")
-
-    def comment_at_position_index(self, i):
-        start = i * self.entry_size + self.key_size
-        end = (i + 1) * self.entry_size
-        return self[start:end].decode('utf-8').rstrip('\0')
-
-    def create_entry(self, i):
-        '''Creates an empty entry at index i, which should immediately after
-        be given an appropriate hash to keep the ordering.'''
-        if i > self.size() // self.entry_size or i < 0:
-            raise ValueError("Invalid index given")
-        start = i * self.entry_size
-        end = self.size()
-        self.resize(self.size() + self.entry_size)
-        self[start + self.entry_size : end + self.entry_size] = self[start:end]
-        self[start : start + self.entry_size] = self.entry_size * b'\0'
-
-    def replace_entry(self, i, h, s):
-        '''Replaces the entry at index i with hash h and string s.'''
-        # Get bytes to add
-        byteArray = h.to_bytes(8, byteorder="big")
-        byteArray += s.encode('utf-8')
-        padding_length = self.entry_size - len(byteArray)
-        if padding_length < 0:
-            raise ValueError("Size of opening comment is too large")
-        byteArray += padding_length * b'\0'
-
-        # Get indices
-        start = i * self.entry_size
-        end = (i + 1) * self.entry_size
-        self[start:end] = byteArray
-        
-    def find_position(self, p):
-        if type(p) != int:
-            p = chess.polyglot.zobrist_hash(p)
-        left = 0
-        right = self.size() // self.entry_size
-        while left < right:
-            middle = (left + right) // 2
-            hash_to_test = self.hash_at_position_index(middle)
-            if hash_to_test < p:
-                left = middle + 1
-            elif hash_to_test > p:
-                right = middle
-            else:
-                return middle
-        return left
+        if self.children != None:
+            self.add_child_hashes([(entry.key, entry.raw_move, childHash(p, m))])
+        with self.lock:
+            # We do nothing if entry with same position/move combo is already in mmap
+            if entry not in self:
+                if self.delta != None:
+                    self.delta.add_entry(entry)
+                    if self.bloom != None:
+                        self.bloom.add(entry.key)
+                else:
+                    self.add_entry(entry)
+    def export(self, filename):
+        '''Writes the book, including its delta segment, to a plain polyglot book.'''
+        with self.lock.shared():
+            array = numpy.concatenate([array for _, array in self.views()])
+        write_plain_book(filename, array)
+
+BOOK_MAGIC = b'CNABOOK1'
+# The header of a CapacityBook takes the place of its first entry
+BOOK_HEADER_STRUCT = struct.Struct('>8sQ')
+
+class CapacityBook(MemoryMappedReaderWriter):
+    '''A book file with preallocated space for entries.
+
+    The file starts with a header (BOOK_HEADER_STRUCT) holding BOOK_MAGIC and the
+    number of entries in the book, followed by the sorted entries and then unused
+    capacity. When an insert needs more room than that, the file grows
+    geometrically (by G.BOOK_GROWTH_FACTOR), and deletes only lower the number
+    of entries, so most inserts and deletes don't resize the file at all.
+
+    Plain polyglot books are converted when opened (see migrate_book), and
+    export writes the book back to a plain polyglot book.'''
+    allows_empty = True
+
+    def __init__(self, filename, *args, **kwargs):
+        migrate_book(filename)
+        super().__init__(filename, *args, **kwargs)
+
+    def __len__(self):
+        return BOOK_HEADER_STRUCT.unpack_from(self.mmap, 0)[1]
+
+    def _read_entry(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError()
+        # The superclass reads the entry at byte 16 * index, so this skips the header
+        return super()._read_entry(index + 1)
+
+    def capacity(self):
+        return len(self.mmap) // 16 - 1
+
+    def _offset(self, index):
+        return 16 * (index + 1)
+
+    def _set_length(self, num_entries):
+        capacity = self.capacity()
+        if num_entries > capacity:
+            capacity = max(num_entries, int(capacity * G.BOOK_GROWTH_FACTOR), G.BOOK_MIN_CAPACITY)
+            self.mmap.resize(self._offset(capacity))
+        BOOK_HEADER_STRUCT.pack_into(self.mmap, 0, BOOK_MAGIC, num_entries)
+
+    def _rewrite_tail(self, start, num_entries, data, added=None, removed=None):
+        if self.journal == None:
+            return super()._rewrite_tail(start, num_entries, data, added, removed)
+        # The new end of the book and its length go through the journal, so that
+        # an interrupted rewrite is redone instead of leaving the book unsorted
+        header = BOOK_HEADER_STRUCT.pack(BOOK_MAGIC, num_entries)
+        apply = lambda : MemoryMappedReaderWriter._rewrite_tail(self, start, num_entries, data, added, removed)
+        self.journal.commit([(self, self._offset(start), data), (self, 0, header)], apply)
+        self.journal.checkpoint()
+
+def is_capacity_book(filename):
+    with open(filename, 'rb') as fil:
+        return fil.read(len(BOOK_MAGIC)) == BOOK_MAGIC
+
+def migrate_book(filename):
+    '''Converts a plain polyglot book into a CapacityBook in place, unless it is 
+    one already. Returns True if the book was converted.
+
+    Other processes may be opening the same book, so the conversion is done
+    holding an exclusive flock on the book, and the check is repeated under it.'''
+    if is_capacity_book(filename):
+        return False
+    with open(filename, 'rb') as locked:
+        fcntl.flock(locked.fileno(), fcntl.LOCK_EX)
+        # Converted by another process while waiting for the lock
+        # (this reads the new file, not the locked one)
+        if is_capacity_book(filename):
+            return False
+        array = numpy.fromfile(filename, dtype=ENTRY_DTYPE)
+        # Drops the null placeholder entry of empty books
+        array = array[(array['key'] != 0) | (array['raw_move'] != 0)]
+        temp_filename = '%s.tmp%d' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as fil:
+            fil.write(BOOK_HEADER_STRUCT.pack(BOOK_MAGIC, len(array)))
+            fil.write(array.tobytes())
+            fil.truncate(16 * (max(len(array), G.BOOK_MIN_CAPACITY) + 1))
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.replace(temp_filename, filename)
+    return True
+
+def write_plain_book(filename, array):
+    '''Writes an array of entries (see ENTRY_DTYPE), in any order, to a plain polyglot book.'''
+    # Concatenated arrays are in native byte order, while books are big endian
+    array = array[numpy.lexsort((array['raw_move'], array['key']))].astype(ENTRY_DTYPE)
+    if len(array) == 0:
+        # Empty books have a null placeholder entry, since they can't be mapped otherwise
+        array = numpy.zeros(1, dtype=ENTRY_DTYPE)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as fil:
+        fil.write(array.tobytes())
+    os.replace(temp_filename, filename)
+
+class CommentStore(KeySearch):
+    '''The comments of positions, keyed by position hash.
+
+    The comments are kept in a heap file (filename) of (hash, length, UTF-8
+    string) records, where setting a comment appends a record, and later 
+    records win. The index file (filename + '.index') has a fixed width (hash, 
+    offset, length) record per comment: first a part sorted by hash, which is 
+    memory-mapped and searched with KeySearch, then the records appended since 
+    it was last sorted, which are also kept in a dictionary (self.recent). The 
+    index is sorted again once the appended part is big enough compared to the
+    sorted part, and the heap is compacted once most of it is replaced comments.
+
+    The heap is all that is needed, so the index is rebuilt from it whenever it 
+    is missing or does not cover all of it (for example, after a crash). Other 
+    processes' changes are picked up when taking self.lock (see sync).
+
+    self.version is incremented on every change, including those of other 
+    processes, so that indexes of the comments can tell they are out of date.'''
+    HEAP_MAGIC = b'CNACMNTS'
+    INDEX_MAGIC = b'CNACMIDX'
+    # Magic, number of sorted records, and the inode of the heap they index
+    INDEX_HEADER_STRUCT = struct.Struct('>8sQQ')
+    INDEX_DTYPE = numpy.dtype([('key', '>u8'), ('offset', '>u8'), ('length', '>u4')])
+    RECORD_STRUCT = struct.Struct('>QI')
+
+    def __init__(self, filename, search_mode=None):
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self.search_mode = search_mode
+        self.heap_fd = None
+        self.index_fd = None
+        self.index_mmap = None
+        self.version = 0
+        # The heap and index files are replaced when rewritten, so they can't be locked
+        self.lock_fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.lock = ProcessLock(self.lock_fd)
+        with self.lock:
+            if os.path.exists(filename):
+                with open(filename, 'rb') as fil:
+                    magic = fil.read(len(self.HEAP_MAGIC))
+                if magic != self.HEAP_MAGIC:
+                    convert_comments_file(filename)
+            self.open_heap()
+            self.load_index()
+        self.lock.on_acquire = self.sync
+
+    def key_at(self, i):
+        return int(self.sorted['key'][i])
+
+    def num_keys(self):
+        return len(self.sorted)
+
+    def open_heap(self):
+        if self.heap_fd != None:
+            os.close(self.heap_fd)
+        self.heap_fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        if os.fstat(self.heap_fd).st_size == 0:
+            os.write(self.heap_fd, self.HEAP_MAGIC)
+        self.heap_inode = os.fstat(self.heap_fd).st_ino
+
+    def load_index(self):
+        '''Maps the sorted part of the index and reads the rest, rebuilding the index if needed.'''
+        if self.index_fd != None:
+            self.sorted = None
+            self.index_mmap.close()
+            os.close(self.index_fd)
+            self.index_fd = None
+        try:
+            fd = os.open(self.index_filename, os.O_RDWR | os.O_APPEND)
+        except FileNotFoundError:
+            return self.rebuild_index()
+        header = os.pread(fd, self.INDEX_HEADER_STRUCT.size, 0)
+        try:
+            magic, sorted_count, heap_inode = self.INDEX_HEADER_STRUCT.unpack(header)
+        except struct.error:
+            magic = None
+        if magic != self.INDEX_MAGIC or heap_inode != self.heap_inode:
+            os.close(fd)
+            return self.rebuild_index()
+        self.index_fd = fd
+        self.index_inode = os.fstat(fd).st_ino
+        sorted_end = self.INDEX_HEADER_STRUCT.size + sorted_count * self.INDEX_DTYPE.itemsize
+        self.index_mmap = mmap.mmap(fd, sorted_end, access=mmap.ACCESS_READ)
+        self.sorted = numpy.frombuffer(self.index_mmap, dtype=self.INDEX_DTYPE, count=sorted_count, offset=self.INDEX_HEADER_STRUCT.size)
+        self.keys_changed()
+        self.version += 1
+        self.recent = {}
+        self.loaded_size = sorted_end
+        self.live_size = len(self.HEAP_MAGIC) + int(numpy.sum(self.sorted['length'], dtype=numpy.int64)) + sorted_count * self.RECORD_STRUCT.size
+        # The size of the part of the heap covered by the index
+        self.indexed_size = len(self.HEAP_MAGIC)
+        if sorted_count > 0:
+            self.indexed_size = int(numpy.max(self.sorted['offset'] + self.sorted['length'])) + self.RECORD_STRUCT.size
+        self.load_recent()
+
+    def load_recent(self):
+        '''Reads the index records appended since the last load, and indexes the 
+        heap records past the end of the index, if any.'''
+        size = os.fstat(self.index_fd).st_size
+        size -= (size - self.loaded_size) % self.INDEX_DTYPE.itemsize
+        if size > self.loaded_size:
+            records = numpy.frombuffer(os.pread(self.index_fd, size - self.loaded_size, self.loaded_size), dtype=self.INDEX_DTYPE)
+            for key, offset, length in zip(records['key'].tolist(), records['offset'].tolist(), records['length'].tolist()):
+                self.note_location(key, offset, length)
+            self.loaded_size = size
+        # Heap records written by a process that crashed before indexing them
+        offset = self.indexed_size
+        heap_size = os.fstat(self.heap_fd).st_size
+        if offset < heap_size:
+            self.append_index(self.scan_heap(offset, heap_size))
+
+    def scan_heap(self, start, end):
+        '''Returns the (key, offset, length) records of the heap between the given 
+        offsets, and drops a partially written record at the end, if any.'''
+        data = os.pread(self.heap_fd, end - start, start)
+        records = []
+        position = 0
+        while position + self.RECORD_STRUCT.size <= len(data):
+            key, length = self.RECORD_STRUCT.unpack_from(data, position)
+            if position + self.RECORD_STRUCT.size + length > len(data):
+                break
+            records.append((key, start + position, length))
+            position += self.RECORD_STRUCT.size + length
+        if position < len(data):
+            os.ftruncate(self.heap_fd, start + position)
+        return records
+
+    def rebuild_index(self):
+        latest = {}
+        for key, offset, length in self.scan_heap(len(self.HEAP_MAGIC), os.fstat(self.heap_fd).st_size):
+            latest[key] = (offset, length)
+        self.write_index(latest)
+
+    def write_index(self, locations):
+        '''Writes a sorted index of the given key to (offset, length) dictionary and loads it.'''
+        keys = sorted(locations)
+        array = numpy.array([(key,) + locations[key] for key in keys], dtype=self.INDEX_DTYPE)
+        temp_filename = self.index_filename + '.tmp'
+        with open(temp_filename, 'wb') as fil:
+            fil.write(self.INDEX_HEADER_STRUCT.pack(self.INDEX_MAGIC, len(array), self.heap_inode))
+            fil.write(array.tobytes())
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.replace(temp_filename, self.index_filename)
+        self.load_index()
+
+    def sync(self):
+        '''Catches up with the comments set by other processes.'''
+        try:
+            if os.stat(self.filename).st_ino != self.heap_inode:
+                # Compacted by another process
+                self.open_heap()
+                return self.load_index()
+            if os.stat(self.index_filename).st_ino != self.index_inode:
+                return self.load_index()
+        except FileNotFoundError:
+            return self.load_index()
+        self.load_recent()
+
+    def location(self, key):
+        '''Returns the (offset, length) of the comment with the given key in the heap, or None.'''
+        if key in self.recent:
+            return self.recent[key]
+        index = self.search_key_left(key)
+        if index < len(self.sorted) and self.key_at(index) == key:
+            return int(self.sorted['offset'][index]), int(self.sorted['length'][index])
+        return None
+
+    def note_location(self, key, offset, length):
+        old = self.location(key)
+        if old != None:
+            self.live_size -= self.RECORD_STRUCT.size + old[1]
+        self.live_size += self.RECORD_STRUCT.size + length
+        self.indexed_size = max(self.indexed_size, offset + self.RECORD_STRUCT.size + length)
+        self.recent[key] = (offset, length)
+        self.version += 1
+
+    def __contains__(self, key):
+        with self.lock.shared():
+            return self.location(key) != None
+
+    def __len__(self):
+        with self.lock.shared():
+            return len(self.items())
+
+    def get(self, key):
+        '''Returns the comment of the position with the given hash, or None if there is none.'''
+        with self.lock.shared():
+            location = self.location(key)
+            if location == None:
+                return None
+            offset, length = location
+            return os.pread(self.heap_fd, length, offset + self.RECORD_STRUCT.size).decode('utf-8')
+
+    def set(self, key, comment):
+        data = comment.encode('utf-8')
+        with self.lock:
+            offset = os.fstat(self.heap_fd).st_size
+            os.write(self.heap_fd, self.RECORD_STRUCT.pack(key, len(data)) + data)
+            self.append_index([(key, offset, len(data))])
+            if os.fstat(self.heap_fd).st_size > max(G.COMMENT_HEAP_MIN_SIZE, 2 * self.live_size):
+                self.compact()
+            elif len(self.recent) > max(G.COMMENT_INDEX_MERGE_MIN, len(self.sorted) // G.COMMENT_INDEX_MERGE_FRACTION):
+                self.merge()
+
+    def append_index(self, records):
+        os.write(self.index_fd, numpy.array(records, dtype=self.INDEX_DTYPE).tobytes())
+        self.loaded_size += len(records) * self.INDEX_DTYPE.itemsize
+        for key, offset, length in records:
+            self.note_location(key, offset, length)
+
+    def items(self):
+        '''Returns a dictionary from the key of every comment to its (offset, length) in the heap.'''
+        locations = dict(zip(self.sorted['key'].tolist(), zip(self.sorted['offset'].tolist(), self.sorted['length'].tolist())))
+        locations.update(self.recent)
+        return locations
+
+    def comments(self):
+        '''Returns a (position hash, comment) pair for every comment, read in heap order.'''
+        with self.lock.shared():
+            locations = sorted(self.items().items(), key=lambda item : item[1][0])
+            return list(map(lambda item : (item[0], os.pread(self.heap_fd, item[1][1], item[1][0] + self.RECORD_STRUCT.size).decode('utf-8')), locations))
+
+    def merge(self):
+        '''Sorts the whole index.'''
+        with self.lock:
+            self.write_index(self.items())
+
+    def compact(self):
+        '''Rewrites the heap without replaced comments, and the index along with it.'''
+        with self.lock:
+            locations = self.items()
+            temp_filename = self.filename + '.tmp'
+            new_locations = {}
+            with open(temp_filename, 'wb') as fil:
+                fil.write(self.HEAP_MAGIC)
+                offset = len(self.HEAP_MAGIC)
+                for key in sorted(locations):
+                    old_offset, length = locations[key]
+                    record = os.pread(self.heap_fd, self.RECORD_STRUCT.size + length, old_offset)
+                    fil.write(record)
+                    new_locations[key] = (offset, length)
+                    offset += len(record)
+                fil.flush()
+                os.fsync(fil.fileno())
+            # If interrupted before the index is replaced, the index is rebuilt from the heap
+            os.replace(temp_filename, self.filename)
+            self.open_heap()
+            self.write_index(new_locations)
+
+    def close(self):
+        self.sorted = None
+        if self.index_fd != None:
+            self.index_mmap.close()
+            os.close(self.index_fd)
+        os.close(self.heap_fd)
+        os.close(self.lock_fd)
+
+def convert_comments_file(filename):
+    '''Converts a comments file of fixed 256 byte (hash, comment) slots, as used
+    before CommentStore, into a CommentStore heap.'''
+    with open(filename, 'rb') as fil:
+        data = fil.read()
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as fil:
+        fil.write(CommentStore.HEAP_MAGIC)
+        for start in range(0, len(data) - len(data) % 256, 256):
+            key = int.from_bytes(data[start:start + 8], byteorder='big')
+            # Key 0 is the placeholder slot of empty files
+            if key != 0:
+                comment = data[start + 8:start + 256].rstrip(b'\0')
+                fil.write(CommentStore.RECORD_STRUCT.pack(key, len(comment)) + comment)
+        fil.flush()
+        os.fsync(fil.fileno())
+    os.replace(temp_filename, filename)
+    if os.path.exists(filename + '.index'):
+        os.remove(filename + '.index')
+
+
+class BookProbe(object):
+    '''The result of looking up a position, and optionally one of its moves, 
+    in a book (see Repertoire.probe).
+
+    entries: (segment, index, entry) triples of the position (see locate_all)
+    moves: the book moves of the position, in the same order as entries
+    locations: the triples of entries whose move is the probed move
+    learn: the learn value of the probed move (0 if not set to learn or not in book)'''
+    def __init__(self):
+        self.entries = []
+        self.moves = []
+        self.locations = []
+        self.learn = 0
+
+    @property
+    def in_book(self):
+        return len(self.entries) > 0
+
+    @property
+    def move_in_book(self):
+        return len(self.locations) > 0
 
 
 class Repertoire(object):
@@ -154,36 +1164,82 @@ class Repertoire(object):
     directory contains moves in a repertoire for white, while the black 
     repertoire contains moves in a repertoire for black. In each directory, 
     the 'white' file contains positions where it is white's move, and the 'black'
-    file contains positions where it is black's move.'''
+    file contains positions where it is black's move.
+    
+    New moves are first written to a delta segment next to each file 
+    (see DeltaSegment), and a background thread regularly merges them 
+    into the files themselves.
+
+    The files are CapacityBooks, and plain polyglot files are converted
+    the first time they are loaded (see export_books for the reverse).
+
+    Edits made inside "with repertoire.transaction():" are committed together
+    through a redo journal (see Journal), which also protects merges and
+    deletes from crashes.
+
+    The positions and moves of each player's repertoire are also kept as a
+    RepertoireGraph (see graph), which the edits made through the methods
+    below keep up to date.'''
 
     def __init__(self, directory):
         # TODO: Create directories/files when they do not exist
         self.directory = directory
-        self.ww = MemoryMappedReaderWriter(os.sep.join([directory, 'white', 'white']))
-        self.wb = MemoryMappedReaderWriter(os.sep.join([directory, 'white', 'black']))
-        self.bw = MemoryMappedReaderWriter(os.sep.join([directory, 'black', 'white']))
-        self.bb = MemoryMappedReaderWriter(os.sep.join([directory, 'black', 'black']))
-        self.t  = MemoryMappedReaderWriter(os.sep.join([directory, 'tactics']))
+        book_filenames = [os.sep.join([directory, 'white', 'white']), os.sep.join([directory, 'white', 'black']),
+                          os.sep.join([directory, 'black', 'white']), os.sep.join([directory, 'black', 'black']),
+                          os.sep.join([directory, 'tactics'])]
+        # Lets other processes using the repertoire know when a book changes (see refresh)
+        self.generations = GenerationCounter(os.sep.join([directory, 'generations']), 3 * len(book_filenames))
+        # Finish writes interrupted by a crash before the books are read, unless
+        # other processes are using the repertoire (and so the journal)
+        journal_filename = os.sep.join([directory, 'journal'])
+        self.generations.register(lambda : Journal.recover(journal_filename, book_filenames + list(map(lambda f : f + '.delta', book_filenames))))
+        self.ww = CapacityBook(os.sep.join([directory, 'white', 'white']), use_delta=True, search_mode=G.BOOK_SEARCH_MODE, use_bloom=True, use_due_index=True, use_child_hashes=True)
+        self.wb = CapacityBook(os.sep.join([directory, 'white', 'black']), use_delta=True, search_mode=G.BOOK_SEARCH_MODE, use_bloom=True, use_due_index=True, use_child_hashes=True)
+        self.bw = CapacityBook(os.sep.join([directory, 'black', 'white']), use_delta=True, search_mode=G.BOOK_SEARCH_MODE, use_bloom=True, use_due_index=True, use_child_hashes=True)
+        self.bb = CapacityBook(os.sep.join([directory, 'black', 'black']), use_delta=True, search_mode=G.BOOK_SEARCH_MODE, use_bloom=True, use_due_index=True, use_child_hashes=True)
+        self.t  = CapacityBook(os.sep.join([directory, 'tactics']), use_delta=True, search_mode=G.BOOK_SEARCH_MODE, use_bloom=True, use_due_index=True, use_child_hashes=True)
+        self.journal = Journal(journal_filename, self.mmrws() + list(map(lambda mmrw : mmrw.delta, self.mmrws())))
+        for mmrw in self.mmrws():
+            mmrw.journal = self.journal
+            mmrw.delta.journal = self.journal
+        for n, mmrw in enumerate(self.mmrws()):
+            mmrw.set_generations(self.generations, 3 * n)
+        # Built when first needed (see graph)
+        self.graphs = {}
+        # Every answer given in spaced repetition (see update_learning_data)
+        self.reviews = ReviewLog(os.sep.join([directory, 'reviews']))
+        # Scheduler fitted to the answers, if any (see fit_scheduler.py)
+        scheduler = load_scheduler(os.sep.join([directory, 'scheduler']))
+        if scheduler != None:
+            set_scheduler(scheduler)
+
+        # Background compaction of the delta segments
+        self.closed = False
+        self.compaction_event = threading.Event()
+        self.compactor = threading.Thread(target=self.compaction_loop, daemon=True)
+        self.compactor.start()
 
         # If some of code below takes too long to run and isn't necessary
         # at startup, consider putting it in a thread and joining the thread
         # when necessary
 
-        comments_filename = os.sep.join([directory, 'comments'])
-        if os.path.getsize(comments_filename) == 0:
-            fil = open(comments_filename, 'w')
-            try:
-                fil.write(G.COMMENT_ENTRY_SIZE * '\0') # Change if comment entry size changes
-            except Exception as e:
-                print(e, file=sys.stderr)
-            fil.close()
-        comments_file = os.open(comments_filename, os.O_RDWR)
-        try:
-            self.comments = CommentsMMRW(comments_file, 0)
-        except Exception as e:
-            # For now
-            print(e, file=sys.stderr)
-            pass
+        self.comments = CommentStore(os.sep.join([directory, 'comments']), search_mode=G.BOOK_SEARCH_MODE)
+        # Built when first needed (see search_comments)
+        self.comment_index = None
+
+        # Games saved with the repertoire (see add_games)
+        archive_filename = os.sep.join([directory, 'games.pgn'])
+        game_directory = os.sep.join([directory, 'games'])
+        if os.path.isdir(game_directory):
+            convert_games_directory(game_directory, archive_filename)
+        self.games = GameArchive(archive_filename)
+
+        # The games each position occurs in (see add_games)
+        index_filename = os.sep.join([directory, 'positions.index'])
+        position_directory = os.sep.join([directory, 'positions'])
+        self.positions = PositionIndex(index_filename)
+        if os.path.isdir(position_directory):
+            convert_positions_directory(position_directory, self.positions, G.POSITION_INDEX_RUN_SIZE)
 
         # Load initial positions
         self.initial_positions = []
@@ -229,18 +1285,13 @@ class Repertoire(object):
             self.save_initial_positions_to_file()
 
     def delete_orphaned_tactics(self):
-        from rep_visitor import tactics_visitor
-        hashes = set()
-        # Make sure to modify this if default behavior of tactics_visitor changes
-        for b, _ in tactics_visitor():
-            hashes.add(chess.polyglot.zobrist_hash(b))
-        # This can probably be more efficient, as each delete might be expensive
-        i = 0
-        while i < len(self.t):
-            if self.t[i].key not in hashes:
-                del self.t[i]
-            else:
-                i += 1
+        '''Deletes the tactics that can't be reached from any initial position.
+        The replies of the opponent are part of the exercises, so they are kept.'''
+        # Every edge below the initial positions needs its child, or what lies past it would be deleted
+        with self.graph_lookup(None, self.initial_positions) as graph:
+            distance, _ = graph.bfs(self.initial_position_hashes)
+            hashes = set(graph.nodes[distance >= 0].tolist())
+        self.t.delete_where(lambda e : e.key not in hashes)
 
     def set_comment(self, position, comment):
         '''Saves the comment for the position in the self.comments file.'''
@@ -249,20 +1300,45 @@ class Repertoire(object):
             h = position
         else:
             h = chess.polyglot.zobrist_hash(position)
-        index = self.comments.find_position(h)
-        if self.comments.hash_at_position_index(index) == h:
+        with self.comments.lock:
+            up_to_date = self.comment_index != None and self.comment_index.version == self.comments.version
+            self.comments.set(h, comment)
+            if up_to_date:
+                self.comment_index.set(h, comment)
+                self.comment_index.version = self.comments.version
+
+    def search_comments(self, query):
+        '''Returns the hashes of the positions whose comments have words starting
+        with every word of query (see CommentSearchIndex).'''
+        with self.comments.lock.shared():
+            if self.comment_index == None or self.comment_index.version != self.comments.version:
+                self.comment_index = CommentSearchIndex(self.comments.comments())
+                self.comment_index.version = self.comments.version
+            return self.comment_index.search(query)
+
+    def find_line(self, key):
+        '''Returns a board with the moves of a shortest line of the white or black 
+        repertoire from the initial position to the position with the given hash, 
+        or None if neither reaches it (see Repertoire.graph).'''
+        board = chess.Board()
+        for player in [chess.WHITE, chess.BLACK]:
+            with self.graph_lookup(player, [board]) as graph:
+                node = graph.node_index(key)
+                if node < 0:
+                    continue
+                distance, parent_edge = graph.bfs([zobrist_hash(board)])
+                if distance[node] < 0:
+                    continue
+                raw_moves = graph.path(parent_edge, node)
             try:
-                # Replace opening comment
-                self.comments.replace_entry(index, h, comment)
-            except ValueError as e:
-                print(e, file=sys.stderr)
-                return
-        else:
-            # Add new entry at index
-            self.comments.create_entry(index)
-            self.comments.replace_entry(index, h, comment)
-            return None
-        pass
+                for raw_move in raw_moves:
+                    board.push(board.parse_uci(decode_move(raw_move).uci()))
+            except ValueError:
+                # Not legal moves, so a hash collision
+                board = chess.Board()
+                continue
+            return board
+        return None
 
     def get_comment(self, position):
         '''Returns comment for given position, or None if the position
@@ -272,11 +1348,7 @@ class Repertoire(object):
             h = position
         else:
             h = chess.polyglot.zobrist_hash(position)
-        index = self.comments.find_position(h)
-        if self.comments.hash_at_position_index(index) == h:
-            return self.comments.comment_at_position_index(index)
-        else:
-            return None
+        return self.comments.get(h)
 
     def get_mmrw(self, player, turn_color):
         if player == chess.WHITE and turn_color == chess.WHITE:
@@ -290,36 +1362,184 @@ class Repertoire(object):
         if player == None:
             return self.t
 
+    def mmrws(self):
+        return [self.ww, self.wb, self.bw, self.bb, self.t]
+
+    def probe(self, player, board, move=None, key=None):
+        '''Looks up a position and move with a single search of the book for player 
+        (None for tactics), returning a BookProbe.
+
+        key can be the precomputed Zobrist hash of board. Book moves are
+        normalized on board (see normalizeMove), so that castling matches in
+        either form, and skipped if illegal there.'''
+        if key == None:
+            key = zobrist_hash(board)
+        result = BookProbe()
+        for segment, index, entry in self.get_mmrw(player, board.turn).locate_all(key):
+            try:
+                entry_move = normalizeMove(board, entry.move)
+            except ValueError:
+                continue
+            result.entries.append((segment, index, entry))
+            result.moves.append(entry_move)
+            if move != None and entry_move == move:
+                result.locations.append((segment, index, entry))
+        if len(result.locations) > 0:
+            result.learn = result.locations[0][2].learn
+        return result
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Groups the edits made in a with statement into one transaction, which
+        is committed at the end with a single journal append and fsync, or 
+        dropped if an exception is raised. The books are only synced at the
+        next checkpoint (see flush), so committing is cheap.
+
+        Inserts into delta segments are written right away, as they are already
+        safe across crashes. Merges and deletes in the books commit the edits so 
+        far before moving entries.'''
+        # Holding every book keeps other threads from moving entries with pending edits
+        for mmrw in self.mmrws():
+            mmrw.lock.acquire()
+        try:
+            self.journal.begin()
+            try:
+                yield self
+            except BaseException:
+                self.journal.abort()
+                # The due indexes and graphs saw the dropped edits
+                for mmrw in self.mmrws():
+                    mmrw.due = None
+                self.graphs = {}
+                raise
+            self.journal.end()
+            if self.journal.depth == 0:
+                # The answers given are logged along with their reviews
+                self.reviews.flush()
+            if self.journal.size > G.JOURNAL_CHECKPOINT_SIZE:
+                self.journal.checkpoint()
+        finally:
+            for mmrw in reversed(self.mmrws()):
+                mmrw.lock.release()
+
+    def refresh(self):
+        '''Catches up with the books changed by other processes since the last call,
+        which is cheap when nothing changed. Returns True if any book changed.'''
+        changed = set(map(lambda slot : slot // 3, self.generations.changed()))
+        for n in changed:
+            self.mmrws()[n].refresh()
+        return len(changed) > 0
+
     def flush(self):
-        self.ww.mmap.flush()
-        self.wb.mmap.flush()
-        self.bw.mmap.flush()
-        self.bb.mmap.flush()
-        self.t.mmap.flush()
+        '''Syncs the books, empties the journal and writes buffered reviews.'''
+        self.journal.checkpoint()
+        self.reviews.flush()
+        for mmrw in self.mmrws():
+            mmrw.flush()
 
     def close(self):
-        self.ww.mmap.close()
-        self.wb.mmap.close()
-        self.bw.mmap.close()
-        self.bb.mmap.close()
-        self.t.mmap.close()
+        self.closed = True
+        self.compaction_event.set()
+        # A compaction in progress still uses the journal and the books
+        self.compactor.join()
+        self.journal.close()
+        self.reviews.close()
+        self.comments.close()
+        self.positions.close()
+        self.games.close()
+        for mmrw in self.mmrws():
+            with mmrw.lock:
+                mmrw.close()
+        self.generations.close()
+
+    def export_books(self, directory):
+        '''Writes the books as plain polyglot books into directory, laid out 
+        like a repertoire directory, for use by other programs.'''
+        for color in ['white', 'black']:
+            os.makedirs(os.sep.join([directory, color]), exist_ok=True)
+        self.ww.export(os.sep.join([directory, 'white', 'white']))
+        self.wb.export(os.sep.join([directory, 'white', 'black']))
+        self.bw.export(os.sep.join([directory, 'black', 'white']))
+        self.bb.export(os.sep.join([directory, 'black', 'black']))
+        self.t.export(os.sep.join([directory, 'tactics']))
+
+    def compact(self):
+        '''Merges the delta segments of all the books into the books.'''
+        for mmrw in self.mmrws():
+            if self.closed:
+                return
+            # Merges move entries around without changing the graph
+            with self.graph_update(self.book_player(mmrw)):
+                mmrw.compact()
+
+    def compaction_loop(self):
+        '''Compacts the books every G.DELTA_COMPACTION_INTERVAL seconds,
+        or sooner if a delta segment gets too large.'''
+        while not self.closed:
+            self.compaction_event.wait(G.DELTA_COMPACTION_INTERVAL)
+            self.compaction_event.clear()
+            if self.closed:
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+    def add_position_and_move(self, mmrw, p, m, weight, learn):
+        with self.graph_update(self.book_player(mmrw)) as graph:
+            mmrw.add_position_and_move(p, m, weight, learn)
+            if graph != None:
+                entry = makeEntry(p, m, weight, learn)
+                graph.add_edge(entry.key, entry.raw_move, weight, learn, mmrw.child_hash(entry))
+        if len(mmrw.delta) >= G.DELTA_MAX_ENTRIES:
+            self.compaction_event.set()
 
     def appendWhite(self, p, m, weight=1, learn=0):
         if p.turn == chess.WHITE:
-            self.ww.add_position_and_move(p, m, weight, learn)
+            self.add_position_and_move(self.ww, p, m, weight, learn)
         else:
-            self.wb.add_position_and_move(p, m, weight, learn)
+            self.add_position_and_move(self.wb, p, m, weight, learn)
 
     def appendBlack(self, p, m, weight=1, learn=0):
         if p.turn == chess.WHITE:
-            self.bw.add_position_and_move(p, m, weight, learn)
+            self.add_position_and_move(self.bw, p, m, weight, learn)
         else:
-            self.bb.add_position_and_move(p, m, weight, learn)
+            self.add_position_and_move(self.bb, p, m, weight, learn)
 
     def appendTactic(self, p, m, weight=None, learn=None):
         if weight == None or learn == None:
             weight, learn = export_values(2.5, 0, int(time.time() / 60))
-        self.t.add_position_and_move(p, m, weight, learn)
+        self.add_position_and_move(self.t, p, m, weight, learn)
+
+    def append_many(self, player, items):
+        '''Adds many position/move pairs to the repertoire for player, or to the 
+        tactics repertoire if player is None, with a single merge into each book.
+
+        Each item is either a (position, move) or a (position, move, weight, learn) tuple.
+        Missing weights and learn values get the same defaults as appendWhite, 
+        appendBlack, and appendTactic. Returns the number of entries added.'''
+        new_entries = {}
+        child_hashes = {}
+        for item in items:
+            p, m = item[0], item[1]
+            weight, learn = (item[2], item[3]) if len(item) > 2 else (None, None)
+            if weight == None or learn == None:
+                if player == None:
+                    weight, learn = export_values(2.5, 0, int(time.time() / 60))
+                else:
+                    weight, learn = 1, 0
+            mmrw = self.get_mmrw(player, p.turn)
+            new_entries.setdefault(mmrw, []).append(makeEntry(p, m, weight, learn))
+            child_hashes.setdefault(mmrw, []).append((new_entries[mmrw][-1].key, new_entries[mmrw][-1].raw_move, childHash(p, m)))
+        count = 0
+        with self.graph_update(player) as graph:
+            for mmrw in new_entries:
+                mmrw.add_child_hashes(child_hashes[mmrw])
+                count += mmrw.add_entries(new_entries[mmrw])
+                if graph != None:
+                    for entry, (_, _, child) in zip(new_entries[mmrw], child_hashes[mmrw]):
+                        graph.add_edge(entry.key, entry.raw_move, entry.weight, entry.learn, child)
+        return count
 
     def findMove(self, perspective, p):
         mmrw = self.get_mmrw(perspective, p.turn)
@@ -354,31 +1574,19 @@ class Repertoire(object):
 
     def remove(self, perspective, p, move=None):
         zh = zobrist_hash(p)
-        deleteIndices = set()
+        deleteIndices = {}
         mmrw = self.get_mmrw(perspective, p.turn)
-        index = 16 * mmrw.bisect_key_left(zh)
 
-        # Find deletions to make
-        for i in range(index, 16 * len(mmrw), 16):
-            key, mBits, _, _ = chess.polyglot.ENTRY_STRUCT.unpack_from(mmrw.mmap, i)
-            if key != zh:
-                break
-            elif move == None or moveToBits(move) == mBits:
-                deleteIndices.add(i)
-
-        # Make deletions to mmap
-        if len(deleteIndices) > 0:
-            offset = 0
-            for i in range(index, 16 * len(mmrw), 16):
-                while i + offset in deleteIndices:
-                    offset += 16
-                if i + offset >= 16 * len(mmrw):
-                    break
-                if offset != 0:
-                    mmrw.mmap[i:i + 16] = mmrw.mmap[i + offset:i + offset + 16]
-        mmrw.mmap.resize(len(mmrw.mmap) - 16 * len(deleteIndices))
+        with self.graph_update(perspective) as graph:
+            # Find deletions to make, in the book and in its delta segment
+            for segment, i, entry in mmrw.locate_all(zh):
+                if move == None or moveToBits(move) == entry.raw_move:
+                    deleteIndices.setdefault(segment, []).append(i)
 
-        return len(deleteIndices)
+            # Make deletions
+            if graph != None:
+                graph.remove_edges(zh, None if move == None else moveToBits(move))
+            return sum(segment.delete_indices(deleteIndices[segment]) for segment in deleteIndices)
 
     def removeWhite(self, p, move=None):
         return self.remove(chess.WHITE, p, move)
@@ -387,15 +1595,7 @@ class Repertoire(object):
         return self.remove(chess.BLACK, p, move)
 
     def removeTactic(self, p, move=None):
-        # Less efficient attempt than remove method
-        h = chess.polyglot.zobrist_hash(p)
-        index = self.t.bisect_key_left(h)
-        for i in range(index, len(self.t)):
-            if self.t[i].key == h:
-                if move == None or move == self.t[i].move:
-                    del self.t[i]
-            else:
-                break
+        return self.remove(None, p, move)
 
     def add_games(self, games=[], filenames=[]):
         # Do nothing case
@@ -405,114 +1605,68 @@ class Repertoire(object):
         # Variable to list filenames that encountered an error
         errors = []
 
-        # We're saving the games to self.directory + '/games' + number,
-        # where number is one more than the highest number already used.
-        # Here we calculate what this number is.
-        game_directory = self.directory + os.sep + 'games'
-        position_directory = self.directory + os.sep + 'positions' # Used further below
-        existing_files = os.listdir(game_directory)
-        next_game_number = 0
-        for name in existing_files:
-            try:
-                n = int(name)
-            except:
-                continue
-            if n >= next_game_number:
-                next_game_number = n + 1
-
-        # Combine lists
+        # Combine lists (without changing the caller's list)
+        games = list(games)
         for filename in filenames:
+            file_games = []
             try:
-                pgnFile = open(filename, 'r')
-                game = chess.pgn.read_game(filename)
-                pgnFile.close()
+                with open(filename, 'r') as pgnFile:
+                    while True:
+                        game = chess.pgn.read_game(pgnFile)
+                        if game == None:
+                            break
+                        file_games.append(game)
             except:
                 errors.append(filename)
                 continue
-            games.append(game)
-
-        # Now we know we're saving to game_directory + os.sep + str(next_game_number).
-        # We loop through the inputs.
-        for game in games:
-            # Store game
-            outputFile = open(game_directory + os.sep + str(next_game_number), 'w')
-            print(game, file=outputFile)
-            outputFile.close()
-
-            # Link relevant nodes to game
-            # Will just run through principal variation
-            while game.variations:
-                board = game.board()
-                key = zobrist_hash(game.board())
-                positionFile = None
-                pgnFile = None
-                try:
-                    pgnFile = open(position_directory + os.sep + str(key), 'r')
-                except FileNotFoundError:
-                    # If creating file for node, just need to write the game number
-                    pgnFile = open(position_directory + os.sep + str(key), 'w')
-                    print(next_game_number, file=pgnFile)
-                    pgnFile.close()
-                    game = game.variation(0)
-                    continue
+            games.extend(file_games)
 
-                if pgnFile != None:
-                    # Parse file contents
-                    firstLine = pgnFile.readline().strip()
-                    rest = pgnFile.read()
-                    pgnFile.close()
-                    # Form new first line
-                    firstLine += ',' + str(next_game_number)
-                    # Reopen to write
-                    # TODO: Use temp file in case something goes wrong between
-                    # reading and writing
-                    pgnFile = open(position_directory + os.sep + str(key), 'w')
-                    print(firstLine, file=pgnFile)
-                    print(rest, file=pgnFile, end="")
-                    pgnFile.close()
-
-                # Go to next node
-                game = game.variation(0)
-
-            # Update next_game_number
-            next_game_number += 1
+        # Games are numbered in the order they are saved
+        first_number = self.games.append(games)
+
+        # Link the positions of the principal variation of each game to it
+        builder = PositionIndexBuilder(self.positions, G.POSITION_INDEX_RUN_SIZE)
+        for number, game in enumerate(games, first_number):
+            builder.add_game(number, mainlineHashes(game))
+
+        # Sort the links in with those of the games already saved
+        builder.finish()
 
         # Return number of errors
         return errors
 
+    def bulk_import_games(self, filename, processes=None, progress=None):
+        '''Like add_games for the games of a single (large) PGN file, but parsed
+        in parallel (see bulk_import.py). Returns the number of games imported.'''
+        return bulk_import_games(self, filename, G.BULK_IMPORT_CHUNK_SIZE, G.POSITION_INDEX_RUN_SIZE, processes, progress)
+
     def list_games(self, position):
-        positionDirectory = self.directory + os.sep + 'positions'
-        positionFile = None
-        try:
-            positionFile = open(positionDirectory + os.sep + str(zobrist_hash(position)), 'r')
-        except FileNotFoundError:
-            return []
-        firstLine = positionFile.readline()
-        games = list(map(lambda x : x.strip(), firstLine.split(',')))
-        return games
+        '''Returns the numbers of the saved games position occurs in (see add_games).'''
+        return self.positions.games(zobrist_hash(position))
+
+    def read_games(self, position):
+        '''Yields the PGN texts of the saved games position occurs in.'''
+        return self.games.texts(self.list_games(position))
 
     def make_position_learnable(self, position, perspective, override=False):
         weight, learn = export_values(2.5, 0, int(time.time() / 60))
         mmrw = self.get_mmrw(perspective, position.turn)
-        position_hash = chess.polyglot.zobrist_hash(position)
-        index = mmrw.bisect_key_left(position_hash)
-        while index < len(mmrw):
-            entry = mmrw[index]
-            if entry.key != position_hash:
-                break
-            # The line below would be more efficient if it used hash and raw move
-            # The weight and learn should already be in their raw bits format
-            # First we check it hasn't been already set for learning!
-            if entry.learn == 0 or override == True:
-                mmrw.edit_entry(index, position, entry.move, weight, learn)
-            index += 1
+        with self.graph_update(perspective) as graph:
+            for segment, index, entry in self.probe(perspective, position).entries:
+                # The weight and learn should already be in their raw bits format
+                # First we check it hasn't been already set for learning!
+                if entry.learn == 0 or override == True:
+                    mmrw.edit_learning(segment, index, entry, weight, learn)
+                    if graph != None:
+                        graph.set_values(entry.key, entry.raw_move, weight, learn)
 
     def update_modified_date(self, player, turn):
+        '''Updates the modification time of a book for directory monitors. 
+        (Other instances of the program use refresh instead.)'''
         mmrw = self.get_mmrw(player, turn)
-        subprocess.Popen(["touch", mmrw.filename])
+        os.utime(mmrw.filename)
 
     def update_learning_data(self, player, position, move, incorrect_answers, time_to_complete):
-        mmrw = self.get_mmrw(player, position.turn)
         # Get q value
         q = 3
         if incorrect_answers > 2:
@@ -528,55 +1682,280 @@ class Repertoire(object):
                 q = 4
 
         # Find node
-        position_hash = chess.polyglot.zobrist_hash(position)
-        index = mmrw.bisect_key_left(position_hash)
-        counter = 0
-        while index < len(mmrw):
-            entry = mmrw[index]
-            if entry.key != position_hash:
-                break
-            if entry.move != move:
-                index += 1
-                continue
-            if counter > 0:
-                # This shouldn't happen!
-                # To make work, need to compare positions
-                print("Warning: following board/move pair has multiple entries")
-                print(position)
-                print("Board hash: %d" % position_hash)
-                print(move)
-                break
-            # The line below would be more efficient if it used hash and raw move
-            # The weight and learn should already be in their raw bits format
-            # First we check it hasn't been already set for learning!
-            e, c, n = read_values((entry.weight << 32) | entry.learn)
-            e, c, n = update_spaced_repetition_values(e, c, n, q)
-            weight, learn = export_values(e, c, n)
-            mmrw.edit_entry(index, position, entry.move, weight, learn)
-            index += 1
-            counter += 1
+        mmrw = self.get_mmrw(player, position.turn)
+        with self.graph_update(player) as graph:
+            for segment, index, entry in self.single_location(player, position, move):
+                e, c, n = read_values((entry.weight << 32) | entry.learn)
+                e, c, n = update_spaced_repetition_values(e, c, n, q)
+                weight, learn = export_values(e, c, n)
+                mmrw.edit_learning(segment, index, entry, weight, learn)
+                self.reviews.append(entry.key, entry.raw_move, book_number(player), q, incorrect_answers, time_to_complete)
+                if graph != None:
+                    graph.set_values(entry.key, entry.raw_move, weight, learn)
+        if self.journal.depth == 0:
+            # Otherwise, written when the transaction commits
+            self.reviews.flush()
+
+    def transform_learning(self, player, transform, board=None):
+        '''Applies transform (see spaced_repetition.py) to the learning data of the
+        entries set to learn in player's repertoire (the tactics if player is None),
+        only those of positions that can be reached from board if one is given. 
+        Returns the number of entries changed.'''
+        books = self.graph_books(player)
+        with contextlib.ExitStack() as stack:
+            for mmrw in books:
+                stack.enter_context(mmrw.lock)
+            keys = None
+            if board != None:
+                with self.graph_lookup(player, [board]) as graph:
+                    distance, _ = graph.bfs([zobrist_hash(board)])
+                    keys = graph.nodes[distance >= 0]
+            return sum(map(lambda mmrw : mmrw.transform_learning(transform, keys), books))
+
+    def graph_books(self, player):
+        '''The books making up player's repertoire (the tactics if player is None).'''
+        if player == None:
+            return [self.t]
+        return [self.get_mmrw(player, chess.WHITE), self.get_mmrw(player, chess.BLACK)]
+
+    def book_player(self, mmrw):
+        '''The player whose repertoire a book is part of (None for the tactics).'''
+        if mmrw is self.t:
+            return None
+        return chess.WHITE if mmrw is self.ww or mmrw is self.wb else chess.BLACK
+
+    def graph(self, player):
+        '''Returns the RepertoireGraph of player's repertoire (the tactics if player
+        is None), building it if it is out of date. The child hashes of the books
+        are filled in first if they never were (see complete_child_hashes).'''
+        self.complete_child_hashes(player)
+        with contextlib.ExitStack() as stack:
+            for mmrw in self.graph_books(player):
+                stack.enter_context(mmrw.lock.shared())
+            return self.current_graph(player)
+
+    def current_graph(self, player):
+        '''Like graph, but without filling in child hashes. The books of player's
+        repertoire must be held.'''
+        books = self.graph_books(player)
+        graph = self.graphs.get(player)
+        if graph == None or graph.versions != list(map(lambda mmrw : mmrw.version, books)):
+            arrays = [(array, mmrw.children.get if mmrw.children != None else lambda key, raw_move : None)
+                      for mmrw in books for _, array in mmrw.views()]
+            graph = RepertoireGraph.for_arrays(arrays)
+            arrays = None
+            graph.versions = list(map(lambda mmrw : mmrw.version, books))
+            self.graphs[player] = graph
+        return graph
+
+    def graph_roots(self, player):
+        '''The positions player's repertoire (the tactics if player is None) starts from.'''
+        if player == None:
+            return list(self.initial_positions)
+        return [chess.Board()]
+
+    def complete_child_hashes(self, player):
+        '''Fills in the child hashes of the entries of player's repertoire (the 
+        tactics if player is None) that can be reached from its initial positions,
+        and marks them complete, unless they already are.
+
+        Every entry added stores its child hash (see add_position_and_move and
+        append_many), but books from before child hashes were stored have none,
+        and the graph can't go past their entries, so this is done once for
+        them, when their graph is first needed.'''
+        books = self.graph_books(player)
+        complete = lambda : all(map(lambda mmrw : mmrw.children == None or mmrw.children.complete, books))
+        if complete():
+            return
+        with contextlib.ExitStack() as stack:
+            for mmrw in books:
+                stack.enter_context(mmrw.lock)
+            # Possibly filled in by another process in the meantime
+            for mmrw in books:
+                if mmrw.children != None:
+                    mmrw.children.load()
+            if complete():
+                return
+            self.fill_child_hashes(player, self.graph_roots(player))
+            for mmrw in books:
+                if mmrw.children != None:
+                    mmrw.children.mark_complete()
+
+    def fill_child_hashes(self, player, boards):
+        '''Stores the child hashes missing from the part of player's repertoire
+        (the tactics if player is None) that can be reached from the given boards,
+        playing the moves of the lines leading to them. Only the nodes from which
+        an edge with an unknown child can be reached are visited, so this is
+        cheap when there is none. Returns the number of child hashes stored.'''
+        records = {}
+        with contextlib.ExitStack() as stack:
+            for mmrw in self.graph_books(player):
+                stack.enter_context(mmrw.lock)
+            graph = self.current_graph(player)
+            incomplete = graph.incomplete_ancestors()
+            visited = set()
+            for board in boards:
+                board = board.copy(stack=False)
+                key = zobrist_hash(board)
+                if key not in incomplete or key in visited:
+                    continue
+                visited.add(key)
+                # For each node of the current line, its hash and the book moves left to look at
+                line = [(key, iter(graph.successors(key)))]
+                while len(line) > 0:
+                    key, edges = line[-1]
+                    edge = next(edges, None)
+                    if edge == None:
+                        line.pop()
+                        if len(line) > 0:
+                            board.pop()
+                        continue
+                    raw_move, child = edge[0], edge[1]
+                    try:
+                        move = normalizeMove(board, decode_move(raw_move))
+                    except ValueError:
+                        # Not a legal move of the position, so a hash collision
+                        continue
+                    if child == None:
+                        child = pushWithHash(board, key, move)
+                        board.pop()
+                        records.setdefault(self.get_mmrw(player, board.turn), []).append((key, raw_move, child))
+                    if child not in incomplete or child in visited:
+                        continue
+                    visited.add(child)
+                    board.push(move)
+                    line.append((child, iter(graph.successors(child))))
+            for mmrw, book_records in records.items():
+                mmrw.add_child_hashes(book_records)
+            if len(records) > 0:
+                # Rebuilt with the new child hashes when next needed
+                self.graphs.pop(player, None)
+        return sum(map(len, records.values()))
+
+    @contextlib.contextmanager
+    def graph_lookup(self, player, boards=[]):
+        '''Holds the books of player's repertoire for lookups, and gives the graph of
+        the repertoire, which no other thread (or process) edits in the meantime.
+
+        The graph has every child hash that can be known below the initial
+        positions of the repertoire, and below the given boards, which traversals
+        from positions that might not be reached from there should give.'''
+        # These need the books exclusively, if they do anything
+        self.complete_child_hashes(player)
+        if len(boards) > 0:
+            self.fill_child_hashes(player, boards)
+        with self.lookups(player):
+            yield self.current_graph(player)
+
+    @contextlib.contextmanager
+    def lookups(self, player):
+        '''Holds the books of player's repertoire (the tactics if player is None)
+        shared for the lookups made in a with statement, which then only take
+        their locks nested, rather than each taking them from the files (and 
+        catching up with other processes) again.
+
+        Other threads can't use the books meanwhile, so this is for batches of
+        lookups, not to be held while waiting for something else.'''
+        with contextlib.ExitStack() as stack:
+            for mmrw in self.graph_books(player):
+                stack.enter_context(mmrw.lock.shared())
+            yield self
+
+    @contextlib.contextmanager
+    def graph_update(self, player):
+        '''Holds the books of player's repertoire for an edit, and gives the graph of 
+        the repertoire to apply the edit to, or None if it is not up to date anyway.
+        The graph is then marked up to date again.'''
+        books = self.graph_books(player)
+        with contextlib.ExitStack() as stack:
+            for mmrw in books:
+                stack.enter_context(mmrw.lock)
+            graph = self.graphs.get(player)
+            if graph != None and graph.versions != list(map(lambda mmrw : mmrw.version, books)):
+                graph = None
+            yield graph
+            if graph != None:
+                graph.versions = list(map(lambda mmrw : mmrw.version, books))
+
+    def successors(self, player, key):
+        '''Returns an (entry, child hash) pair for each book move of the position 
+        with the given hash in player's repertoire (the tactics if player is None),
+        without playing any moves or looking at the books.
+
+        Entry moves are as stored in the book (castling is king takes rook), and 
+        child hashes not stored yet are None (see store_child_hash).'''
+        with self.graph_lookup(player) as graph:
+            edges = graph.successors(key)
+        return list(map(lambda edge : (chess.polyglot.Entry(key, edge[0], edge[2], edge[3], decode_move(edge[0])), edge[1]), edges))
+
+    def store_child_hash(self, player, board, entry, child=None):
+        '''Stores and returns the child hash of an entry of board in player's 
+        repertoire (the tactics if player is None), computing it if not given.'''
+        if child == None:
+            child = childHash(board, entry.move)
+        with self.graph_update(player) as graph:
+            self.get_mmrw(player, board.turn).add_child_hashes([(entry.key, entry.raw_move, child)])
+            if graph != None:
+                graph.set_child(entry.key, entry.raw_move, child)
+        return child
+
+    def opening_size(self, player, board):
+        '''Returns the number of positions of player's repertoire, with player to
+        move, that can be reached from board (including board itself).'''
+        with self.graph_lookup(player, [board]) as graph:
+            distance, _ = graph.bfs([zobrist_hash(board)])
+        parity = 0 if board.turn == player else 1
+        return int(numpy.count_nonzero((distance >= 0) & (distance % 2 == parity)))
+
+    def due_entries(self, player, count=None, before=None):
+        '''Yields the entries set to learn in player's repertoire (the tactics if 
+        player is None) in due order, only those due at or before the given time 
+        (in minutes after the epoch) if one is given, and at most count of them.
+
+        Only the books of player's own moves are looked at, as in rep_visitor.
+        The entries are read from the due index a chunk at a time, starting with
+        G.DUE_ENTRIES_CHUNK and doubling, so taking the first k of them costs
+        O(k log n), and the book is only held while reading a chunk. Each chunk
+        starts after the last entry of the one before, so changes to the book in
+        the meantime are seen.'''
+        mmrw = self.get_mmrw(player, player)
+        chunk = G.DUE_ENTRIES_CHUNK if count == None else min(count, G.DUE_ENTRIES_CHUNK)
+        last = None
+        while count == None or count > 0:
+            with mmrw.lock.shared():
+                entries = mmrw.due_index().due(before, chunk, last)
+            yield from entries
+            if len(entries) < chunk:
+                return
+            last = entries[-1]
+            if count != None:
+                count -= len(entries)
+            chunk = 2 * chunk if count == None else min(2 * chunk, count)
+
+    def count_due(self, player, before):
+        '''Returns the number of entries of player's repertoire (the tactics if
+        player is None) due at or before the given time, as in due_entries.'''
+        mmrw = self.get_mmrw(player, player)
+        with mmrw.lock.shared():
+            return mmrw.due_index().count_due(before)
+
+    def single_location(self, player, position, move):
+        '''Returns the (segment, index, entry) triple of a board/move pair as a 
+        list of at most one element, warning if there are several entries.'''
+        locations = self.probe(player, position, move).locations
+        if len(locations) > 1:
+            # This shouldn't happen!
+            # To make work, need to compare positions
+            print("Warning: following board/move pair has multiple entries")
+            print(position)
+            print("Board hash: %d" % locations[0][2].key)
+            print(move)
+        return locations[:1]
 
     def remove_learning_data(self, player, position, move):
-        # TODO Refactor to avoid repeated code
         mmrw = self.get_mmrw(player, position.turn)
-        position_hash = chess.polyglot.zobrist_hash(position)
-        index = mmrw.bisect_key_left(position_hash)
-        counter = 0
-        while index < len(mmrw):
-            entry = mmrw[index]
-            if entry.key != position_hash:
-                break
-            if entry.move != move:
-                index += 1
-                continue
-            if counter > 0:
-                # This shouldn't happen!
-                # To make work, need to compare positions
-                print("Warning: following board/move pair has multiple entries")
-                print(position)
-                print("Board hash: %d" % position_hash)
-                print(move)
-                break
-            mmrw.edit_entry(index, position, entry.move, 1, 0)
-            index += 1
-            counter += 1
+        with self.graph_update(player) as graph:
+            for segment, index, entry in self.single_location(player, position, move):
+                mmrw.edit_learning(segment, index, entry, 1, 0)
+                if graph != None:
+                    graph.set_values(entry.key, entry.raw_move, 1, 0)
@@ -6,10 +6,6 @@ from mmrw import *
 
 # TODO: Change argument order, and give filename default None at the end
 def create_opening_game(filename, repertoire, color, starting_node):
-    findMoves = repertoire.findMovesWhite
-    if color == chess.BLACK: 
-        findMoves = repertoire.findMovesBlack
-
     # Visited nodes (to prevent too many paths to the same position)
     visited_hashes = set()
 
@@ -20,18 +16,30 @@ def create_opening_game(filename, repertoire, color, starting_node):
         curr = curr.variation(0)
         visited_hashes.add(zobrist_hash(curr.board()))
 
-    def inner_iter(curr):
-        if curr.board().can_claim_threefold_repetition():
+    # Children are found through their stored hashes (see Repertoire.successors),
+    # so the same board is used throughout, and no hashes are computed
+    def inner_iter(curr, board, key):
+        if board.can_claim_threefold_repetition():
             return # To avoid infinite loops, though should not be necessary if using visited nodes
-        board = curr.board()
-        for move in findMoves(board):
+        for entry, child_hash in repertoire.successors(color, key):
+            try:
+                move = normalizeMove(board, entry.move)
+            except ValueError:
+                continue
+            if child_hash == None:
+                child_hash = repertoire.store_child_hash(color, board, entry)
             curr = curr.add_variation(move)
-            if zobrist_hash(curr.board()) in visited_hashes: return
-            visited_hashes.add(zobrist_hash(curr.board()))
-            inner_iter(curr)
+            if child_hash in visited_hashes: return
+            visited_hashes.add(child_hash)
+            board.push(move)
+            inner_iter(curr, board, child_hash)
+            board.pop()
             curr = curr.parent
 
-    inner_iter(curr)
+    board = curr.board()
+    # Holding the books for the whole export saves locking them at every position
+    with repertoire.lookups(color):
+        inner_iter(curr, board, zobrist_hash(board))
 
     # Set place to start and color to test
     if color == chess.WHITE:
@@ -0,0 +1,272 @@
+# position_index.py
+
+'''An index of the games of a repertoire by the positions in them, kept in a
+single memory-mapped file.'''
+
+import os, mmap, struct, numpy
+from bisect import bisect_left
+from process_lock import ProcessLock
+
+class PositionIndex(object):
+    '''The ids of the games each position (by Zobrist hash) occurs in.
+
+    The file holds a header, then the posting lists (the game ids of every
+    position, one list after the other, each in increasing order), then the
+    sorted hashes of the positions, then for each hash the start of its posting
+    list (with the end of the last one after them). Looking up a position is a
+    binary search of the hashes, and its games are a slice of the postings.
+
+    The file is never changed in place. Games are added with a builder (see
+    PositionIndexBuilder), which sorts their (hash, game id) pairs in runs and
+    merges the runs with the index into a new file, replacing the old one
+    under self.lock. Other processes reopen the file when its inode changes.'''
+    MAGIC = b'CNAPOSIX'
+    # Magic, number of positions, and number of postings
+    HEADER_STRUCT = struct.Struct('>8sQQ')
+    PAIR_DTYPE = numpy.dtype([('hash', '>u8'), ('game', '>u4')])
+    # Positions read at once when merging the index
+    MERGE_CHUNK = 1 << 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mmap = None
+        self.inode = None
+        self.set_arrays(0, 0)
+        # The index file is replaced when rewritten, so it can't be locked
+        self.lock_fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.lock = ProcessLock(self.lock_fd, on_acquire=self.load)
+        self.load()
+
+    def set_arrays(self, num_positions, num_postings):
+        if num_positions == 0:
+            self.postings = numpy.zeros(0, dtype='>u4')
+            self.hashes = numpy.zeros(0, dtype='>u8')
+            self.starts = numpy.zeros(1, dtype='>u8')
+            return
+        offset = self.HEADER_STRUCT.size
+        self.postings = numpy.frombuffer(self.mmap, dtype='>u4', count=num_postings, offset=offset)
+        offset += 4 * num_postings
+        self.hashes = numpy.frombuffer(self.mmap, dtype='>u8', count=num_positions, offset=offset)
+        offset += 8 * num_positions
+        self.starts = numpy.frombuffer(self.mmap, dtype='>u8', count=num_positions + 1, offset=offset)
+
+    def load(self):
+        '''Maps the index file, unless the one mapped is still current.'''
+        try:
+            inode = os.stat(self.filename).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode == self.inode:
+            return
+        self.unmap()
+        if inode == None:
+            return
+        with open(self.filename, 'rb') as fil:
+            size = os.fstat(fil.fileno()).st_size
+            if size < self.HEADER_STRUCT.size:
+                return
+            self.mmap = mmap.mmap(fil.fileno(), size, access=mmap.ACCESS_READ)
+        magic, num_positions, num_postings = self.HEADER_STRUCT.unpack_from(self.mmap)
+        if magic != self.MAGIC or size < self.HEADER_STRUCT.size + 4 * num_postings + 16 * num_positions + 8:
+            self.unmap()
+            return
+        self.inode = inode
+        self.set_arrays(num_positions, num_postings)
+
+    def unmap(self):
+        # Arrays over the old mapping may still be in use (by a merge, for
+        # instance), so it is left to be closed when they are all gone
+        self.set_arrays(0, 0)
+        self.mmap = None
+        self.inode = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def num_postings(self):
+        return len(self.postings)
+
+    def games(self, key):
+        '''Returns the ids of the games position key occurs in, in increasing order.'''
+        with self.lock.shared():
+            # Rather than numpy.searchsorted, which would convert the whole array to native byte order
+            index = bisect_left(self.hashes, key)
+            if index == len(self.hashes) or int(self.hashes[index]) != key:
+                return []
+            return self.postings[int(self.starts[index]):int(self.starts[index + 1])].tolist()
+
+    def max_game(self):
+        '''The highest game id in the index, or -1 if it is empty.'''
+        with self.lock.shared():
+            return int(self.postings.max()) if len(self.postings) > 0 else -1
+
+    def chunks(self):
+        '''Yields the (hash, game id) pairs of the index in order, as arrays of
+        PAIR_DTYPE of whole positions.'''
+        for start in range(0, len(self.hashes), self.MERGE_CHUNK):
+            end = min(start + self.MERGE_CHUNK, len(self.hashes))
+            first, last = int(self.starts[start]), int(self.starts[end])
+            pairs = numpy.empty(last - first, dtype=self.PAIR_DTYPE)
+            pairs['hash'] = numpy.repeat(self.hashes[start:end], numpy.diff(self.starts[start:end + 1].astype(numpy.int64)))
+            pairs['game'] = self.postings[first:last]
+            yield pairs
+
+    def merge(self, runs):
+        '''Merges sorted arrays of (hash, game id) pairs (of PAIR_DTYPE, such as
+        memory-mapped run files) into the index, replacing its file.
+
+        This is the merge step of an external sort: every source is read a
+        chunk of whole positions at a time, and the positions up to the lowest
+        last hash of the chunks in memory are merged and written out.'''
+        with self.lock:
+            sources = [self.chunks()] + [run_chunks(run, self.MERGE_CHUNK) for run in runs]
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'wb') as fil, open(temp_filename + '.hashes', 'w+b') as hashes_file, \
+                 open(temp_filename + '.starts', 'w+b') as starts_file:
+                fil.write(bytes(self.HEADER_STRUCT.size))
+                num_positions, num_postings = 0, 0
+                for pairs in merge_sorted(sources):
+                    # A game counts once per position, however many times it occurs in it
+                    keep = numpy.ones(len(pairs), dtype=bool)
+                    keep[1:] = (pairs['hash'][1:] != pairs['hash'][:-1]) | (pairs['game'][1:] != pairs['game'][:-1])
+                    pairs = pairs[keep]
+                    first = numpy.ones(len(pairs), dtype=bool)
+                    first[1:] = pairs['hash'][1:] != pairs['hash'][:-1]
+                    starts = numpy.flatnonzero(first)
+                    fil.write(pairs['game'].astype('>u4').tobytes())
+                    hashes_file.write(pairs['hash'][starts].astype('>u8').tobytes())
+                    starts_file.write((starts + num_postings).astype('>u8').tobytes())
+                    num_positions += len(starts)
+                    num_postings += len(pairs)
+                starts_file.write(numpy.array([num_postings], dtype='>u8').tobytes())
+                for part in [hashes_file, starts_file]:
+                    part.seek(0)
+                    while True:
+                        data = part.read(1 << 20)
+                        if len(data) == 0:
+                            break
+                        fil.write(data)
+                fil.seek(0)
+                fil.write(self.HEADER_STRUCT.pack(self.MAGIC, num_positions, num_postings))
+                fil.flush()
+                os.fsync(fil.fileno())
+            os.remove(temp_filename + '.hashes')
+            os.remove(temp_filename + '.starts')
+            os.replace(temp_filename, self.filename)
+            self.load()
+
+    def close(self):
+        self.unmap()
+        os.close(self.lock_fd)
+
+def run_chunks(run, size):
+    '''Yields a sorted array of pairs in chunks of about size pairs, each ending
+    at the end of a position.'''
+    start = 0
+    while start < len(run):
+        end = min(start + size, len(run))
+        if end < len(run):
+            end = int(numpy.searchsorted(run['hash'], run['hash'][end - 1], side='right'))
+        yield run[start:end]
+        start = end
+
+def merge_sorted(sources):
+    '''Merges iterators of sorted arrays of pairs (whose chunks end at the end of
+    a position, see run_chunks) into sorted arrays of whole positions.'''
+    sources = list(sources)
+    buffers = [None] * len(sources)
+    while True:
+        for i, source in enumerate(sources):
+            if source != None and (buffers[i] is None or len(buffers[i]) == 0):
+                buffers[i] = next(source, None)
+                if buffers[i] is None:
+                    sources[i] = None
+        active = [i for i in range(len(sources)) if sources[i] != None]
+        if len(active) == 0:
+            return
+        # No source has pairs of hashes up to this one left to read
+        bound = min(buffers[i]['hash'][-1] for i in active)
+        parts = []
+        for i in active:
+            cut = int(numpy.searchsorted(buffers[i]['hash'], bound, side='right'))
+            parts.append(buffers[i][:cut])
+            buffers[i] = buffers[i][cut:]
+        pairs = numpy.concatenate(parts)
+        yield pairs[numpy.lexsort((pairs['game'], pairs['hash']))]
+
+class PositionIndexBuilder(object):
+    '''Adds games to a PositionIndex: the (hash, game id) pairs of the games are
+    collected in memory, sorted and written to a run file every run_size pairs,
+    and the runs are merged into the index by finish.'''
+    def __init__(self, index, run_size):
+        self.index = index
+        self.run_size = run_size
+        # Arrays of hashes and of game ids not yet written to a run
+        self.hashes = []
+        self.games = []
+        self.size = 0
+        self.run_filenames = []
+
+    def add_game(self, game, hashes):
+        '''Records that the positions with the given hashes occur in game (an id).'''
+        self.add_many(numpy.array(hashes, dtype=numpy.uint64), numpy.full(len(hashes), game, dtype=numpy.uint32))
+
+    def add_many(self, hashes, games):
+        '''Records that the position with hash hashes[i] occurs in game games[i], for every i.'''
+        self.hashes.append(hashes)
+        self.games.append(games)
+        self.size += len(hashes)
+        if self.size >= self.run_size:
+            self.write_run()
+
+    def add_pairs(self, pairs):
+        '''Adds a sorted array of pairs (of PositionIndex.PAIR_DTYPE) as a run.'''
+        filename = '%s.run%d.%d.%d' % (self.index.filename, os.getpid(), id(self), len(self.run_filenames))
+        pairs.astype(PositionIndex.PAIR_DTYPE).tofile(filename)
+        self.run_filenames.append(filename)
+
+    def write_run(self):
+        if self.size == 0:
+            return
+        pairs = numpy.empty(self.size, dtype=PositionIndex.PAIR_DTYPE)
+        pairs['hash'] = numpy.concatenate(self.hashes)
+        pairs['game'] = numpy.concatenate(self.games)
+        self.add_pairs(pairs[numpy.lexsort((pairs['game'], pairs['hash']))])
+        self.hashes, self.games, self.size = [], [], 0
+
+    def finish(self):
+        '''Merges the pairs added into the index.'''
+        self.write_run()
+        try:
+            runs = [numpy.memmap(filename, dtype=PositionIndex.PAIR_DTYPE, mode='r')
+                    for filename in self.run_filenames if os.path.getsize(filename) > 0]
+            self.index.merge(runs)
+            del runs
+        finally:
+            for filename in self.run_filenames:
+                os.remove(filename)
+            self.run_filenames = []
+
+def convert_positions_directory(directory, index, run_size):
+    '''Adds the games listed in a directory of one text file per position (named
+    by its hash, with the game ids comma separated on the first line), as used
+    before PositionIndex, to index, unless the index has a file already.
+
+    The index file is only written by the final merge, which renames it into
+    place, and the whole conversion holds the lock of the index, so that
+    neither an interrupted conversion nor two processes converting at once
+    leave an incomplete index behind.'''
+    with index.lock:
+        if os.path.exists(index.filename):
+            return
+        builder = PositionIndexBuilder(index, run_size)
+        for name in os.listdir(directory):
+            try:
+                key = int(name)
+                with open(os.sep.join([directory, name]), 'r') as fil:
+                    games = [int(x) for x in fil.readline().split(',') if x.strip() != '']
+            except ValueError:
+                continue
+            for game in games:
+                builder.add_game(game, [key])
+        builder.finish()
@@ -0,0 +1,71 @@
+# process_lock.py
+
+'''Reader/writer locks shared between processes.'''
+
+import fcntl, threading, contextlib
+
+class ProcessLock(object):
+    '''A reader/writer lock between processes, using flock on a file, which
+    is also a reentrant lock between the threads of a process.
+
+    Using the lock itself in a with statement (or calling acquire) takes it
+    exclusively, for changes, while shared() takes it for lookups only, so that
+    any number of processes can look things up at once. Within a process, only
+    one thread holds the lock at a time, in either mode.
+
+    on_acquire, if given, is called whenever the process gets the lock from
+    the file (that is, not for nested uses), so that it can catch up with
+    changes made by other processes in the meantime. Taking the lock
+    exclusively while holding it shared converts it, which flock does not
+    do atomically, so on_acquire is called then as well.'''
+    def __init__(self, fd, on_acquire=None):
+        self.fd = fd
+        self.on_acquire = on_acquire
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.mode = None
+
+    def acquire(self, mode=fcntl.LOCK_EX):
+        self.thread_lock.acquire()
+        if self.depth > 0 and (mode == fcntl.LOCK_SH or self.mode == fcntl.LOCK_EX):
+            self.depth += 1
+            return
+        try:
+            fcntl.flock(self.fd, mode)
+        except:
+            self.thread_lock.release()
+            raise
+        self.mode = mode
+        self.depth += 1
+        if self.on_acquire != None:
+            # The lock is already held, so on_acquire can use it as well
+            try:
+                self.on_acquire()
+            except:
+                self.release()
+                raise
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.unlock()
+        self.thread_lock.release()
+
+    def unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mode = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextlib.contextmanager
+    def shared(self):
+        self.acquire(fcntl.LOCK_SH)
+        try:
+            yield self
+        finally:
+            self.release()
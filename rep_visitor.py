@@ -1,55 +1,193 @@
 # rep_visitor.py
 
 import global_variables as G
-import datetime, random
+import datetime, random, queue, threading
 import mmrw
-import chess, chess.polyglot, time
-from chess_tools import board_moves
+import chess, chess.polyglot, time, numpy
+from chess_tools import board_moves, moveToBits, pushWithHash, normalizeMove
+from due_index import decode_move
 from bisect import bisect_left
 
 '''Module to visit repertoire nodes that are children of given board.'''
 
-# Idea: Start a background thread to start looking for next rep_visitor node
-# since this search can be slow due to a giant tree traversal that is hard
-# to avoid.
+
+def tree_visitor(board, player, book_player, only_sr, return_entry, visited_hashes):
+    '''Visits the nodes of book_player's repertoire (the tactics if None) that are 
+    children of given board in dfs, and returns board/move pairs where it is 
+    player's turn (at every node if player is None).
+
+    The search keeps an explicit stack of the nodes on the current line and
+    plays moves on a single board, which is only copied for the pairs returned.
+    Children are found through their stored hashes (see Repertoire.successors),
+    and the hashes that are not stored yet are computed from the hash of the
+    parent (see pushWithHash) and stored. If only_sr is True, only the nodes 
+    from which an entry set to learn can be reached are visited.
+
+    The lookups made until the next pair is found (or for at most 
+    VISITOR_BATCH_SIZE book moves) hold the books once (see Repertoire.lookups),
+    and the books are let go before the pair is returned.'''
+    useful = None
+    if only_sr:
+        with G.rep.graph_lookup(book_player) as graph:
+            useful = graph.learning_ancestors()
+    board = board.copy()
+    key = chess.polyglot.zobrist_hash(board)
+    # In case of originally given node being repeated later on in search tree
+    visited_hashes.add(key)
+    # For each node of the current line, its hash and the book moves left to look at
+    stack = [(key, iter(G.rep.successors(book_player, key)))]
+    while len(stack) > 0:
+        found = None
+        with G.rep.lookups(book_player):
+            for _ in range(G.VISITOR_BATCH_SIZE):
+                if len(stack) == 0 or found != None:
+                    break
+                found = visit_edge(board, player, book_player, only_sr, return_entry, visited_hashes, useful, stack)
+        if found != None:
+            yield found
+
+def visit_edge(board, player, book_player, only_sr, return_entry, visited_hashes, useful, stack):
+    '''Takes the next step of tree_visitor from the line given by board and stack,
+    and returns the pair found there, if any.'''
+    key, edges = stack[-1]
+    edge = next(edges, None)
+    if edge == None:
+        stack.pop()
+        if len(stack) > 0:
+            board.pop()
+        return None
+    entry, child_hash = edge
+    try:
+        move = normalizeMove(board, entry.move)
+    except ValueError:
+        # Not a legal move of the position, so a hash collision
+        return None
+    known = child_hash != None
+    if not known:
+        child_hash = pushWithHash(board, key, move)
+        board.pop()
+        G.rep.store_child_hash(book_player, board, entry, child_hash)
+    if child_hash in visited_hashes:
+        return None
+    found = None
+    if (board.turn == player or player == None) and \
+        (only_sr == False or \
+        (entry.learn > 0 and \
+        (return_entry == True or entry.learn <= int(time.time() / 60)))):
+        if not return_entry:
+            found = board.copy(), move
+        else:
+            found = board.copy(), move, entry._replace(move=move)
+    if useful != None and known and child_hash not in useful:
+        return found
+    visited_hashes.add(child_hash)
+    board.push(move)
+    stack.append((child_hash, iter(G.rep.successors(book_player, child_hash))))
+    return found
+
+class Prefetcher(object):
+    '''Runs a visitor of board/move pairs in a background thread, keeping up to
+    size of its pairs in a queue, so that the next one is ready when asked for 
+    (the search can be slow in sparse parts of a giant tree).
+
+    Pairs are queued along with the values of their entry in player's 
+    repertoire (the tactics if player is None), and are skipped when taken from
+    the queue if the entry changed in the meantime (for example, if it was 
+    reviewed as part of a line). Use it like the visitor itself, and close it
+    when done.'''
+    def __init__(self, visitor, player, size=G.PREFETCH_SIZE):
+        self.player = player
+        self.queue = queue.Queue(size)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.produce, args=(visitor,), daemon=True)
+        self.thread.start()
+
+    def entry_values(self, board, move):
+        return list(map(lambda location : (location[2].weight, location[2].learn),
+                        G.rep.single_location(self.player, board, move)))
+
+    def put(self, item):
+        '''Queues an item, waiting for room, and returns False if closed meanwhile.'''
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self, visitor):
+        try:
+            for b, m in visitor:
+                if not self.put((b, m, self.entry_values(b, m))):
+                    return
+        except Exception as e:
+            # Raised again in the thread taking the items
+            self.put(e)
+            return
+        self.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.put(None)
+                raise StopIteration
+            if isinstance(item, Exception):
+                raise item
+            b, m, values = item
+            if self.entry_values(b, m) == values:
+                return b, m
+
+    def close(self):
+        self.closed.set()
 
 def rep_visitor(board, player=None, only_sr=False, return_entry=False):
     '''Visits repertoire nodes that are children of given board in dfs.
     Returns board/move pairs for player.'''
-    visited_hashes = set()
-    def rep_visitor(board, player=None, only_sr=False, return_entry=False):
-        # In case of originally given node being repeated later on in search tree
-        # For other nodes, this is redundant due to loop below
-        hashValue = chess.polyglot.zobrist_hash(board)
-        visited_hashes.add(hashValue)
-        subrep = G.rep.get_mmrw(player, board.turn)
-        for entry in subrep.find_all(board):
-            child_board = board.copy()
-            child_board.push(entry.move)
-            child_hash = chess.polyglot.zobrist_hash(child_board)
-            if child_hash not in visited_hashes:
-                if (board.turn == player or player == None) and \
-                    (only_sr == False or \
-                    (entry.learn > 0 and \
-                    (return_entry == True or entry.learn <= int(time.time() / 60)))):
-                    if not return_entry:
-                        yield board.copy(), entry.move
-                    else:
-                        yield board.copy(), entry.move, entry
-                board.push(entry.move)
-                yield from rep_visitor(board.copy(), player, only_sr, return_entry)
-                board.pop()
-
-    return rep_visitor(board, player, only_sr, return_entry)
-
-# Incomplete
-def batch_rep_visitor(board, player=None, only_sr=False, return_entry=False):
-    def batch_rep_visitor(board, player=None, only_sr=False, return_entry=False):
-        count = 0
-        while True:
-            yield from rep_visitor(board, player, only_sr, return_entry)
-            count += 1
-    
+    visitor = tree_visitor(board, player, player, only_sr, return_entry, set())
+    if only_sr and not return_entry:
+        return until_nothing_due(visitor, player)
+    return visitor
+
+def until_nothing_due(visitor, player):
+    '''Stops a visitor of due board/move pairs as soon as it has yielded as many
+    pairs as the due index of player's repertoire (the tactics if player is None)
+    had due entries when the visit started, instead of visiting the rest of the
+    repertoire for nothing. The visitor only yields due pairs, so counting them
+    is enough (problems becoming due during the visit are left for the next one).'''
+    remaining = G.rep.count_due(player, int(time.time() / 60))
+    if remaining == 0:
+        return
+    yielded = set()
+    for b, m in visitor:
+        yield b, m
+        pair = (chess.polyglot.zobrist_hash(b), moveToBits(m))
+        if pair not in yielded:
+            yielded.add(pair)
+            remaining -= 1
+            if remaining == 0:
+                return
+
+def batch_rep_visitor(board, player, batch_size, return_entry=False):
+    '''Returns board/move pairs for the batch_size entries of player's repertoire 
+    due first among those that are due now and can be reached from board.
+
+    The whole batch is found up front with the due index and the repertoire 
+    graph (see schedule_lines), so no traversal is needed while answering. The
+    pairs are ordered by their lines, so that lines with moves in common come
+    one after the other, and setup_ot_mode rarely needs to restart a line.'''
+    lines = schedule_lines(board, player, batch_size, before=int(time.time() / 60))
+    lines.sort(key=lambda line : list(map(moveToBits, line[1].move_stack)) + [moveToBits(line[0].move)])
+    for entry, b in lines:
+        if not return_entry:
+            yield b, entry.move
+        else:
+            yield b, entry.move, entry
+
 def tactics_visitor(board=None, only_sr=False, return_entry=False, **kw):
     '''Visits tactics repertoire nodes that are either the exercises starting from
     the given initial position, or visits all tactics repertoire nodes
@@ -58,24 +196,7 @@ def tactics_visitor(board=None, only_sr=False, return_entry=False, **kw):
     visited_hashes = set()
 
     def exercise_visitor(board, player, only_sr=False, return_entry=False):
-        hashValue = chess.polyglot.zobrist_hash(board)
-        visited_hashes.add(hashValue)
-        for entry in G.rep.t.find_all(board):
-            child_board = board.copy()
-            child_board.push(entry.move)
-            child_hash = chess.polyglot.zobrist_hash(child_board)
-            if child_hash not in visited_hashes:
-                if board.turn == player and \
-                    (only_sr == False or \
-                    (entry.learn > 0 and \
-                    (return_entry == True or entry.learn <= int(time.time() / 60)))):
-                    if not return_entry:
-                        yield board.copy(), entry.move
-                    else:
-                        yield board.copy(), entry.move, entry
-                board.push(entry.move)
-                yield from exercise_visitor(board.copy(), player, only_sr, return_entry)
-                board.pop()
+        return tree_visitor(board, player, None, only_sr, return_entry, visited_hashes)
 
     def tactics_visitor(board=None, only_sr=False, return_entry=False):
         if board != None:
@@ -93,6 +214,8 @@ def tactics_visitor(board=None, only_sr=False, return_entry=False, **kw):
             for b in G.rep.initial_positions:
                 yield from exercise_visitor(b, b.turn, only_sr, return_entry)
 
+    if only_sr and not return_entry:
+        return until_nothing_due(tactics_visitor(board, only_sr, return_entry), None)
     return tactics_visitor(board, only_sr, return_entry)
 
 
@@ -116,7 +239,8 @@ def quickselect(f, k, l, left=0, right=-1):
     with the elements to the less being less and the elements to the right being more.'''
     if right == -1:
         right = len(l) - 1 # Quick hack since default argument can't depend on l
-    if left == right:
+    if left >= right:
+        # At most one element (none for an empty list)
         return
     pivotIndex = random.randint(left, right)
     pivotIndex = quickselect_partition(f, l, left, right, pivotIndex)
@@ -133,48 +257,87 @@ def clear_orphaned_learn_values(player, only_print=True):
     # Partially for these reasons, this is not currently tied to a callback,
     # and can only be used manually.
     start_time = int(time.time() / 60)
-    entries_and_boards = get_learning_schedule(chess.Board(), player, 0, True)
-    hashes_set = set(map(lambda x : (x[0].key, x[0].raw_move), entries_and_boards))
+    boards = G.rep.graph_roots(player)
+    # Every edge below the roots needs its child, or what lies past it would count as orphaned
+    with G.rep.graph_lookup(player, boards) as graph:
+        distance, _ = graph.bfs(list(map(chess.polyglot.zobrist_hash, boards)))
+        reachable = graph.nodes[distance >= 0]
     subrep = G.rep.ww if player == chess.WHITE else (G.rep.bb if player == chess.BLACK else G.rep.t)
     counter = 0
-    for i, entry in enumerate(subrep):
-        if (entry.key, entry.raw_move) not in hashes_set and entry.learn > 0:
-            counter += 1
-            if not only_print:
-                subrep[i] = chess.polyglot.Entry(entry.key, entry.raw_move, entry.weight, 0, 0)
+    with subrep.lock:
+        views = subrep.views()
+        for segment, array in views:
+            orphans = numpy.nonzero((array['learn'] > 0) & ~numpy.isin(array['key'].astype(numpy.uint64), reachable))[0]
+            counter += len(orphans)
+            if only_print:
+                for key in array['key'][orphans]:
+                    print(key)
+            elif segment is subrep:
+                # Writes straight through to the book
+                array['learn'][orphans] = 0
             else:
-                print(entry.key)
+                for i in orphans:
+                    entry = segment[int(i)]
+                    segment[int(i)] = chess.polyglot.Entry(entry.key, entry.raw_move, entry.weight, 0, 0)
+        views = array = None
+        if not only_print:
+            subrep.learning_changed()
     print("%d changes%s." % (counter, "" if only_print else " made"))
 
 def repeated_nodes(subrep):
     # Just for debugging
-    # If order can be counted on, it is much faster to implement a uniq style alg
-    hashes_set = set()
-    for entry in subrep:
-        if (entry.key, entry.raw_move) in hashes_set and entry.learn > 0:
-            print(entry)
-            for entry2 in subrep:
-                if (entry2.key, entry2.raw_move) == (entry.key, entry.raw_move):
-                    print(entry2)
+    groups = {}
+    with subrep.lock.shared():
+        array = subrep.view()
+        _, inverse, counts = numpy.unique(mmrw.entry_pairs(array), return_inverse=True, return_counts=True)
+        for i in numpy.nonzero(counts[inverse] > 1)[0]:
+            groups.setdefault(inverse[i], []).append(subrep[int(i)])
+        array = None
+    for group in groups.values():
+        if any(map(lambda e : e.learn > 0, group)):
+            for entry in group:
+                print(entry)
             print("---")
-        hashes_set.add((entry.key, entry.raw_move))
 
-def flat_rep_visitor(player):
-    if player == chess.WHITE:
-        subrep = G.rep.ww
-    elif player == chess.BLACK:
-        subrep = G.rep.bb
-    else:
-        subrep = G.rep.t
-    for entry in subrep:
-        if entry.learn > 0:
-            yield entry
+def flat_rep_visitor(player, due_before=None):
+    '''Visits the entries set to learn (and due before the given time in minutes
+    after the epoch, if one is given) in player's repertoire in due order, 
+    without any tree traversal.'''
+    yield from G.rep.due_entries(player, before=due_before)
+
+def schedule_lines(board, player, max_lines, before=None):
+    '''Returns (entry, board) pairs for the max_lines entries of player's repertoire
+    due first among those that can be reached from board (and are due at or 
+    before the given time, if one is given), in due order. The boards are found
+    with the repertoire graph (see Repertoire.graph).'''
+    result = []
+    with G.rep.graph_lookup(player, [board]) as graph:
+        distance, parent_edge = graph.bfs([chess.polyglot.zobrist_hash(board)])
+        for entry in G.rep.due_entries(player, before=before):
+            if len(result) >= max_lines:
+                break
+            node = graph.node_index(entry.key)
+            if node < 0 or distance[node] < 0:
+                continue
+            b = board.copy()
+            try:
+                for raw_move in graph.path(parent_edge, node):
+                    b.push(normalizeMove(b, decode_move(raw_move)))
+                move = normalizeMove(b, entry.move)
+            except ValueError:
+                # Not legal moves, so a hash collision
+                continue
+            result.append((entry._replace(move=move), b))
+    return result
 
 def get_learning_schedule(board, player, max_lines=100, must_use_tree_visitor=False):
     startTime = time.time()
     entries_and_boards = []
     # Get spaced repetition entries
-    if max_lines > 0 or must_use_tree_visitor:
+    if max_lines > 0 and not must_use_tree_visitor and player != None:
+        # The due index has the answer, and the graph the lines
+        entries_and_boards = schedule_lines(board, player, max_lines)
+    elif max_lines > 0 or must_use_tree_visitor:
         if player != None:
             visitor = rep_visitor(board, player, only_sr=True, return_entry=True)
         else:
@@ -0,0 +1,250 @@
+# repertoire_graph.py
+
+'''Repertoires as graphs of positions, for traversals and statistics that
+do not need to look at the books themselves.'''
+
+import numpy
+import global_variables as G
+
+class RepertoireGraph(object):
+    '''The positions of a repertoire and the book moves between them, in
+    compressed sparse row form. Positions are nodes, so transpositions are
+    merged.
+
+    nodes: sorted array of position hashes (every position with a book move,
+           and every position a book move leads to)
+    indptr: the edges (book moves) of node i are indptr[i]:indptr[i + 1]
+    edge_source, edge_child: node indices, with -1 as the child of an edge
+                             whose child hash is not known
+    edge_raw_move, edge_weight, edge_learn: the values of the book entries
+
+    Edits that only change values are made in place. Other edits go to an
+    overlay (self.removed, a set of (key, raw move) pairs, and self.added,
+    lists of (raw move, child hash, weight, learn) tuples keyed by position
+    hash) until there are G.GRAPH_OVERLAY_LIMIT of them, at which point the
+    arrays are rebuilt (see compact). Traversals of the whole graph
+    (bfs, ancestors) compact first.
+
+    self.versions is for the owner, to tell whether the graph is up to date.'''
+    def __init__(self, keys, raw_moves, weights, learns, children):
+        '''Builds the graph from columns of entries, with 0 for unknown child hashes.'''
+        self.versions = None
+        self.removed = set()
+        self.added = {}
+        self.overlay_size = 0
+        order = numpy.lexsort((raw_moves, keys))
+        keys, raw_moves, weights, learns, children = keys[order], raw_moves[order], weights[order], learns[order], children[order]
+        # Drop repeated (key, raw move) pairs, keeping the first
+        keep = numpy.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (raw_moves[1:] != raw_moves[:-1])
+        keys, raw_moves, weights, learns, children = keys[keep], raw_moves[keep], weights[keep], learns[keep], children[keep]
+
+        self.nodes = numpy.unique(numpy.concatenate([keys, children[children != 0]]))
+        self.edge_source = numpy.searchsorted(self.nodes, keys)
+        self.indptr = numpy.zeros(len(self.nodes) + 1, dtype=numpy.int64)
+        self.indptr[1:] = numpy.cumsum(numpy.bincount(self.edge_source, minlength=len(self.nodes)))
+        self.edge_child = numpy.where(children != 0, numpy.searchsorted(self.nodes, children), -1)
+        self.edge_raw_move = raw_moves
+        self.edge_weight = weights
+        self.edge_learn = learns
+
+    @classmethod
+    def for_arrays(cls, arrays):
+        '''Builds the graph from (array, child_hash) pairs, where array is a numpy
+        array of entries (see ENTRY_DTYPE) and child_hash(key, raw move) returns
+        the child hash of an entry, or None if it is not known.'''
+        columns = [[], [], [], [], []]
+        for array, child_hash in arrays:
+            keys = array['key'].astype(numpy.uint64)
+            raw_moves = array['raw_move'].astype(numpy.uint16)
+            columns[0].append(keys)
+            columns[1].append(raw_moves)
+            columns[2].append(array['weight'].astype(numpy.uint16))
+            columns[3].append(array['learn'].astype(numpy.uint32))
+            children = map(lambda pair : child_hash(*pair) or 0, zip(keys.tolist(), raw_moves.tolist()))
+            columns[4].append(numpy.fromiter(children, dtype=numpy.uint64, count=len(keys)))
+        dtypes = [numpy.uint64, numpy.uint16, numpy.uint16, numpy.uint32, numpy.uint64]
+        return cls(*[numpy.concatenate(column) if len(column) > 0 else numpy.zeros(0, dtype=dtype) for column, dtype in zip(columns, dtypes)])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node_index(self, key):
+        '''Returns the index of the node with the given hash, or -1 if there is none.'''
+        index = int(numpy.searchsorted(self.nodes, key))
+        if index < len(self.nodes) and int(self.nodes[index]) == key:
+            return index
+        return -1
+
+    def edge_index(self, key, raw_move):
+        '''Returns the index of the edge of the given entry in the arrays, or -1
+        if it is not there (it may still be in the overlay).'''
+        if (key, raw_move) in self.removed:
+            return -1
+        index = self.node_index(key)
+        if index < 0:
+            return -1
+        start = int(self.indptr[index])
+        moves = self.edge_raw_move[start:int(self.indptr[index + 1])].tolist()
+        return start + moves.index(raw_move) if raw_move in moves else -1
+
+    def successors(self, key):
+        '''Returns a (raw move, child hash, weight, learn) tuple for each book move
+        of the position with the given hash. Unknown child hashes are None.'''
+        result = []
+        index = self.node_index(key)
+        if index >= 0:
+            start, end = int(self.indptr[index]), int(self.indptr[index + 1])
+            children = self.edge_child[start:end].tolist()
+            for raw_move, child, weight, learn in zip(self.edge_raw_move[start:end].tolist(), children,
+                                                      self.edge_weight[start:end].tolist(), self.edge_learn[start:end].tolist()):
+                if len(self.removed) > 0 and (key, raw_move) in self.removed:
+                    continue
+                result.append((raw_move, int(self.nodes[child]) if child >= 0 else None, weight, learn))
+        result.extend(self.added.get(key, []))
+        return result
+
+    def add_edge(self, key, raw_move, weight, learn, child=None):
+        '''Adds a book move, unless it is already in the graph.'''
+        if self.edge_index(key, raw_move) >= 0 or any(map(lambda edge : edge[0] == raw_move, self.added.get(key, []))):
+            return
+        self.added.setdefault(key, []).append((raw_move, child, weight, learn))
+        self.overlay_changed()
+
+    def remove_edges(self, key, raw_move=None):
+        '''Removes the book moves of a position (only raw_move if it is given).'''
+        for edge in self.successors(key):
+            if raw_move == None or edge[0] == raw_move:
+                if self.edge_index(key, edge[0]) >= 0:
+                    self.removed.add((key, edge[0]))
+        if key in self.added:
+            self.added[key] = list(filter(lambda edge : raw_move != None and edge[0] != raw_move, self.added[key]))
+        self.overlay_changed()
+
+    def set_values(self, key, raw_move, weight, learn):
+        index = self.edge_index(key, raw_move)
+        if index >= 0:
+            self.edge_weight[index] = weight
+            self.edge_learn[index] = learn
+        else:
+            self.added[key] = list(map(lambda edge : (edge[0], edge[1], weight, learn) if edge[0] == raw_move else edge, self.added.get(key, [])))
+
+    def set_child(self, key, raw_move, child):
+        index = self.edge_index(key, raw_move)
+        child_index = self.node_index(child)
+        if index >= 0 and child_index >= 0:
+            self.edge_child[index] = child_index
+        elif index >= 0:
+            # The child is a new node, so the edge moves to the overlay
+            weight, learn = int(self.edge_weight[index]), int(self.edge_learn[index])
+            self.removed.add((key, raw_move))
+            self.added.setdefault(key, []).append((raw_move, child, weight, learn))
+            self.overlay_changed()
+        else:
+            self.added[key] = list(map(lambda edge : (edge[0], child, edge[2], edge[3]) if edge[0] == raw_move else edge, self.added.get(key, [])))
+
+    def overlay_changed(self):
+        self.overlay_size += 1
+        if self.overlay_size >= G.GRAPH_OVERLAY_LIMIT:
+            self.compact()
+
+    def compact(self):
+        '''Rebuilds the arrays with the edits in the overlay.'''
+        if self.overlay_size == 0:
+            return
+        keep = numpy.ones(len(self.edge_source), dtype=bool)
+        if len(self.removed) > 0:
+            keys = self.nodes[self.edge_source].tolist()
+            keep = numpy.fromiter(map(lambda pair : pair not in self.removed, zip(keys, self.edge_raw_move.tolist())), dtype=bool, count=len(keys))
+        added = [(key,) + edge for key, edges in self.added.items() for edge in edges]
+        columns = [
+            [self.nodes[self.edge_source[keep]], numpy.array(list(map(lambda edge : edge[0], added)), dtype=numpy.uint64)],
+            [self.edge_raw_move[keep], numpy.array(list(map(lambda edge : edge[1], added)), dtype=numpy.uint16)],
+            [self.edge_weight[keep], numpy.array(list(map(lambda edge : edge[3], added)), dtype=numpy.uint16)],
+            [self.edge_learn[keep], numpy.array(list(map(lambda edge : edge[4], added)), dtype=numpy.uint32)],
+            [numpy.where(self.edge_child[keep] >= 0, self.nodes[numpy.maximum(self.edge_child[keep], 0)], 0),
+             numpy.array(list(map(lambda edge : edge[2] or 0, added)), dtype=numpy.uint64)]]
+        versions = self.versions
+        self.__init__(*map(numpy.concatenate, columns))
+        self.versions = versions
+
+    def expand(self, frontier):
+        '''Returns the indices of the edges of the given nodes.'''
+        starts, ends = self.indptr[frontier], self.indptr[frontier + 1]
+        counts = ends - starts
+        if counts.sum() == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        # Each edge index is its node's start plus its rank among the node's edges
+        offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+        return offsets + numpy.arange(counts.sum())
+
+    def bfs(self, keys):
+        '''Breadth first search from the nodes with the given hashes. Returns the
+        distance of every node from the closest of them (-1 if unreachable) and
+        the edge through which each node was first reached (-1 for the start
+        nodes and unreachable ones).'''
+        self.compact()
+        distance = numpy.full(len(self.nodes), -1, dtype=numpy.int64)
+        parent_edge = numpy.full(len(self.nodes), -1, dtype=numpy.int64)
+        frontier = numpy.array(list(filter(lambda index : index >= 0, map(self.node_index, keys))), dtype=numpy.int64)
+        distance[frontier] = 0
+        level = 0
+        while len(frontier) > 0:
+            edges = self.expand(frontier)
+            children = self.edge_child[edges]
+            new = (children >= 0) & (distance[numpy.maximum(children, 0)] == -1)
+            edges, children = edges[new], children[new]
+            # Keep the first edge to reach each child
+            children, first = numpy.unique(children, return_index=True)
+            level += 1
+            distance[children] = level
+            parent_edge[children] = edges[first]
+            frontier = children
+        return distance, parent_edge
+
+    def path(self, parent_edge, node):
+        '''Returns the raw moves leading to a node, using the parent edges of a bfs.'''
+        moves = []
+        while parent_edge[node] >= 0:
+            edge = parent_edge[node]
+            moves.append(int(self.edge_raw_move[edge]))
+            node = self.edge_source[edge]
+        moves.reverse()
+        return moves
+
+    def learning_ancestors(self):
+        '''Returns the set of hashes of the nodes from which an entry set to learn
+        might be reached. Child hashes are stored lazily, so what lies past an
+        edge with an unknown child is not known, and its source counts as well.'''
+        self.compact()
+        mask = numpy.zeros(len(self.nodes), dtype=bool)
+        mask[self.edge_source[(self.edge_learn > 0) | (self.edge_child < 0)]] = True
+        return set(self.nodes[self.ancestors(mask)].tolist())
+
+    def incomplete_ancestors(self):
+        '''Returns the set of hashes of the nodes from which an edge with an
+        unknown child might be reached.'''
+        self.compact()
+        mask = numpy.zeros(len(self.nodes), dtype=bool)
+        mask[self.edge_source[self.edge_child < 0]] = True
+        return set(self.nodes[self.ancestors(mask)].tolist())
+
+    def ancestors(self, mask):
+        '''Returns a mask of the nodes from which some node in the given mask of
+        nodes can be reached (including those nodes themselves).'''
+        self.compact()
+        result = mask.copy()
+        # Edges sorted by child, to go up the graph
+        known = numpy.nonzero(self.edge_child >= 0)[0]
+        order = known[numpy.argsort(self.edge_child[known], kind='stable')]
+        sorted_children = self.edge_child[order]
+        frontier = numpy.nonzero(mask)[0]
+        while len(frontier) > 0:
+            starts = numpy.searchsorted(sorted_children, frontier, side='left')
+            ends = numpy.searchsorted(sorted_children, frontier, side='right')
+            counts = ends - starts
+            edges = order[numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())]
+            parents = numpy.unique(self.edge_source[edges])
+            frontier = parents[~result[parents]]
+            result[frontier] = True
+        return result
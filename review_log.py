@@ -0,0 +1,125 @@
+# review_log.py
+
+'''A log of every spaced repetition answer, for statistics and for tuning the
+scheduling of reviews (see spaced_repetition.py), which only keeps the latest
+state of each problem.'''
+
+import os, mmap, time, contextlib, numpy
+import global_variables as G
+
+# Values of the 'book' field
+WHITE_BOOK, BLACK_BOOK, TACTICS_BOOK = 0, 1, 2
+
+def book_number(player):
+    '''The 'book' field of the reviews of player's repertoire (the tactics if player is None).'''
+    if player == None:
+        return TACTICS_BOOK
+    return WHITE_BOOK if player else BLACK_BOOK
+
+class ReviewLog(object):
+    '''An append-only file of fixed width records, one per answer:
+
+    time: when the answer was given, in seconds after the epoch
+    key, raw_move: the repertoire entry reviewed
+    book: whose repertoire the entry is in (see book_number)
+    q: quality of the answer, from 0 to 5 (see update_spaced_repetition_values)
+    errors: number of incorrect answers before the correct one
+    latency: time taken to answer, in milliseconds
+
+    Records are buffered, and written G.REVIEW_LOG_BUFFER at a time (or on
+    flush, which Repertoire does when the transaction of the answers commits)
+    with single appends, so that several processes can share the log.
+    For reading, the file is memory-mapped as a numpy array (see records),
+    which the query functions below work on.'''
+    RECORD_DTYPE = numpy.dtype([('time', '>u4'), ('key', '>u8'), ('raw_move', '>u2'), ('book', 'u1'),
+                                ('q', 'u1'), ('errors', 'u1'), ('latency', '>u4')])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.buffer = []
+
+    def append(self, key, raw_move, book, q, errors, latency, timestamp=None):
+        '''Logs an answer, with latency in seconds.'''
+        if timestamp == None:
+            timestamp = time.time()
+        self.buffer.append((int(timestamp), key, raw_move, book, q, min(errors, 255), int(latency * 1000)))
+        if len(self.buffer) >= G.REVIEW_LOG_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            os.write(self.fd, numpy.array(self.buffer, dtype=self.RECORD_DTYPE).tobytes())
+            self.buffer = []
+
+    @contextlib.contextmanager
+    def records(self):
+        '''Gives the records logged so far in a with statement, as a read-only
+        numpy array over the file, which is unmapped at the end of it. Drop the
+        array, and any views of it, before then (copies can be kept).'''
+        self.flush()
+        size = os.fstat(self.fd).st_size
+        # A partially written record, if any, is left out
+        count = size // self.RECORD_DTYPE.itemsize
+        if count == 0:
+            yield numpy.zeros(0, dtype=self.RECORD_DTYPE)
+            return
+        mapping = mmap.mmap(self.fd, count * self.RECORD_DTYPE.itemsize, access=mmap.ACCESS_READ)
+        try:
+            yield numpy.frombuffer(mapping, dtype=self.RECORD_DTYPE)
+        finally:
+            try:
+                mapping.close()
+            except BufferError:
+                # Views are still in use, so it is unmapped once they are all gone
+                pass
+
+    def __len__(self):
+        return os.fstat(self.fd).st_size // self.RECORD_DTYPE.itemsize + len(self.buffer)
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+def select(records, book=None, since=None):
+    '''The records of a book (see book_number), and at or after a time, if given.'''
+    mask = numpy.ones(len(records), dtype=bool)
+    if book != None:
+        mask &= records['book'] == book
+    if since != None:
+        mask &= records['time'] >= since
+    return records[mask]
+
+def retention(records):
+    '''The fraction of answers that were correct the first time (q of at least 3).'''
+    if len(records) == 0:
+        return 0.0
+    return float(numpy.count_nonzero(records['q'] >= 3)) / len(records)
+
+def failure_rates(records, min_reviews=1):
+    '''Returns the keys, raw moves, number of reviews and failure rates of the
+    entries reviewed at least min_reviews times, highest failure rate first.'''
+    keys, raw_moves = records['key'].astype(numpy.uint64), records['raw_move'].astype(numpy.uint16)
+    order = numpy.lexsort((raw_moves, keys))
+    keys, raw_moves, failed = keys[order], raw_moves[order], (records['q'][order] < 3).astype(numpy.int64)
+    # Start of each group of records of the same entry
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (raw_moves[1:] != raw_moves[:-1])
+    starts = numpy.flatnonzero(first)
+    reviews = numpy.diff(numpy.append(starts, len(keys)))
+    rates = numpy.add.reduceat(failed, starts) / reviews if len(starts) > 0 else numpy.zeros(0)
+    selected = numpy.nonzero(reviews >= min_reviews)[0]
+    selected = selected[numpy.argsort(-rates[selected], kind='stable')]
+    return keys[starts[selected]], raw_moves[starts[selected]], reviews[selected], rates[selected]
+
+def daily_workload(records, utc_offset=None):
+    '''Returns the days (as dates in numpy's datetime64[D]) with answers, along
+    with the number of answers and the seconds spent answering each of those days.
+    Days are in local time unless a UTC offset (in seconds) is given.'''
+    if utc_offset == None:
+        utc_offset = -time.timezone if time.localtime().tm_isdst == 0 else -time.altzone
+    days = (records['time'].astype(numpy.int64) + utc_offset) // 86400
+    unique, inverse = numpy.unique(days, return_inverse=True)
+    counts = numpy.bincount(inverse, minlength=len(unique))
+    seconds = numpy.bincount(inverse, weights=records['latency'] / 1000, minlength=len(unique))
+    return unique.astype('datetime64[D]'), counts, seconds
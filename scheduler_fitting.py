@@ -0,0 +1,159 @@
+# scheduler_fitting.py
+
+'''Fits the parameters of spaced repetition schedulers (see spaced_repetition.py)
+to a review log (see review_log.py), by replaying the whole log at once.
+
+The memory model is that the probability of answering a problem correctly
+decays exponentially with the time since its last review, measured in
+intervals of the scheduler: p = exp(-decay * elapsed / interval). The better
+a scheduler's intervals match how long each problem is remembered, the more
+likely the answers in the log are under the model.'''
+
+import itertools, math, numpy
+from spaced_repetition import SM2Scheduler
+
+# Values tried for each parameter by default
+DEFAULT_GRIDS = {
+    SM2Scheduler.name: {
+        'ease_penalty': [0.04, 0.08, 0.12],
+        'ease_bonus': [0.05, 0.1, 0.15],
+        'first_interval': [120, 240, 480],
+        'base_interval': [720, 1440, 2880],
+    },
+}
+
+# Fewer answers than these (fitted, and failed among them) are too few to fit the decay
+MIN_FITTED_ANSWERS = 50
+MIN_FAILED_ANSWERS = 5
+# Range of the factor applied to the intervals of the fitted scheduler
+MIN_INTERVAL_SCALE = 0.25
+MAX_INTERVAL_SCALE = 4.0
+
+class ReviewHistories(object):
+    '''The records of a review log grouped by entry, in time order.
+
+    times, q: the times (in minutes after the epoch) and qualities of the answers
+    entries: the index of the entry of each answer
+    rounds: rounds[i] is the indices (into times and q) of the i-th answer of
+            every entry with more than i answers, so that replaying round by
+            round updates all entries at once
+
+    The state of an entry before its first answer in the log is taken to be
+    that of a new problem, which is only exact for problems added after the
+    log was started.'''
+    def __init__(self, records):
+        keys, raw_moves = records['key'].astype(numpy.uint64), records['raw_move'].astype(numpy.uint16)
+        books, times = records['book'].astype(numpy.uint8), records['time'].astype(numpy.int64)
+        order = numpy.lexsort((times, raw_moves, keys, books))
+        keys, raw_moves, books = keys[order], raw_moves[order], books[order]
+        self.times = times[order] / 60
+        self.q = records['q'][order].astype(numpy.int64)
+        first = numpy.ones(len(keys), dtype=bool)
+        first[1:] = (keys[1:] != keys[:-1]) | (raw_moves[1:] != raw_moves[:-1]) | (books[1:] != books[:-1])
+        starts = numpy.flatnonzero(first)
+        self.entries = numpy.cumsum(first) - 1
+        # Rank of each answer among those of its entry
+        ranks = numpy.arange(len(keys)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(keys))))
+        order = numpy.argsort(ranks, kind='stable')
+        bounds = numpy.searchsorted(ranks[order], numpy.arange(ranks.max() + 2 if len(ranks) > 0 else 0))
+        self.rounds = [order[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+        self.num_entries = len(starts)
+
+    def __len__(self):
+        return len(self.times)
+
+def replay(scheduler, histories):
+    '''Replays the answers of the log with the scheduler, and returns the time
+    elapsed since the previous answer, the interval the scheduler had set after
+    it, and whether the answer was correct, for every answer that had a previous
+    one with a nonzero interval.'''
+    # State of each entry after its latest answer replayed so far
+    e = numpy.full(histories.num_entries, 2.5)
+    c = numpy.zeros(histories.num_entries, dtype=numpy.int64)
+    last = numpy.zeros(histories.num_entries)
+    elapsed, intervals, correct = [], [], []
+    for i, indices in enumerate(histories.rounds):
+        entries, times, q = histories.entries[indices], histories.times[indices], histories.q[indices]
+        if i > 0:
+            interval = scheduler.interval(e[entries], c[entries])
+            due = interval > 0
+            elapsed.append((times - last[entries])[due])
+            intervals.append(interval[due])
+            correct.append(q[due] >= 3)
+        e[entries], c[entries], _ = scheduler.update(e[entries], c[entries], 0, q, times)
+        last[entries] = times
+    if len(elapsed) == 0:
+        return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0, dtype=bool)
+    return numpy.concatenate(elapsed), numpy.concatenate(intervals), numpy.concatenate(correct)
+
+def log_likelihood(decay, x, correct):
+    # Answers given right after the previous one tell nothing about the decay
+    x, correct = x[x > 0], correct[x > 0]
+    p = numpy.exp(-decay * x)
+    return float(numpy.sum(numpy.where(correct, -decay * x, numpy.log(numpy.maximum(1 - p, 1e-12)))))
+
+def fit_decay(elapsed, intervals, correct):
+    '''Returns the decay maximizing the likelihood of the answers (see the module
+    docstring), or None if there are too few answers, or too few failed ones, to
+    fit (with no failures there is no finite maximum). The log likelihood is
+    concave in the decay, so Newton's method converges in a few steps.'''
+    x = elapsed / intervals
+    keep = x > 0
+    x, correct = x[keep], correct[keep]
+    failed_x = x[~correct]
+    if len(x) < MIN_FITTED_ANSWERS or len(failed_x) < MIN_FAILED_ANSWERS:
+        return None
+    correct_sum = float(numpy.sum(x[correct]))
+    # The decay that would explain the overall retention as an average
+    decay = -math.log(min(max(float(numpy.mean(correct)), 1e-3), 1 - 1e-3)) / float(numpy.mean(x))
+    for _ in range(50):
+        p = numpy.exp(-decay * failed_x)
+        first = float(numpy.sum(failed_x * p / numpy.maximum(1 - p, 1e-12))) - correct_sum
+        second = -float(numpy.sum(failed_x * failed_x * p / numpy.maximum(1 - p, 1e-12) ** 2))
+        step = -first / second if second < 0 else 0
+        # Stay positive
+        new_decay = decay + step if decay + step > 0 else decay / 2
+        if abs(new_decay - decay) <= 1e-9 * decay:
+            return new_decay
+        decay = new_decay
+    return decay
+
+def fit(records, scheduler_class=SM2Scheduler, grid=None, retention=0.9, params={}):
+    '''Tries every combination of the parameter values in grid (by default,
+    DEFAULT_GRIDS for the scheduler), on top of params, and returns the scheduler
+    whose intervals fit the answers in records best, along with a report (a dict).
+
+    The intervals of the result are then scaled so that the probability of a
+    correct answer when a problem is due is the given retention, within
+    MIN_INTERVAL_SCALE and MAX_INTERVAL_SCALE.'''
+    if grid == None:
+        grid = DEFAULT_GRIDS.get(scheduler_class.name, {})
+    histories = ReviewHistories(records)
+    best = None
+    names = list(grid.keys())
+    for values in itertools.product(*map(lambda name : grid[name], names)):
+        scheduler = scheduler_class(dict(params, **dict(zip(names, values))))
+        elapsed, intervals, correct = replay(scheduler, histories)
+        decay = fit_decay(elapsed, intervals, correct)
+        if decay == None:
+            continue
+        likelihood = log_likelihood(decay, elapsed / intervals, correct)
+        if best == None or likelihood > best[0]:
+            best = (likelihood, scheduler, decay, len(correct), float(numpy.mean(correct)))
+    if best == None:
+        return None, {'answers': len(histories), 'entries': histories.num_entries}
+    likelihood, scheduler, decay, count, observed = best
+    # A problem is due when elapsed equals the (scaled) interval, so exp(-decay * scale) = retention
+    scale = min(max(-math.log(retention) / decay, MIN_INTERVAL_SCALE), MAX_INTERVAL_SCALE)
+    scheduler.params['interval_scale'] = scheduler.params.get('interval_scale', 1.0) * scale
+    report = {
+        'answers': len(histories),
+        'entries': histories.num_entries,
+        'answers_fitted': count,
+        'log_likelihood': likelihood,
+        'decay': decay,
+        'observed_retention': observed,
+        'retention_when_due_before_scaling': math.exp(-decay),
+        'interval_scale': scale,
+    }
+    return scheduler, report
@@ -11,40 +11,92 @@
 # more or less (probably less) efficient. Hopefully, though, it is 
 # also more tailored for chess openings. 
 
-import time
+import time, json, numpy
+
+class Scheduler(object):
+    '''Base class of the algorithms scheduling reviews, which define the methods
+    below. The state of a problem is its e (easiness, from 1 to 3.047) and c
+    (from 0 to 15) values, whose meaning is up to the scheduler, and n, the next
+    time to train it (see read_values).
+
+    name: the key of the scheduler in SCHEDULERS
+    params: dictionary of the parameters of the scheduler (see save_scheduler)
+    update(e, c, n, q, now): returns the new e, c and n values after an answer 
+                             of quality q (from 0 to 5) given at time now (in
+                             minutes after the epoch)
+    interval(e, c): the number of minutes after a review that leaves a problem
+                    with the given e and c values that it is due
+
+    Both methods should work on numpy arrays as well as numbers, so that whole
+    books and review logs can be handled at once (see scheduler_fitting.py).'''
+    name = None
+    DEFAULT_PARAMS = {}
+
+    def __init__(self, params={}):
+        self.params = dict(self.DEFAULT_PARAMS)
+        self.params.update(params)
+
+class SM2Scheduler(Scheduler):
+    '''The blend of SM-2 and chessable's starting intervals described above, where
+    c is the number of consecutive correct answers.'''
+    name = 'sm2'
+    DEFAULT_PARAMS = {
+        'ease_bonus': 0.1, # Change of e after a perfect answer
+        'ease_penalty': 0.08, # Further change of e per point of q below 5
+        'ease_penalty_growth': 0.02, # And per squared point of q below 5
+        'ease_min': 1.1,
+        'ease_max': 2.5,
+        'first_interval': 240, # In minutes, after the first correct answer in a row
+        'base_interval': 1440, # In minutes, after the second one (multiplied by e after each following one)
+        'max_interval': 1440 * 365, # So that everything is reviewed at least once per year
+        'interval_scale': 1.0, # Multiplier of all intervals
+    }
+
+    def update(self, e, c, n, q, now):
+        p = self.params
+        e = numpy.clip(e + p['ease_bonus'] - (5 - q) * (p['ease_penalty'] + (5 - q) * p['ease_penalty_growth']), p['ease_min'], p['ease_max'])
+        c = numpy.where(q >= 3, numpy.minimum(c + 1, 15), 0)
+        # Otherwise, c is 0, and the problem should be repeated now
+        n = numpy.floor(now + self.interval(e, c)).astype(numpy.int64)
+        return e, c, n
+
+    def interval(self, e, c):
+        p = self.params
+        later = numpy.minimum(p['interval_scale'] * p['base_interval'] * numpy.power(e, numpy.maximum(c, 2) - 2.0), p['max_interval'])
+        return numpy.where(c >= 2, later, numpy.where(c == 1, numpy.minimum(p['interval_scale'] * p['first_interval'], p['max_interval']), 0.0))
+
+SCHEDULERS = {SM2Scheduler.name : SM2Scheduler}
+
+# The scheduler used by update_spaced_repetition_values
+scheduler = SM2Scheduler()
+
+def set_scheduler(new_scheduler):
+    global scheduler
+    scheduler = new_scheduler
+
+def get_scheduler():
+    return scheduler
+
+def save_scheduler(scheduler, filename):
+    with open(filename, 'w') as fil:
+        json.dump({'name': scheduler.name, 'params': scheduler.params}, fil, indent=2)
+
+def load_scheduler(filename):
+    # Returns the scheduler saved in a file, or None if there is none
+    try:
+        with open(filename) as fil:
+            saved = json.load(fil)
+    except FileNotFoundError:
+        return None
+    return SCHEDULERS[saved['name']](saved['params'])
 
 def update_spaced_repetition_values(e, c, n, q):
     # e - easiness
     # c - previous number of consecutive correct answers (before this update)
     # n - next time to train, given in minutes after unix epoch
     # q - quality of answer in attempt, from 0-5
-
-    # Update e
-    e += 0.1 - (5 - q) * (0.08 + (5 - q) * 0.02)
-    if e < 1.1: e = 1.1
-    if e > 2.5: e = 2.5
-
-    # Update c
-    if q >= 3:
-        c += 1
-        if c > 15: c = 15
-    else:
-        c = 0
-
-    # Update n
-    now = time.time() / 60
-    if q >= 3 and c >= 2:
-        n = int(now + 1440 * e ** (c - 2))
-        # Max 1 year interval, so that everything is reviewed at least once per year
-        if n > now + 1440 * 365:
-            n = int(now + 1440 * 365)
-    elif c == 1:
-        n = int(now + 240)
-    else:
-        # Otherwise, c is 0, and the problem should be repeated now
-        n = int(now)
-
-    return e, c, n
+    e, c, n = scheduler.update(e, c, n, q, time.time() / 60)
+    return float(e), int(c), int(n)
 
 def read_values(bits):
     # Parses e, c, and n values from polyglot binary data
@@ -73,3 +125,53 @@ def export_values(e, c, n):
 
     return (e_steps << 4) | c, n
 
+
+# Vectorized versions of the above, for changing the learning data of whole 
+# books at once (see Repertoire.transform_learning). A transform takes numpy
+# arrays of e, c and n values and returns new ones.
+
+def read_value_arrays(weights, learns):
+    # Parses arrays of e, c, and n values from arrays of weight and learn values
+    weights = weights.astype(numpy.int64)
+    return 1 + (weights >> 4) * 0.001, weights & 15, learns.astype(numpy.int64)
+
+def export_value_arrays(e, c, n):
+    # Exports arrays of values into weight and learn arrays
+    # Unlike export_values, e is rounded, so that values read and exported are unchanged
+    e_steps = numpy.clip(numpy.rint((e - 1) / 0.001).astype(numpy.int64), 0, 2047)
+    c = numpy.clip(c, 0, 15)
+    # A learn value of 0 would mean the entry is not set to learn
+    n = numpy.clip(n, 1, 2 ** 32 - 1)
+    return ((e_steps << 4) | c).astype(numpy.uint16), n.astype(numpy.uint32)
+
+def shift_due_dates(minutes):
+    # Transform moving every due date by the given number of minutes (e.g. after a vacation)
+    def transform(e, c, n):
+        return e, c, n + minutes
+    return transform
+
+def spread_backlog(minutes):
+    # Transform spreading the problems due now evenly over the next given number
+    # of minutes, keeping their order, so that the most overdue come first
+    def transform(e, c, n):
+        now = int(time.time() / 60)
+        overdue = numpy.nonzero(n <= now)[0]
+        order = overdue[numpy.argsort(n[overdue], kind='stable')]
+        n = n.copy()
+        if len(order) > 0:
+            n[order] = now + numpy.arange(len(order)) * minutes // len(order)
+        return e, c, n
+    return transform
+
+def reset_easiness(e_value=2.5):
+    # Transform setting every easiness to the given value (by default, that of new problems)
+    def transform(e, c, n):
+        return numpy.full(len(e), e_value), c, n
+    return transform
+
+def rescheduled(old_scheduler, new_scheduler):
+    # Transform moving due dates from the intervals of one scheduler to those of another,
+    # counting from the last review
+    def transform(e, c, n):
+        return e, c, n - old_scheduler.interval(e, c) + new_scheduler.interval(e, c)
+    return transform
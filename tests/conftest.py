@@ -0,0 +1,37 @@
+# conftest.py
+
+'''Fixtures shared by the tests, which are run from the repository directory
+with "python -m pytest tests".'''
+
+import os, sys, shutil, pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY not in sys.path:
+    sys.path.append(REPOSITORY)
+
+@pytest.fixture
+def repertoire_directory(tmp_path):
+    '''An empty repertoire directory, as made by makeEmptyRepertoire.'''
+    directory = tmp_path / 'repertoire'
+    (directory / 'white').mkdir(parents=True)
+    (directory / 'black').mkdir()
+    for name in ['white/white', 'white/black', 'black/white', 'black/black', 'tactics']:
+        shutil.copy(os.path.join(REPOSITORY, 'empty'), str(directory / name))
+    (directory / 'comments').touch()
+    return str(directory)
+
+@pytest.fixture
+def open_repertoire(repertoire_directory):
+    '''A function (re)opening the repertoire of repertoire_directory as G.rep,
+    closing the one open first, if any. The last one is closed at the end.'''
+    import global_variables as G
+    from mmrw import Repertoire
+    def open_repertoire():
+        if G.rep != None:
+            G.rep.close()
+        G.rep = Repertoire(repertoire_directory)
+        return G.rep
+    yield open_repertoire
+    if G.rep != None:
+        G.rep.close()
+        G.rep = None
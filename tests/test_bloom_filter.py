@@ -0,0 +1,44 @@
+# test_bloom_filter.py
+
+import os, random, numpy, chess, chess.polyglot
+from bloom_filter import BloomFilter
+from mmrw import MemoryMappedReaderWriter, Repertoire
+
+def test_filter_round_trip(tmp_path):
+    filename = str(tmp_path / 'book.bloom')
+    random.seed(0)
+    keys = numpy.array([random.getrandbits(64) for _ in range(1000)], dtype=numpy.uint64)
+    bloom = BloomFilter.for_keys(keys, 10, 4)
+    assert all(bloom.might_contain(int(key)) for key in keys)
+    stamp = (1, 2, 3, 4)
+    bloom.save(filename, stamp)
+    loaded = BloomFilter.load(filename, stamp)
+    assert loaded.num_bits == bloom.num_bits and loaded.num_hashes == bloom.num_hashes and loaded.bits == bloom.bits
+    # Saved for another version of the book
+    assert BloomFilter.load(filename, (1, 2, 3, 5)) == None
+
+def count_rebuilds(monkeypatch):
+    '''Returns the list of the filenames of the books whose filter is rebuilt from now on.'''
+    rebuilds = []
+    rebuild = MemoryMappedReaderWriter.rebuild_bloom
+    def counting(self):
+        rebuilds.append(self.filename)
+        rebuild(self)
+    monkeypatch.setattr(MemoryMappedReaderWriter, 'rebuild_bloom', counting)
+    return rebuilds
+
+def test_filters_are_saved_when_built(open_repertoire, repertoire_directory, monkeypatch):
+    rebuilds = count_rebuilds(monkeypatch)
+    rep = open_repertoire()
+    assert len(rebuilds) == 5
+    assert all(os.path.exists(mmrw.filename + '.bloom') for mmrw in rep.mmrws())
+    rep.appendWhite(chess.Board(), chess.Move.from_uci('e2e4'))
+    # Another process opening the repertoire only rebuilds the filter of the changed book
+    other = Repertoire(repertoire_directory)
+    assert rebuilds[5:] == [rep.ww.filename]
+    other.close()
+    del rebuilds[:]
+    rep = open_repertoire()
+    assert rebuilds == []
+    assert rep.ww.might_contain_key(chess.polyglot.zobrist_hash(chess.Board()))
+    assert list(rep.findMovesWhite(chess.Board())) == [chess.Move.from_uci('e2e4')]
@@ -0,0 +1,74 @@
+# test_capacity_book.py
+
+import os, shutil, random, numpy, chess, chess.polyglot
+from conftest import REPOSITORY
+from mmrw import CapacityBook, ENTRY_DTYPE, write_plain_book, is_capacity_book
+import global_variables as G
+
+def entries_array(count, seed=0):
+    random.seed(seed)
+    array = numpy.zeros(count, dtype=ENTRY_DTYPE)
+    array['key'] = sorted(random.sample(range(1, 1 << 62), count))
+    array['raw_move'] = [random.randrange(1, 1 << 12) for _ in range(count)]
+    array['weight'] = 1
+    array['learn'] = [random.choice([0, 12345]) for _ in range(count)]
+    return array
+
+def book_array(book):
+    return numpy.array([(e.key, e.raw_move, e.weight, e.learn) for e in book], dtype=ENTRY_DTYPE)
+
+def test_plain_book_is_migrated_once(tmp_path):
+    filename = str(tmp_path / 'book')
+    array = entries_array(100)
+    write_plain_book(filename, array)
+    assert not is_capacity_book(filename)
+    book = CapacityBook(filename)
+    assert is_capacity_book(filename)
+    assert numpy.array_equal(book_array(book), array)
+    assert book.capacity() >= max(len(array), G.BOOK_MIN_CAPACITY)
+    book.close()
+    # Opening it again reads the converted book as is
+    inode = os.stat(filename).st_ino
+    book = CapacityBook(filename)
+    assert os.stat(filename).st_ino == inode
+    assert numpy.array_equal(book_array(book), array)
+    book.close()
+    assert not any('tmp' in name for name in os.listdir(str(tmp_path)))
+
+def test_empty_book_loses_its_placeholder(tmp_path):
+    filename = str(tmp_path / 'book')
+    shutil.copy(os.path.join(REPOSITORY, 'empty'), filename)
+    book = CapacityBook(filename)
+    assert len(book) == 0 and list(book.find_all(chess.Board())) == []
+    book.close()
+
+def test_entries_survive_growth_and_reopening(tmp_path):
+    filename = str(tmp_path / 'book')
+    write_plain_book(filename, numpy.zeros(0, dtype=ENTRY_DTYPE))
+    array = entries_array(3 * G.BOOK_MIN_CAPACITY, seed=1)
+    book = CapacityBook(filename)
+    capacity = book.capacity()
+    entries = [chess.polyglot.Entry(int(a['key']), int(a['raw_move']), int(a['weight']), int(a['learn']), None) for a in array]
+    random.shuffle(entries)
+    book.add_entries(entries[:10])
+    book.add_entries(entries[10:])
+    assert book.capacity() > capacity
+    book.close()
+    book = CapacityBook(filename)
+    assert numpy.array_equal(book_array(book), array)
+    # Deletes only lower the number of entries
+    capacity = book.capacity()
+    book.delete_indices(range(0, len(array), 2))
+    book.close()
+    book = CapacityBook(filename)
+    assert book.capacity() == capacity and numpy.array_equal(book_array(book), array[1::2])
+    book.close()
+
+def test_export_writes_a_plain_book(tmp_path):
+    filename = str(tmp_path / 'book')
+    array = entries_array(50, seed=2)
+    write_plain_book(filename, array)
+    book = CapacityBook(filename)
+    book.export(str(tmp_path / 'plain'))
+    book.close()
+    assert numpy.array_equal(numpy.fromfile(str(tmp_path / 'plain'), dtype=ENTRY_DTYPE), array)
@@ -0,0 +1,76 @@
+# test_child_hashes.py
+
+import chess, chess.polyglot
+from child_hashes import ChildHashes
+from mmrw import makeEntry
+
+def test_records_reload_and_later_ones_win(tmp_path):
+    filename = str(tmp_path / 'book.children')
+    hashes = ChildHashes(filename)
+    hashes.add_many([(1, 2, 3), (4, 5, 6)])
+    hashes.add(1, 2, 7)
+    other = ChildHashes(filename)
+    assert other.get(1, 2) == 7 and other.get(4, 5) == 6 and other.get(8, 9) == None
+    # Appended by another process, along with half a record
+    hashes.add(8, 9, 10)
+    with open(filename, 'ab') as fil:
+        fil.write(ChildHashes.RECORD_STRUCT.pack(11, 12, 13)[:9])
+    other.load()
+    assert other.get(8, 9) == 10 and len(other) == 3
+    hashes.close()
+    other.close()
+
+def test_complete_mark_survives_reopening_and_rewrite(tmp_path):
+    filename = str(tmp_path / 'book.children')
+    hashes = ChildHashes(filename)
+    hashes.add_many([(1, 2, 3), (4, 5, 6)])
+    assert not hashes.complete
+    hashes.mark_complete()
+    hashes.mark_complete()
+    assert hashes.num_records() == 3
+    hashes.close()
+    hashes = ChildHashes(filename)
+    assert hashes.complete and len(hashes) == 2 and hashes.get(0, 0) == None
+    hashes.rewrite([(4, 5)])
+    assert hashes.complete and len(hashes) == 1 and hashes.num_records() == 2
+    hashes.close()
+    hashes = ChildHashes(filename)
+    assert hashes.complete and hashes.get(4, 5) == 6 and hashes.get(1, 2) == None
+    hashes.close()
+
+def add_line(rep, sans):
+    '''Adds a line to white's repertoire without its child hashes, as in
+    books from before child hashes were stored.'''
+    board = chess.Board()
+    for san in sans:
+        move = board.parse_san(san)
+        rep.get_mmrw(chess.WHITE, board.turn).add_entries([makeEntry(board, move)])
+        board.push(move)
+    return board
+
+def test_missing_child_hashes_are_filled_in_once(open_repertoire):
+    rep = open_repertoire()
+    add_line(rep, ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5'])
+    add_line(rep, ['d4', 'd5', 'c4'])
+    assert len(rep.ww.children) == 0 and len(rep.wb.children) == 0
+    # The start, 1. e4 e5, 1. e4 e5 2. Nf3 Nc6 and 1. d4 d5
+    assert rep.opening_size(chess.WHITE, chess.Board()) == 4
+    assert rep.ww.children.complete and rep.wb.children.complete
+    assert len(rep.ww.children) + len(rep.wb.children) == 8
+    board = chess.Board()
+    move = board.parse_san('e4')
+    board.push(move)
+    assert rep.ww.child_hash(makeEntry(chess.Board(), move)) == chess.polyglot.zobrist_hash(board)
+    rep = open_repertoire()
+    assert rep.ww.children.complete and len(rep.ww.children) + len(rep.wb.children) == 8
+
+def test_new_entries_store_their_child_hashes(open_repertoire):
+    rep = open_repertoire()
+    board = chess.Board()
+    rep.appendWhite(board, chess.Move.from_uci('e2e4'))
+    rep.append_many(chess.WHITE, [(board, chess.Move.from_uci('d2d4'))])
+    rep = open_repertoire()
+    for uci in ['e2e4', 'd2d4']:
+        child = board.copy()
+        child.push_uci(uci)
+        assert rep.ww.child_hash(makeEntry(board, chess.Move.from_uci(uci))) == chess.polyglot.zobrist_hash(child)
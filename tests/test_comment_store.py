@@ -0,0 +1,68 @@
+# test_comment_store.py
+
+import os, random, chess, chess.polyglot
+from mmrw import CommentStore
+
+def old_comments_file(filename, comments):
+    '''Writes comments (a dictionary of hash to comment) in the fixed 256 byte
+    slots used before CommentStore, with the placeholder slot of empty files.'''
+    data = b'\0' * 256
+    for key, comment in sorted(comments.items()):
+        slot = key.to_bytes(8, byteorder='big') + comment.encode('utf-8')
+        data += slot + b'\0' * (256 - len(slot))
+    with open(filename, 'wb') as fil:
+        fil.write(data)
+
+def test_old_comments_are_converted(open_repertoire, repertoire_directory):
+    old_comments_file(os.path.join(repertoire_directory, 'comments'), {5: 'five', 99: 'ninety nine é'})
+    rep = open_repertoire()
+    assert rep.get_comment(5) == 'five' and rep.get_comment(99) == 'ninety nine é' and rep.get_comment(7) == None
+    rep = open_repertoire()
+    assert rep.get_comment(5) == 'five' and len(rep.comments) == 2
+
+def test_comments_round_trip(open_repertoire):
+    rep = open_repertoire()
+    board = chess.Board()
+    # Longer than the slots of old comments files
+    rep.set_comment(board, 'start ' * 100)
+    random.seed(0)
+    comments = {chess.polyglot.zobrist_hash(board): 'start ' * 100}
+    for i in range(2000):
+        key = random.getrandbits(64) if random.random() < 0.7 else random.choice(list(comments))
+        comments[key] = 'comment %d' % i
+        rep.set_comment(key, comments[key])
+    assert all(rep.get_comment(key) == comment for key, comment in comments.items())
+    rep = open_repertoire()
+    assert len(rep.comments) == len(comments)
+    assert all(rep.get_comment(key) == comment for key, comment in comments.items())
+    rep.comments.compact()
+    rep = open_repertoire()
+    assert all(rep.get_comment(key) == comment for key, comment in comments.items())
+
+def test_other_processes_see_changes(tmp_path):
+    filename = str(tmp_path / 'comments')
+    store = CommentStore(filename)
+    other = CommentStore(filename)
+    store.set(1, 'one')
+    assert other.get(1) == 'one'
+    store.compact()
+    store.set(2, 'two')
+    assert other.get(2) == 'two' and other.get(1) == 'one'
+    other.close()
+    store.close()
+
+def test_index_is_rebuilt_from_the_heap(tmp_path):
+    filename = str(tmp_path / 'comments')
+    store = CommentStore(filename)
+    store.set(1, 'one')
+    store.close()
+    # Appended to the heap without the index, with half a record after it
+    with open(filename, 'ab') as fil:
+        fil.write(CommentStore.RECORD_STRUCT.pack(2, 3) + b'two' + CommentStore.RECORD_STRUCT.pack(3, 10) + b'th')
+    store = CommentStore(filename)
+    assert store.get(1) == 'one' and store.get(2) == 'two' and store.get(3) == None
+    store.close()
+    os.remove(filename + '.index')
+    store = CommentStore(filename)
+    assert store.get(1) == 'one' and store.get(2) == 'two' and len(store) == 2
+    store.close()
@@ -0,0 +1,67 @@
+# test_delta_segment.py
+
+import os, random, chess
+from mmrw import DeltaSegment, makeEntry
+
+def random_lines(count, seed, plies=8):
+    '''Position/move pairs of random games.'''
+    random.seed(seed)
+    pairs = []
+    for _ in range(count):
+        board = chess.Board()
+        for _ in range(plies):
+            move = random.choice(sorted(board.legal_moves, key=str))
+            pairs.append((board.copy(), move))
+            board.push(move)
+    return pairs
+
+def white_moves(rep, pairs):
+    return all(move in list(rep.findMovesWhite(board)) for board, move in pairs)
+
+def test_segment_reloads_sorted_and_drops_partial_entry(tmp_path):
+    filename = str(tmp_path / 'book.delta')
+    segment = DeltaSegment(filename)
+    entries = [makeEntry(board, move) for board, move in random_lines(3, seed=0)]
+    for entry in entries:
+        segment.add_entry(entry)
+    segment.close()
+    # An append interrupted halfway through an entry
+    with open(filename, 'ab') as fil:
+        fil.write(b'\1' * 7)
+    segment = DeltaSegment(filename)
+    assert len(segment) == len(set((e.key, e.raw_move) for e in entries))
+    assert [e.key for e in segment] == sorted(e.key for e in segment)
+    assert all(entry in segment for entry in entries)
+    assert os.path.getsize(filename) % 16 == 0
+    segment.close()
+
+def test_compaction_merges_into_the_book(open_repertoire):
+    rep = open_repertoire()
+    pairs = random_lines(10, seed=1)
+    for board, move in pairs:
+        rep.appendWhite(board, move)
+    assert len(rep.ww.delta) > 0 and white_moves(rep, pairs)
+    rep.compact()
+    assert len(rep.ww.delta) == 0 and len(rep.wb.delta) == 0
+    assert len(rep.ww) + len(rep.wb) == len(set(map(lambda pair : makeEntry(*pair)[:2], pairs)))
+    assert [e.key for e in rep.ww] == sorted(e.key for e in rep.ww)
+    assert white_moves(rep, pairs)
+    rep = open_repertoire()
+    assert len(rep.ww.delta) == 0 and white_moves(rep, pairs)
+
+def test_uncompacted_entries_survive_reopening(open_repertoire):
+    rep = open_repertoire()
+    pairs = random_lines(5, seed=2)
+    rep.append_many(chess.WHITE, pairs)
+    rep.compact()
+    more = random_lines(5, seed=3)
+    for board, move in more:
+        rep.appendWhite(board, move)
+    # Deep enough into a random game to be the only pair of its position
+    board, move = pairs[-1]
+    rep.removeWhite(board, move)
+    rep = open_repertoire()
+    assert white_moves(rep, more + pairs[:-1]) and move not in list(rep.findMovesWhite(board))
+    rep.compact()
+    rep = open_repertoire()
+    assert white_moves(rep, more + pairs[:-1]) and move not in list(rep.findMovesWhite(board))
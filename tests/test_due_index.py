@@ -0,0 +1,74 @@
+# test_due_index.py
+
+import os, random, chess, chess.polyglot
+from due_index import DueIndex
+import global_variables as G
+
+def item(learn, key, raw_move=1, weight=1):
+    return chess.polyglot.Entry(key, raw_move, weight, learn, None)
+
+def test_index_round_trip(tmp_path):
+    filename = str(tmp_path / 'book.due')
+    index = DueIndex()
+    for learn, key in [(30, 1), (10, 2), (20, 3), (10, 4)]:
+        index.add(item(learn, key))
+    index.add(item(0, 5))
+    stamp = (1, 2, 3, 4)
+    index.save(filename, stamp)
+    loaded = DueIndex.load(filename, stamp)
+    assert loaded.items == index.items and len(loaded) == 4
+    assert [e.key for e in loaded.due(20)] == [2, 4, 3] and loaded.count_due(20) == 3
+    assert [e.key for e in loaded.due(None, 2, after=loaded.due(None)[0])] == [4, 3]
+    # Saved for another version of the book
+    assert DueIndex.load(filename, (1, 2, 3, 5)) == None
+    assert DueIndex.load(str(tmp_path / 'missing.due'), stamp) == None
+
+def learnable_lines(rep, count, seed):
+    '''Adds count white moves set to learn at various times to white's repertoire.'''
+    random.seed(seed)
+    board = chess.Board()
+    added = 0
+    while added < count:
+        move = random.choice(sorted(board.legal_moves, key=str))
+        if board.turn == chess.WHITE:
+            rep.appendWhite(board, move, learn=random.randrange(1000, 2000))
+            added += 1
+        board.push(move)
+        if board.is_game_over() or len(board.move_stack) > 40:
+            board = chess.Board()
+
+def test_index_is_saved_when_built_and_loaded_on_reopening(open_repertoire):
+    rep = open_repertoire()
+    learnable_lines(rep, 20, seed=0)
+    filename = rep.ww.filename + '.due'
+    rep.ww.due = None
+    if os.path.exists(filename):
+        os.remove(filename)
+    items = rep.ww.due_index().items
+    assert os.path.exists(filename)
+    assert DueIndex.load(filename, rep.ww.file_stamp()).items == items
+    rep = open_repertoire()
+    assert rep.ww.due != None and rep.ww.due.items == items
+
+def test_stale_index_is_rebuilt(open_repertoire):
+    rep = open_repertoire()
+    learnable_lines(rep, 20, seed=1)
+    rep = open_repertoire()
+    items = list(rep.ww.due_index().items)
+    # Changed without the index being saved, as by a crash
+    learnable_lines(rep, 5, seed=2)
+    changed = list(rep.ww.due_index().items)
+    rep.ww.due = None
+    rep.close()
+    G.rep = None
+    rep = open_repertoire()
+    assert rep.ww.due_index().items == changed and len(changed) > len(items)
+
+def test_due_entries_read_in_chunks(open_repertoire):
+    rep = open_repertoire()
+    learnable_lines(rep, 3 * G.DUE_ENTRIES_CHUNK, seed=3)
+    expected = rep.ww.due_index().due(None)
+    assert list(rep.due_entries(chess.WHITE)) == expected
+    assert list(rep.due_entries(chess.WHITE, count=G.DUE_ENTRIES_CHUNK + 5)) == expected[:G.DUE_ENTRIES_CHUNK + 5]
+    before = expected[len(expected) // 2].learn
+    assert list(rep.due_entries(chess.WHITE, before=before)) == [e for e in expected if e.learn <= before]
@@ -0,0 +1,77 @@
+# test_position_index.py
+
+import os, random
+from position_index import PositionIndex, PositionIndexBuilder, convert_positions_directory
+
+def add_games(index, games, run_size):
+    '''Adds games (a dictionary of game id to hashes) to index.'''
+    builder = PositionIndexBuilder(index, run_size)
+    for game, hashes in games.items():
+        builder.add_game(game, hashes)
+    builder.finish()
+
+def expected_games(games):
+    result = {}
+    for game, hashes in games.items():
+        for key in hashes:
+            result.setdefault(key, set()).add(game)
+    return {key: sorted(ids) for key, ids in result.items()}
+
+def random_games(first, count, seed):
+    random.seed(seed)
+    # Few enough hashes that games share positions, and some repeat one
+    return {game: [random.randrange(1, 500) for _ in range(30)] for game in range(first, first + count)}
+
+def test_index_round_trip(tmp_path):
+    filename = str(tmp_path / 'positions.index')
+    index = PositionIndex(filename)
+    assert len(index) == 0 and index.games(1) == [] and index.max_game() == -1
+    games = random_games(0, 100, seed=0)
+    # Small runs, so that several are merged
+    add_games(index, games, run_size=200)
+    expected = expected_games(games)
+    assert len(index) == len(expected) and index.num_postings() == sum(map(len, expected.values()))
+    assert all(index.games(key) == ids for key, ids in expected.items()) and index.games(1000) == []
+    index.close()
+    index = PositionIndex(filename)
+    assert all(index.games(key) == ids for key, ids in expected.items()) and index.max_game() == 99
+    # Merged with the games already in the index
+    more = random_games(100, 50, seed=1)
+    add_games(index, more, run_size=1 << 20)
+    games.update(more)
+    assert all(index.games(key) == ids for key, ids in expected_games(games).items())
+    index.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['positions.index', 'positions.index.lock']
+
+def test_other_processes_see_merges(tmp_path):
+    filename = str(tmp_path / 'positions.index')
+    index = PositionIndex(filename)
+    other = PositionIndex(filename)
+    add_games(index, {0: [1, 2], 1: [2]}, run_size=10)
+    assert other.games(2) == [0, 1]
+    index.close()
+    other.close()
+
+def old_positions_directory(directory, games):
+    os.mkdir(directory)
+    for key, ids in expected_games(games).items():
+        with open(os.path.join(directory, str(key)), 'w') as fil:
+            print(','.join(map(str, ids)), file=fil)
+
+def test_positions_directory_is_converted_once(tmp_path):
+    directory = str(tmp_path / 'positions')
+    filename = str(tmp_path / 'positions.index')
+    games = random_games(0, 20, seed=2)
+    old_positions_directory(directory, games)
+    # Left by an interrupted conversion, which wrote no index
+    with open(filename + '.tmp', 'wb') as fil:
+        fil.write(b'partial')
+    index = PositionIndex(filename)
+    convert_positions_directory(directory, index, 50)
+    assert all(index.games(key) == ids for key, ids in expected_games(games).items())
+    add_games(index, {20: [1000]}, run_size=10)
+    # Converting again (as another process opening the repertoire would) does nothing
+    convert_positions_directory(directory, index, 50)
+    assert index.games(1000) == [20] and index.num_postings() == sum(map(len, expected_games(games).values())) + 1
+    assert not os.path.exists(filename + '.tmp')
+    index.close()
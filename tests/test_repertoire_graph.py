@@ -0,0 +1,71 @@
+# test_repertoire_graph.py
+
+'''Graph operations on repertoires whose books have no child hashes, as books
+from before child hashes were stored (see Repertoire.complete_child_hashes).'''
+
+import io, time, contextlib, chess, chess.polyglot
+import rep_visitor
+from mmrw import makeEntry
+from spaced_repetition import export_values, shift_due_dates
+
+def add_old_line(rep, player, sans, board=None, learn=False):
+    '''Adds a line to player's repertoire (the tactics if player is None) straight
+    to the books, without child hashes, and returns the board at its end. The 
+    moves of player are set to learn if learn is True.'''
+    board = chess.Board() if board == None else board.copy()
+    for san in sans:
+        move = board.parse_san(san)
+        weight, learn_value = export_values(2.5, 0, 100) if learn and board.turn == player else (1, 0)
+        rep.get_mmrw(player, board.turn).add_entries([makeEntry(board, move, weight, learn_value)])
+        board.push(move)
+    return board
+
+# A position that can't be reached from the start
+CUSTOM = chess.Board('4k3/8/8/8/8/8/4P3/4K3 w - - 0 1')
+
+def old_repertoire(open_repertoire):
+    rep = open_repertoire()
+    add_old_line(rep, chess.WHITE, ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5'], learn=True)
+    add_old_line(rep, chess.WHITE, ['e4', 'c5', 'Nf3', 'd6', 'd4'], learn=True)
+    add_old_line(rep, chess.WHITE, ['d4', 'd5', 'c4'])
+    add_old_line(rep, chess.WHITE, ['e4', 'Kd7', 'e5', 'Ke6', 'Ke2'], board=CUSTOM)
+    assert all(len(mmrw.children) == 0 for mmrw in rep.mmrws())
+    return rep
+
+def test_sizes_and_lines(open_repertoire):
+    rep = old_repertoire(open_repertoire)
+    assert rep.opening_size(chess.WHITE, chess.Board()) == 6
+    assert rep.opening_size(chess.WHITE, CUSTOM) == 3
+    key = chess.polyglot.zobrist_hash(chess.Board('r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3'))
+    line = rep.find_line(key)
+    assert line != None and len(line.move_stack) == 4
+
+def test_scheduling(open_repertoire):
+    rep = old_repertoire(open_repertoire)
+    now = int(time.time() / 60)
+    assert rep.count_due(chess.WHITE, now) == 5
+    assert len(rep_visitor.schedule_lines(chess.Board(), chess.WHITE, 10)) == 5
+    assert len(list(rep_visitor.batch_rep_visitor(chess.Board(), chess.WHITE, 3))) == 3
+    board = chess.Board()
+    board.push_san('e4')
+    board.push_san('c5')
+    assert rep.transform_learning(chess.WHITE, shift_due_dates(1), board) == 2
+    with contextlib.redirect_stdout(io.StringIO()):
+        # No lines from a position without any
+        assert rep_visitor.get_learning_schedule(chess.Board('8/8/8/8/8/8/8/K6k w - - 0 1'), chess.WHITE) == []
+
+def test_nothing_reachable_is_orphaned(open_repertoire):
+    rep = old_repertoire(open_repertoire)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rep_visitor.clear_orphaned_learn_values(chess.WHITE, only_print=False)
+    assert rep.count_due(chess.WHITE, int(time.time() / 60)) == 5
+
+def test_only_orphaned_tactics_are_deleted(open_repertoire):
+    rep = open_repertoire()
+    rep.add_initial_position(chess.Board())
+    # Opponent replies included
+    add_old_line(rep, None, ['e4', 'e5', 'Qh5', 'Nc6'])
+    add_old_line(rep, None, ['e4'], board=CUSTOM)
+    assert len(rep.t) == 5
+    rep.delete_orphaned_tactics()
+    assert len(rep.t) == 4 and list(rep.t.find_all(CUSTOM)) == []
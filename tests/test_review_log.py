@@ -0,0 +1,58 @@
+# test_review_log.py
+
+import os, numpy, chess
+import review_log
+from review_log import ReviewLog
+import global_variables as G
+
+def test_records_round_trip(tmp_path):
+    filename = str(tmp_path / 'reviews')
+    log = ReviewLog(filename)
+    for i in range(G.REVIEW_LOG_BUFFER + 3):
+        log.append(i, 5, review_log.WHITE_BOOK, i % 6, i % 3, 2.5, timestamp=1.7e9 + 60 * i)
+    assert len(log) == G.REVIEW_LOG_BUFFER + 3
+    log.close()
+    # Half a record, as left by an interrupted append
+    with open(filename, 'ab') as fil:
+        fil.write(b'\1' * 5)
+    log = ReviewLog(filename)
+    with log.records() as records:
+        assert len(records) == G.REVIEW_LOG_BUFFER + 3
+        assert records['key'].tolist() == list(range(G.REVIEW_LOG_BUFFER + 3))
+        assert records['latency'][0] == 2500 and records['time'][1] == 1.7e9 + 60
+        assert abs(review_log.retention(records) - numpy.mean(records['q'] >= 3)) < 1e-9
+        # Copies can outlive the mapping
+        errors = records['errors'].copy()
+        records = None
+    assert errors.tolist()[:3] == [0, 1, 2]
+    log.close()
+
+def test_empty_log(tmp_path):
+    log = ReviewLog(str(tmp_path / 'reviews'))
+    with log.records() as records:
+        assert len(records) == 0 and review_log.retention(records) == 0.0
+        assert len(review_log.failure_rates(records)[0]) == 0
+    log.close()
+
+def test_answers_are_logged_when_they_commit(open_repertoire, repertoire_directory):
+    rep = open_repertoire()
+    board = chess.Board()
+    move = chess.Move.from_uci('e2e4')
+    rep.appendWhite(board, move)
+    rep.make_position_learnable(board, chess.WHITE)
+    with rep.transaction():
+        rep.update_learning_data(chess.WHITE, board, move, 0, 10)
+        rep.update_learning_data(chess.WHITE, board, move, 3, 10)
+        assert os.path.getsize(os.path.join(repertoire_directory, 'reviews')) == 0
+    # Visible to other processes right away
+    other = ReviewLog(os.path.join(repertoire_directory, 'reviews'))
+    assert len(other) == 2
+    other.close()
+    rep.update_learning_data(chess.WHITE, board, move, 1, 10)
+    rep = open_repertoire()
+    with rep.reviews.records() as records:
+        assert records['q'].tolist() == [5, 0, 2]
+        keys, raw_moves, reviews, rates = review_log.failure_rates(records)
+        assert reviews.tolist() == [3] and abs(rates[0] - 2 / 3) < 1e-9
+        assert len(review_log.select(records, review_log.BLACK_BOOK)) == 0
+        records = keys = raw_moves = None